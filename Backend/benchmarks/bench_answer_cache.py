@@ -0,0 +1,134 @@
+"""Answer cache: hit rate, latency and GPT calls for a repetitive /query mix.
+
+Users ask a handful of questions per flowchart, most of them more than once
+and in slightly different words. Questions are drawn from a few templates
+with a Zipf-like skew and random rewording (case, punctuation, filler
+words), and every --write-every queries a graph write invalidates the
+cache. GPT calls go to benchmarks/stub_llm_server.py and the Neo4j calls
+are replaced with an in-memory graph.
+
+    python benchmarks/bench_answer_cache.py --queries 300 --similarity 0.6
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+import stub_llm_server
+from bench_concurrent_query import free_port, summarize
+from fakes import patch_graph_store
+from synthetic import generate_flowchart_graph
+
+TEMPLATES = (
+    "How does {a} interact with {b}?",
+    "What does {a} do?",
+    "Which components depend on {a}?",
+    "What happens after {a} calls {b}?",
+    "Where is data from {a} stored?",
+)
+FILLERS = ("", "please ", "can you tell me ", "quickly, ")
+
+
+def generate_questions(graph, count, topics, seed):
+    rng = random.Random(seed)
+    edges = rng.sample(graph["relationships"], topics)
+    questions = []
+    for _ in range(count):
+        # Low ranks are picked far more often
+        edge = edges[min(int(rng.paretovariate(1.2)) - 1, topics - 1)]
+        question = rng.choice(TEMPLATES).format(a=edge["from"], b=edge["to"])
+        question = rng.choice(FILLERS) + question
+        if rng.random() < 0.5:
+            question = question.lower().rstrip("?")
+        questions.append(question)
+    return questions
+
+
+async def run(args, graph, stub_app):
+    import main
+
+    store = patch_graph_store(main)
+    await store.save(graph)
+    questions = generate_questions(graph, args.queries, args.topics, args.seed)
+
+    latencies = {"hit": [], "miss": []}
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app), httpx.AsyncClient(
+        transport=transport, base_url="http://backend", timeout=None
+    ) as client:
+        calls_before = stub_app.state.calls
+        for i, question in enumerate(questions):
+            if args.write_every and i and i % args.write_every == 0:
+                await store.save({"nodes": graph["nodes"][:1], "relationships": []})
+            hits = main.get_answer_cache().hits
+            start = time.perf_counter()
+            response = await client.post(
+                "/query",
+                json={
+                    "user_input": question,
+                    "conversation_history": [],
+                    "use_relevant_context": True,
+                },
+            )
+            response.raise_for_status()
+            kind = "hit" if main.get_answer_cache().hits > hits else "miss"
+            latencies[kind].append(time.perf_counter() - start)
+        gpt_calls = stub_app.state.calls - calls_before
+
+    return {
+        "queries": args.queries,
+        "similarity_threshold": args.similarity,
+        "answer_cache": main.get_answer_cache().stats(),
+        "gpt_calls": gpt_calls,
+        "hit_latency": summarize(latencies["hit"]) if latencies["hit"] else None,
+        "miss_latency": summarize(latencies["miss"]) if latencies["miss"] else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--topics", type=int, default=10)
+    parser.add_argument("--similarity", type=float, default=0.0)
+    parser.add_argument("--write-every", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    port = free_port()
+    _, stub_app = stub_llm_server.start_in_thread(port, args.latency_ms / 1000)
+    os.environ.update(
+        {
+            "AZURE_OPENAI_ENDPOINT_URL": f"http://127.0.0.1:{port}",
+            "AZURE_OPENAI_API_KEY": "stub",
+            "AZURE_OPENAI_DEPLOYMENT_NAME": "stub",
+            "AZURE_OPENAI_API_VERSION": "2024-08-01-preview",
+            "ANSWER_CACHE_SIMILARITY_THRESHOLD": str(args.similarity),
+        }
+    )
+    os.environ.setdefault("NEO4J_URI", "bolt://localhost:7687")
+    os.environ.setdefault("NEO4J_USER", "neo4j")
+    os.environ.setdefault("NEO4J_PASSWORD", "")
+    scratch_dir = tempfile.mkdtemp(prefix="bench-")
+    os.environ["JOBS_DIR"] = os.path.join(scratch_dir, "jobs")
+    os.environ["TILE_CACHE_PATH"] = os.path.join(scratch_dir, "tile_cache.sqlite3")
+    # main.py loads its prompt files relative to the working directory
+    os.chdir(BACKEND_DIR)
+
+    graph = generate_flowchart_graph(seed=args.seed)
+    print(json.dumps(asyncio.run(run(args, graph, stub_app)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
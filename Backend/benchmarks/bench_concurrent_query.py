@@ -0,0 +1,148 @@
+"""Load test: /query latency while an /upload is running.
+
+GPT calls go to benchmarks/stub_llm_server.py and the Neo4j calls made by
+main.py are replaced with an in-memory graph, so the only thing measured is
+how well the event loop keeps serving requests during an upload.
+
+    python benchmarks/bench_concurrent_query.py --queries 50 --latency-ms 300
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+import stub_llm_server
+from fakes import patch_graph_store
+from synthetic import generate_flowchart_base64
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+        "max_ms": round(latencies[-1] * 1000, 1),
+    }
+
+
+async def timed(client, method, url, **kwargs):
+    start = time.perf_counter()
+    response = await client.request(method, url, **kwargs)
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+async def query_burst(client, count):
+    payload = {
+        "user_input": "How does Module 1 reach Module 2?",
+        "conversation_history": [],
+        "use_relevant_context": True,
+    }
+    return await asyncio.gather(
+        *[timed(client, "POST", "/query", json=payload) for _ in range(count)]
+    )
+
+
+async def run_upload(client, payload):
+    start = time.perf_counter()
+    response = await client.post("/upload", json=payload)
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    while True:
+        job = (await client.get(f"/jobs/{job_id}")).json()
+        if job["status"] in ("completed", "failed"):
+            break
+        await asyncio.sleep(0.1)
+    if job["status"] == "failed":
+        raise RuntimeError(job["error"])
+    return time.perf_counter() - start
+
+
+async def run(args):
+    import main
+
+    patch_graph_store(main)
+    image = generate_flowchart_base64(args.width, args.height, seed=1)
+    upload_payload = {
+        "image_base64_array": [image] * args.images,
+        "image_name_array": [f"image-{i}.png" for i in range(args.images)],
+        "rows": args.rows,
+        "cols": args.cols,
+    }
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app), httpx.AsyncClient(
+        transport=transport, base_url="http://backend", timeout=None
+    ) as client:
+        idle = await query_burst(client, args.queries)
+
+        upload = asyncio.create_task(run_upload(client, upload_payload))
+        # Let the upload get going before measuring
+        await asyncio.sleep(0.05)
+        healthcheck = await timed(client, "GET", "/healthcheck")
+        during_upload = await query_burst(client, args.queries)
+        upload_seconds = await upload
+
+    return {
+        "llm_latency_ms": args.latency_ms,
+        "idle_query": summarize(idle),
+        "query_during_upload": summarize(during_upload),
+        "healthcheck_during_upload_ms": round(healthcheck * 1000, 1),
+        "upload_seconds": round(upload_seconds, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--images", type=int, default=2)
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--rows", type=int, default=4)
+    parser.add_argument("--cols", type=int, default=4)
+    args = parser.parse_args()
+
+    port = free_port()
+    stub_llm_server.start_in_thread(port, args.latency_ms / 1000)
+    os.environ.update(
+        {
+            "AZURE_OPENAI_ENDPOINT_URL": f"http://127.0.0.1:{port}",
+            "AZURE_OPENAI_API_KEY": "stub",
+            "AZURE_OPENAI_DEPLOYMENT_NAME": "stub",
+            "AZURE_OPENAI_API_VERSION": "2024-08-01-preview",
+        }
+    )
+    os.environ.setdefault("NEO4J_URI", "bolt://localhost:7687")
+    os.environ.setdefault("NEO4J_USER", "neo4j")
+    os.environ.setdefault("NEO4J_PASSWORD", "")
+    scratch_dir = tempfile.mkdtemp(prefix="bench-")
+    os.environ["JOBS_DIR"] = os.path.join(scratch_dir, "jobs")
+    os.environ["TILE_CACHE_PATH"] = os.path.join(scratch_dir, "tile_cache.sqlite3")
+    # main.py loads its prompt files relative to the working directory
+    os.chdir(BACKEND_DIR)
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+"""End-to-end load test of /upload, /query, /fullgraph and /editgraph.
+
+Neo4j is replaced with the in-memory graph from benchmarks/fakes.py
+(--store memory) or the embedded SQLite store (--store sqlite), seeded with
+a synthetic graph, and GPT either with FakeLLM in the same process
+(--llm fake) or with benchmarks/stub_llm_server.py over HTTP (--llm stub),
+which also goes through the OpenAI client and the dispatcher. Each scenario
+sends --requests requests from --concurrency clients at a time, an upload
+counting until its job has finished; "mixed" sends queries, full graph reads
+and edits together in the --mix proportions. The JSON report has throughput
+and latency percentiles per scenario and the commit it was run on, and with
+--baseline the ratios to an earlier report:
+
+    python benchmarks/bench_e2e.py --concurrency 16 --requests 200 --output before.json
+    python benchmarks/bench_e2e.py --concurrency 16 --requests 200 --baseline before.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+import stub_llm_server
+from bench_concurrent_query import free_port
+from fakes import FakeLLM, patch_graph_store, patch_llm
+from synthetic import (
+    generate_conversation,
+    generate_flowchart_base64,
+    generate_flowchart_graph,
+)
+
+SCENARIOS = ("query", "fullgraph", "editgraph", "upload", "mixed")
+
+
+def percentile(values, q):
+    # Nearest rank, values sorted
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def summarize(latencies, errors, elapsed):
+    report = {
+        "requests": len(latencies) + sum(errors.values()),
+        "errors": dict(errors),
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+    }
+    if latencies:
+        latencies = sorted(latencies)
+        for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            report[f"{name}_ms"] = round(percentile(latencies, q) * 1000, 1)
+        report["max_ms"] = round(latencies[-1] * 1000, 1)
+    return report
+
+
+async def run_load(send, kinds, concurrency):
+    # kinds[i] is the kind of request i, every client takes the next one
+    # until none are left
+    latencies = {kind: [] for kind in set(kinds)}
+    errors = {kind: {} for kind in set(kinds)}
+    counter = itertools.count()
+
+    async def client():
+        while (i := next(counter)) < len(kinds):
+            kind = kinds[i]
+            start = time.perf_counter()
+            try:
+                await send(kind, i)
+            except Exception as e:
+                name = type(e).__name__
+                errors[kind][name] = errors[kind].get(name, 0) + 1
+                continue
+            latencies[kind].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+class Workload:
+    def __init__(self, client, graph, args):
+        self.client = client
+        self.args = args
+        self.names = [node["name"] for node in graph["nodes"]]
+        self.conversation = generate_conversation(
+            graph, args.requests + args.warmup + args.history_turns, seed=args.seed
+        )
+        self.rng = random.Random(args.seed)
+        self.images = {}
+
+    async def query(self, i):
+        turn = i + self.args.history_turns
+        response = await self.client.post(
+            "/query",
+            json={
+                "user_input": self.conversation[2 * turn]["content"],
+                "conversation_history": self.conversation[
+                    2 * (turn - self.args.history_turns) : 2 * turn
+                ],
+                "use_relevant_context": True,
+            },
+        )
+        response.raise_for_status()
+
+    async def fullgraph(self, i):
+        response = await self.client.get("/fullgraph")
+        response.raise_for_status()
+
+    async def editgraph(self, i):
+        # A new node joined to an existing one, as drawn in the editor
+        name = f"Bench Node {i}"
+        response = await self.client.post(
+            "/editgraph",
+            json={
+                "editedNodes": [{"oldName": "", "newName": name}],
+                "deletedEdges": [],
+                "addedEdges": [
+                    {"from": self.rng.choice(self.names), "to": name, "label": "calls"}
+                ],
+            },
+        )
+        response.raise_for_status()
+
+    def get_image(self, i):
+        # Different images, so the tile cache does not answer for GPT
+        if i not in self.images:
+            self.images[i] = generate_flowchart_base64(
+                self.args.width, self.args.height, boxes=30, seed=self.args.seed + i
+            )
+        return self.images[i]
+
+    async def upload(self, i):
+        response = await self.client.post(
+            "/upload",
+            json={
+                "image_base64_array": [self.get_image(i)],
+                "image_name_array": [f"bench-{i}.png"],
+                "rows": self.args.rows,
+                "cols": self.args.cols,
+            },
+        )
+        response.raise_for_status()
+        job_id = response.json()["job_id"]
+        while True:
+            job = (await self.client.get(f"/jobs/{job_id}")).json()
+            if job["status"] in ("completed", "failed"):
+                break
+            await asyncio.sleep(0.05)
+        if job["status"] == "failed":
+            raise RuntimeError(job["error"])
+
+    async def send(self, kind, i):
+        await getattr(self, kind)(i)
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        kind, weight = part.split("=")
+        weights[kind.strip()] = float(weight)
+    return weights
+
+
+async def run_scenario(workload, scenario, args):
+    if scenario == "upload":
+        kinds = ["upload"] * args.uploads
+        # Image generation is not part of the measurement
+        for i in range(args.uploads):
+            workload.get_image(i)
+        latencies, errors, elapsed = await run_load(
+            workload.send, kinds, min(args.concurrency, args.uploads)
+        )
+        return summarize(latencies["upload"], errors["upload"], elapsed)
+
+    if scenario == "mixed":
+        weights = parse_mix(args.mix)
+        rng = random.Random(args.seed)
+        kinds = rng.choices(list(weights), list(weights.values()), k=args.requests)
+    else:
+        kinds = [scenario] * args.requests
+
+    # Builds the search index and graph snapshot before measuring
+    for i in range(args.warmup):
+        await workload.send(kinds[i % len(kinds)], args.requests + i)
+
+    latencies, errors, elapsed = await run_load(workload.send, kinds, args.concurrency)
+    all_latencies = [latency for values in latencies.values() for latency in values]
+    all_errors = {}
+    for kind_errors in errors.values():
+        for name, count in kind_errors.items():
+            all_errors[name] = all_errors.get(name, 0) + count
+    report = summarize(all_latencies, all_errors, elapsed)
+    if scenario == "mixed":
+        report["by_endpoint"] = {
+            kind: summarize(latencies[kind], errors[kind], elapsed)
+            for kind in sorted(latencies)
+        }
+    return report
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=BACKEND_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    # Above 1 is more throughput or more latency than the baseline
+    comparison = {"baseline_commit": baseline.get("commit")}
+    for scenario, result in report["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(scenario)
+        if not before:
+            continue
+        comparison[scenario] = {
+            key: round(result[key] / before[key], 3)
+            for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms")
+            if result.get(key) and before.get(key)
+        }
+    return comparison
+
+
+async def run(args, llm):
+    import main
+
+    if args.store == "sqlite":
+        from sqlite_utils import SQLiteGraphStore
+
+        store = main.graph_store = SQLiteGraphStore()
+    else:
+        store = patch_graph_store(main)
+    await store.ensure_schema()
+    if args.llm == "fake":
+        patch_llm(main, llm)
+    graph = generate_flowchart_graph(args.nodes, args.edges, seed=args.seed)
+    await store.save(graph)
+
+    report = {
+        "commit": get_commit(),
+        "config": vars(args),
+        "scenarios": {},
+    }
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app), httpx.AsyncClient(
+        transport=transport, base_url="http://backend", timeout=None
+    ) as client:
+        workload = Workload(client, graph, args)
+        for scenario in args.scenarios.split(","):
+            report["scenarios"][scenario] = await run_scenario(workload, scenario, args)
+
+    report["llm_calls"] = llm.calls if args.llm == "fake" else llm.state.calls
+    report["answer_cache"] = main.get_answer_cache().stats()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scenarios", default=",".join(SCENARIOS), help="comma separated"
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--mix", default="query=7,fullgraph=2,editgraph=1")
+    parser.add_argument("--llm", choices=("fake", "stub"), default="fake")
+    parser.add_argument("--store", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--token-latency-ms", type=float, default=0)
+    parser.add_argument("--answer-words", type=int, default=60)
+    parser.add_argument("--history-turns", type=int, default=2)
+    parser.add_argument("--nodes", type=int, default=300)
+    parser.add_argument("--edges", type=int, default=600)
+    parser.add_argument("--uploads", type=int, default=4)
+    parser.add_argument("--width", type=int, default=2000)
+    parser.add_argument("--height", type=int, default=1500)
+    parser.add_argument("--rows", type=int, default=3)
+    parser.add_argument("--cols", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("--baseline", help="report of an earlier run to compare to")
+    args = parser.parse_args()
+    for scenario in args.scenarios.split(","):
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario {scenario}, choose from {SCENARIOS}")
+
+    port = free_port()
+    if args.llm == "stub":
+        _, llm = stub_llm_server.start_in_thread(
+            port,
+            args.latency_ms / 1000,
+            token_latency=args.token_latency_ms / 1000,
+            answer_words=args.answer_words,
+        )
+    else:
+        llm = FakeLLM(
+            args.latency_ms / 1000, args.token_latency_ms / 1000, args.answer_words
+        )
+    os.environ.update(
+        {
+            "AZURE_OPENAI_ENDPOINT_URL": f"http://127.0.0.1:{port}",
+            "AZURE_OPENAI_API_KEY": "stub",
+            "AZURE_OPENAI_DEPLOYMENT_NAME": "stub",
+            "AZURE_OPENAI_API_VERSION": "2024-08-01-preview",
+        }
+    )
+    os.environ.setdefault("NEO4J_URI", "bolt://localhost:7687")
+    os.environ.setdefault("NEO4J_USER", "neo4j")
+    os.environ.setdefault("NEO4J_PASSWORD", "")
+    scratch_dir = tempfile.mkdtemp(prefix="bench-")
+    os.environ["JOBS_DIR"] = os.path.join(scratch_dir, "jobs")
+    os.environ["TILE_CACHE_PATH"] = os.path.join(scratch_dir, "tile_cache.sqlite3")
+    os.environ["SQLITE_GRAPH_PATH"] = os.path.join(scratch_dir, "graph.sqlite3")
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    # main.py loads its prompt files relative to the working directory
+    os.chdir(BACKEND_DIR)
+
+    report = asyncio.run(run(args, llm))
+    if baseline:
+        with open(baseline) as file:
+            report["vs_baseline"] = compare(report, json.load(file))
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as file:
+            file.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
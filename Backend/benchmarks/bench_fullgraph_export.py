@@ -0,0 +1,214 @@
+"""Exporting a large graph, /fullgraph vs /fullgraph/stream vs /fullgraph/page.
+
+A synthetic graph of --nodes nodes, with up to --max-edges edges from each,
+is saved in the embedded SQLite store. For every mode and encoding a fresh
+backend runs under uvicorn in a child process, so no snapshot of the graph
+is held when the export starts, and gets the whole graph: "fullgraph" in one
+response, "stream" as NDJSON and "pages" by following next_cursor with
+--page-size records a page. The report has the time to the first byte and
+to the last, the bytes sent and the peak resident memory of the backend
+during the export over the memory before it. Linux only, as it reads /proc:
+
+    python benchmarks/bench_fullgraph_export.py --nodes 50000 --max-edges 3
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+import zstandard
+
+from bench_concurrent_query import free_port
+from bench_upload_memory import read_memory, reset_peak_memory
+
+MODES = ("fullgraph", "stream", "pages")
+ENCODINGS = ("identity", "gzip", "zstd")
+COLLECTION = "export"
+
+
+def generate_graph(nodes, max_edges, seed):
+    rng = random.Random(seed)
+    words = ["validate", "request", "store", "retry", "notify", "queue", "parse"]
+    graph = {"nodes": [], "relationships": []}
+    for i in range(nodes):
+        graph["nodes"].append(
+            {
+                "name": f"Step {i} {rng.choice(words)}",
+                "context": [f"{rng.choice(words)} the {rng.choice(words)} output"],
+                "imageSources": [f"flowchart-{i % 20}.png"],
+            }
+        )
+    for node in graph["nodes"]:
+        for _ in range(rng.randint(0, max_edges)):
+            graph["relationships"].append(
+                {
+                    "from": node["name"],
+                    "to": rng.choice(graph["nodes"])["name"],
+                    "name": rng.choice(["yes", "no", "next", "on error"]),
+                    "context": [],
+                    "imageSources": [node["imageSources"][0]],
+                }
+            )
+    return graph
+
+
+def start_server(port, env):
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+        ],
+        cwd=BACKEND_DIR,
+        env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(600):
+        try:
+            httpx.get(base_url + "/readiness").raise_for_status()
+            return process, base_url
+        except httpx.HTTPError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Backend did not start.")
+
+
+def decode(body, encoding):
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    return body
+
+
+def get(client, path, params, encoding, timing):
+    # The body as sent, without letting httpx decode it
+    chunks = []
+    with client.stream(
+        "GET", path, params=params, headers={"Accept-Encoding": encoding}
+    ) as response:
+        response.raise_for_status()
+        for chunk in response.iter_raw():
+            if "first_byte" not in timing:
+                timing["first_byte"] = time.perf_counter()
+            chunks.append(chunk)
+        sent_encoding = response.headers.get("Content-Encoding", "identity")
+    body = b"".join(chunks)
+    return decode(body, sent_encoding), len(body)
+
+
+def export(client, mode, encoding, args, timing):
+    # Returns the records received and the bytes sent for them
+    params = {"collection_id": COLLECTION}
+    if mode == "fullgraph":
+        body, size = get(client, "/fullgraph", params, encoding, timing)
+        graph = json.loads(body)["full_graph"]
+        return len(graph["nodes"]) + len(graph["relationships"]), size
+    if mode == "stream":
+        body, size = get(client, "/fullgraph/stream", params, encoding, timing)
+        return len(body.splitlines()), size
+
+    records = 0
+    total = 0
+    params["limit"] = args.page_size
+    while True:
+        body, size = get(client, "/fullgraph/page", params, encoding, timing)
+        page = json.loads(body)
+        records += len(page["nodes"]) + len(page["relationships"])
+        total += size
+        if page["next_cursor"] is None:
+            return records, total
+        params["cursor"] = page["next_cursor"]
+
+
+def measure(mode, encoding, args, env):
+    process, base_url = start_server(free_port(), env)
+    try:
+        with httpx.Client(base_url=base_url, timeout=None) as client:
+            before = read_memory(process.pid)
+            peak_reset = reset_peak_memory(process.pid)
+            timing = {}
+            start = time.perf_counter()
+            records, size = export(client, mode, encoding, args, timing)
+            elapsed = time.perf_counter() - start
+            after = read_memory(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+
+    peak = after["VmHWM"] if peak_reset else max(after["VmHWM"], before["VmRSS"])
+    return {
+        "records": records,
+        "first_byte_seconds": round(timing["first_byte"] - start, 3),
+        "seconds": round(elapsed, 3),
+        "sent_mb": round(size / 2**20, 2),
+        "peak_growth_mb": round((peak - before["VmRSS"]) / 1024, 1),
+        "peak_reset": peak_reset,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated")
+    parser.add_argument(
+        "--encodings", default=",".join(ENCODINGS), help="comma separated"
+    )
+    parser.add_argument("--nodes", type=int, default=50000)
+    parser.add_argument("--max-edges", type=int, default=3)
+    parser.add_argument("--page-size", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    scratch_dir = tempfile.mkdtemp(prefix="bench-")
+    env = dict(
+        os.environ,
+        AZURE_OPENAI_ENDPOINT_URL="http://127.0.0.1:9",
+        AZURE_OPENAI_API_KEY="stub",
+        AZURE_OPENAI_DEPLOYMENT_NAME="stub",
+        AZURE_OPENAI_API_VERSION="2024-08-01-preview",
+        GRAPH_STORE="sqlite",
+        SQLITE_GRAPH_PATH=os.path.join(scratch_dir, "graph.sqlite3"),
+        JOBS_DIR=os.path.join(scratch_dir, "jobs"),
+        TILE_CACHE_PATH=os.path.join(scratch_dir, "tile_cache.sqlite3"),
+    )
+    from sqlite_utils import SQLiteGraphStore
+
+    graph = generate_graph(args.nodes, args.max_edges, args.seed)
+    store = SQLiteGraphStore(env["SQLITE_GRAPH_PATH"])
+    store.ensure_schema_sync()
+    store.save_sync(graph, COLLECTION)
+    store.close_sync()
+
+    report = {
+        "config": vars(args),
+        "nodes": len(graph["nodes"]),
+        "relationships": len(graph["relationships"]),
+        "modes": {},
+    }
+    del graph
+    for mode in args.modes.split(","):
+        report["modes"][mode] = {
+            encoding: measure(mode, encoding, args, env)
+            for encoding in args.encodings.split(",")
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Write transactions per upload, one save per tile vs the coalescing writer.
+
+Uploads go through main.py with FakeLLM, whose tile graphs reuse node names
+across tiles like overlapping sections of a flowchart do. "per-tile" makes
+the writer save every graph on its own, which issues the same transactions
+as saving each tile as soon as its GPT call returns; "batched" uses the
+WRITE_BATCH_* settings. The report has the graphs, saves and transactions
+per upload, how long extraction took and the size of the saved graph, which
+is the same for both:
+
+    python benchmarks/bench_graph_writer.py --uploads 3 --rows 6 --cols 6 --store sqlite
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+from cache_utils import TileCache
+from fakes import FakeLLM, patch_graph_store, patch_llm
+from synthetic import generate_flowchart_base64
+
+MODES = ("per-tile", "batched")
+
+
+async def upload(client, image, name, args):
+    response = await client.post(
+        "/upload",
+        json={
+            "image_base64_array": [image],
+            "image_name_array": [name],
+            "rows": args.rows,
+            "cols": args.cols,
+        },
+    )
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    while True:
+        job = (await client.get(f"/jobs/{job_id}")).json()
+        if job["status"] in ("completed", "failed"):
+            break
+        await asyncio.sleep(0.02)
+    if job["status"] == "failed":
+        raise RuntimeError(job["error"])
+    return job
+
+
+async def run_mode(main, storage_utils, mode, images, args):
+    if args.store == "sqlite":
+        from sqlite_utils import SQLiteGraphStore
+
+        store = main.graph_store = SQLiteGraphStore(
+            os.path.join(tempfile.mkdtemp(prefix="bench-"), "graph.sqlite3")
+        )
+    elif args.store == "neo4j":
+        store = main.graph_store = storage_utils.get_graph_store("neo4j")
+    else:
+        store = patch_graph_store(main)
+    await store.ensure_schema()
+    await store.delete_all()
+    # A new tile cache, so every mode makes the same GPT calls
+    main.tile_cache = TileCache(
+        os.path.join(tempfile.mkdtemp(prefix="bench-"), "tile_cache.sqlite3")
+    )
+    main.GraphWriter = (
+        functools.partial(storage_utils.GraphWriter, max_nodes=1)
+        if mode == "per-tile"
+        else storage_utils.GraphWriter
+    )
+
+    uploads = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app), httpx.AsyncClient(
+        transport=transport, base_url="http://backend", timeout=None
+    ) as client:
+        for i, image in enumerate(images):
+            job = await upload(client, image, f"bench-{i}.png", args)
+            uploads.append(
+                {
+                    **job["write_stats"],
+                    "extract_seconds": round(job["timings"]["extract_seconds"], 3),
+                }
+            )
+        graph = (await client.get("/fullgraph")).json()["full_graph"]
+
+    return {
+        "uploads": uploads,
+        "transactions_per_upload": sum(u["transactions"] for u in uploads)
+        / len(uploads),
+        "saved_nodes": len(graph["nodes"]),
+        "saved_relationships": len(graph["relationships"]),
+    }
+
+
+async def run(args, images):
+    import main
+    import storage_utils
+
+    patch_llm(main, FakeLLM(args.latency_ms / 1000))
+    report = {"config": vars(args), "modes": {}}
+    for mode in args.modes.split(","):
+        report["modes"][mode] = await run_mode(main, storage_utils, mode, images, args)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated")
+    parser.add_argument(
+        "--store", choices=("memory", "sqlite", "neo4j"), default="sqlite"
+    )
+    parser.add_argument("--uploads", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=6)
+    parser.add_argument("--cols", type=int, default=6)
+    parser.add_argument("--width", type=int, default=3000)
+    parser.add_argument("--height", type=int, default=2000)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.environ.update(
+        {
+            "AZURE_OPENAI_ENDPOINT_URL": "http://127.0.0.1:9",
+            "AZURE_OPENAI_API_KEY": "stub",
+            "AZURE_OPENAI_DEPLOYMENT_NAME": "stub",
+            "AZURE_OPENAI_API_VERSION": "2024-08-01-preview",
+        }
+    )
+    os.environ.setdefault("NEO4J_URI", "bolt://localhost:7687")
+    os.environ.setdefault("NEO4J_USER", "neo4j")
+    os.environ.setdefault("NEO4J_PASSWORD", "")
+    scratch_dir = tempfile.mkdtemp(prefix="bench-")
+    os.environ["JOBS_DIR"] = os.path.join(scratch_dir, "jobs")
+    os.environ["TILE_CACHE_PATH"] = os.path.join(scratch_dir, "tile_cache.sqlite3")
+    # main.py loads its prompt files relative to the working directory
+    os.chdir(BACKEND_DIR)
+
+    images = [
+        generate_flowchart_base64(args.width, args.height, boxes=80, seed=args.seed + i)
+        for i in range(args.uploads)
+    ]
+    print(json.dumps(asyncio.run(run(args, images)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
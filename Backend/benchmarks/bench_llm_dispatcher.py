@@ -0,0 +1,137 @@
+"""Drive gpt_utils.LLMDispatcher against a stub deployment that returns 429s.
+
+A burst of tile, relevance, query and merge calls is sent once with retries
+disabled, the way get_gpt_response used to call Azure, and once through the
+dispatcher with its concurrency cap, rate limiter and Retry-After backoff.
+
+    python benchmarks/bench_llm_dispatcher.py --calls 200 --rate-limit-ratio 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import stub_llm_server
+
+CALLERS = ("tile", "relevance", "query", "merge")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_messages(caller, i):
+    if caller == "tile":
+        return [
+            {"role": "system", "content": "Convert the image section to a graph."},
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": "data:image/jpeg;base64,AAAA"},
+                    },
+                    {"type": "text", "text": f"Section coordinates: ({i}, 0)."},
+                ],
+            },
+        ]
+    if caller == "relevance":
+        return [
+            {"role": "system", "content": "Analyze the user query and pick nodes."},
+            {"role": "user", "content": f"User input: 'question {i}'."},
+        ]
+    if caller == "merge":
+        return [
+            {
+                "role": "system",
+                "content": "Decide which of the provided flowchart nodes are the same.",
+            },
+            {"role": "user", "content": json.dumps([[{"name": "A"}, {"name": "a"}]])},
+        ]
+    return [{"role": "user", "content": f"Question {i}"}]
+
+
+async def run_burst(gpt_utils, dispatcher, calls):
+    # A fresh client per run, its connection pool belongs to this event loop
+    client = gpt_utils.get_async_openai_client()
+
+    async def call(i):
+        caller = CALLERS[i % len(CALLERS)]
+        params = gpt_utils.get_completion_params(get_messages(caller, i))
+        try:
+            await dispatcher.create_async(client, params, caller)
+            return True
+        except Exception:
+            return False
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[call(i) for i in range(calls)])
+    return {
+        "succeeded": sum(results),
+        "failed": len(results) - sum(results),
+        "seconds": round(time.perf_counter() - start, 2),
+        "callers": dispatcher.stats()["callers"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.2)
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests-per-minute", type=int, default=0)
+    parser.add_argument("--tokens-per-minute", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=10)
+    args = parser.parse_args()
+
+    port = free_port()
+    _, stub = stub_llm_server.start_in_thread(
+        port,
+        args.latency_ms / 1000,
+        rate_limit_ratio=args.rate_limit_ratio,
+        retry_after=args.retry_after,
+        jitter=args.jitter_ms / 1000,
+    )
+    os.environ.update(
+        {
+            "AZURE_OPENAI_ENDPOINT_URL": f"http://127.0.0.1:{port}",
+            "AZURE_OPENAI_API_KEY": "stub",
+            "AZURE_OPENAI_DEPLOYMENT_NAME": "stub",
+            "AZURE_OPENAI_API_VERSION": "2024-08-01-preview",
+        }
+    )
+    import gpt_utils
+
+    bare = gpt_utils.LLMDispatcher(
+        max_concurrency=args.calls, timeout=args.timeout, max_retries=0
+    )
+    dispatched = gpt_utils.LLMDispatcher(
+        max_concurrency=args.concurrency,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        timeout=args.timeout,
+    )
+    report = {
+        "calls": args.calls,
+        "rate_limit_ratio": args.rate_limit_ratio,
+        "without_retries": asyncio.run(run_burst(gpt_utils, bare, args.calls)),
+        "dispatcher": asyncio.run(run_burst(gpt_utils, dispatched, args.calls)),
+        "stub_rate_limited": stub.state.rate_limited,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Merge quality and runtime of merge_utils on generated graphs.
+
+Every entity is spelled a few different ways, the way overlapping tiles
+name the same box (casing, camelCase, plurals, typos, abbreviations), and
+the edges are spread over those spellings. Pairwise precision and recall
+are measured against the known entities, once for the local matcher alone
+and once with the ambiguous groups resolved by an oracle standing in for GPT.
+
+    python benchmarks/bench_merge.py --entities 1000 2000 5000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from itertools import combinations
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import merge_utils
+
+WORDS = (
+    "account address alert approval audit authentication authorization backup "
+    "balance basket billing cache card cart catalog checkout config customer "
+    "dashboard database delivery discount document email error event export "
+    "feedback file gateway history import inventory invoice ledger login logout "
+    "message metrics notification order password payment permission pipeline "
+    "policy pricing product profile queue receipt refund report request review "
+    "schedule search session settings shipment shipping storage subscription "
+    "support tax ticket token transaction upload user validation vendor wallet "
+    "warehouse workflow"
+).split()
+SUFFIXES = "service manager handler page module api store job worker check".split()
+ABBREVIATIONS = {
+    "authentication": "auth",
+    "authorization": "authz",
+    "configuration": "config",
+    "database": "db",
+    "notification": "notif",
+    "subscription": "sub",
+}
+
+
+def generate_entities(count, rng):
+    entities = set()
+    while len(entities) < count:
+        words = rng.sample(WORDS, rng.choice((1, 2))) + [rng.choice(SUFFIXES)]
+        if rng.random() < 0.1:
+            words.append(str(rng.randint(1, 9)))
+        entities.add(" ".join(words))
+    return sorted(entities)
+
+
+def typo(word, rng):
+    if len(word) < 5:
+        return word
+    i = rng.randrange(1, len(word) - 2)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2 :]
+
+
+def spell(entity, rng):
+    words = entity.split()
+    style = rng.choice(("title", "lower", "camel", "plural", "typo", "abbrev", "dash"))
+    if style == "lower":
+        return " ".join(words)
+    if style == "camel":
+        return "".join(word.capitalize() for word in words)
+    if style == "plural":
+        words[-1] += "s" if not words[-1].isdigit() else ""
+    if style == "typo":
+        i = rng.randrange(len(words))
+        words[i] = typo(words[i], rng)
+    if style == "abbrev":
+        words = [ABBREVIATIONS.get(word, word) for word in words]
+    if style == "dash":
+        return "-".join(words)
+    return " ".join(word.capitalize() for word in words)
+
+
+def generate_graph(entity_count, seed):
+    rng = random.Random(seed)
+    entities = generate_entities(entity_count, rng)
+    truth = {}
+    spellings = {}
+    for entity in entities:
+        names = {" ".join(word.capitalize() for word in entity.split())}
+        for _ in range(rng.randint(0, 3)):
+            names.add(spell(entity, rng))
+        # Two entities can collide on a spelling, keep the first owner
+        names = [name for name in names if name not in truth]
+        for name in names:
+            truth[name] = entity
+        spellings[entity] = names
+
+    graph = {
+        "nodes": [
+            {"name": name, "context": [f"{entity} context"], "imageSources": ["a.png"]}
+            for name, entity in truth.items()
+        ],
+        "relationships": [],
+    }
+    for _ in range(entity_count * 2):
+        source, target = rng.sample(entities, 2)
+        graph["relationships"].append(
+            {
+                "from": rng.choice(spellings[source]),
+                "to": rng.choice(spellings[target]),
+                "name": rng.choice(("calls", "Calls", "reads from", "writes to")),
+                "context": [],
+                "imageSources": ["a.png"],
+            }
+        )
+    return graph, truth
+
+
+def get_pairs(groups):
+    return {
+        tuple(sorted(pair)) for group in groups for pair in combinations(set(group), 2)
+    }
+
+
+def score(predicted_groups, truth):
+    by_entity = {}
+    for name, entity in truth.items():
+        by_entity.setdefault(entity, []).append(name)
+    expected = get_pairs(by_entity.values())
+    predicted = get_pairs(predicted_groups)
+    true_positives = len(expected & predicted)
+    precision = true_positives / len(predicted) if predicted else 1.0
+    recall = true_positives / len(expected) if expected else 1.0
+    return {
+        "precision": round(precision, 4),
+        "recall": round(recall, 4),
+        "f1": round(2 * precision * recall / ((precision + recall) or 1), 4),
+    }
+
+
+def oracle(ambiguous_groups, truth):
+    merges = {}
+    for group in ambiguous_groups:
+        for name in group:
+            merges.setdefault((id(group), truth[name]), []).append(name)
+    return [merge for merge in merges.values() if len(merge) > 1]
+
+
+def close_groups(groups):
+    # Transitive closure, as merge_graph applies the groups
+    union_find = merge_utils.UnionFind()
+    for group in groups:
+        for name in group[1:]:
+            union_find.union(group[0], name)
+    return union_find.groups()
+
+
+def run(entity_count, seed):
+    graph, truth = generate_graph(entity_count, seed)
+    names = [node["name"] for node in graph["nodes"]]
+
+    start = time.perf_counter()
+    groups, ambiguous_groups = merge_utils.find_merge_candidates(names)
+    match_seconds = time.perf_counter() - start
+
+    arbitrated = groups + oracle(ambiguous_groups, truth)
+    start = time.perf_counter()
+    merged_graph, renamed = merge_utils.merge_graph(graph, arbitrated)
+    merge_seconds = time.perf_counter() - start
+
+    dangling = sum(
+        relationship["from"] not in truth or relationship["to"] not in truth
+        for relationship in merged_graph["relationships"]
+    )
+    return {
+        "entities": entity_count,
+        "nodes": len(names),
+        "relationships": len(graph["relationships"]),
+        "all_pairs": len(names) * (len(names) - 1) // 2,
+        "match_seconds": round(match_seconds, 3),
+        "merge_seconds": round(merge_seconds, 3),
+        "ambiguous_groups": len(ambiguous_groups),
+        "local_only": score(close_groups(groups), truth),
+        "with_arbitration": score(close_groups(arbitrated), truth),
+        "merged_nodes": len(merged_graph["nodes"]),
+        "merged_relationships": len(merged_graph["relationships"]),
+        "dangling_relationships": dangling,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entities", type=int, nargs="+", default=[1000, 2000, 5000])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    report = [run(entity_count, args.seed) for entity_count in args.entities]
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
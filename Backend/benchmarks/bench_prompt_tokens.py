@@ -0,0 +1,182 @@
+"""Prompt tokens per /query: the JSON layout versus the compact one.
+
+The JSON layout is what process_query used to send: the prompt, the subgraph
+as JSON, the last 10 conversation messages and the question. The compact
+layout is the edge-list text from prompt_utils with image ids and shared
+contexts, and older messages replaced by summaries (a fixed 100 word text
+here, the length the summary prompt asks for).
+
+Queries are replayed from a JSON lines file of recorded /query bodies
+(user_input, conversation_history, use_relevant_context), in order, or
+generated as conversations about a synthetic graph. For consecutive queries
+the tokens in the leading messages that repeat from the previous request
+are the part a provider's prompt cache can reuse.
+
+Tokens are counted with tiktoken when it is installed, otherwise estimated
+at four characters per token.
+
+    python benchmarks/bench_prompt_tokens.py --sessions 5 --turns 12
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import prompt_utils
+from graph_utils import GraphSnapshot
+from search_utils import NodeIndex
+from synthetic import generate_conversation, generate_flowchart_graph
+
+SUMMARY = " ".join(["summary"] * 100)
+# Per-message overhead of the chat format
+MESSAGE_TOKENS = 4
+
+try:
+    import tiktoken
+
+    encoding = tiktoken.get_encoding("o200k_base")
+    TOKEN_COUNTER = "tiktoken o200k_base"
+
+    def count_text_tokens(text):
+        return len(encoding.encode(text))
+
+except ImportError:
+    TOKEN_COUNTER = "estimate, 4 characters per token"
+
+    def count_text_tokens(text):
+        return len(text) // 4
+
+
+def count_tokens(messages):
+    return [
+        MESSAGE_TOKENS + count_text_tokens(message["content"]) for message in messages
+    ]
+
+
+def json_layout(prompt, query, subgraph):
+    return (
+        [
+            {"role": "system", "content": prompt},
+            {
+                "role": "user",
+                "content": "Here is the data for a flowchart: " + json.dumps(subgraph),
+            },
+        ]
+        + query["conversation_history"][-10:]
+        + [{"role": "user", "content": query["user_input"]}]
+    )
+
+
+def compact_layout(prompt, query, subgraph):
+    blocks, recent_history = prompt_utils.split_history(query["conversation_history"])
+    graph_text, _ = prompt_utils.serialize_graph(subgraph)
+    return prompt_utils.get_query_messages(
+        prompt,
+        query["user_input"],
+        [SUMMARY for _ in blocks],
+        recent_history,
+        graph_text,
+        stable_graph=not query["use_relevant_context"],
+    )
+
+
+def cached_prefix_tokens(previous, messages, tokens):
+    cached = 0
+    for i, message in enumerate(messages):
+        if i >= len(previous) or previous[i] != message:
+            break
+        cached += tokens[i]
+    return cached
+
+
+def generate_queries(graph, args):
+    queries = []
+    for session in range(args.sessions):
+        conversation = generate_conversation(graph, args.turns, seed=session)
+        for turn in range(args.turns):
+            queries.append(
+                {
+                    "user_input": conversation[2 * turn]["content"],
+                    "conversation_history": conversation[: 2 * turn],
+                    "use_relevant_context": not args.full_graph,
+                }
+            )
+    return queries
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        "mean": round(statistics.mean(values)),
+        "p95": values[int(len(values) * 0.95) - 1],
+        "max": values[-1],
+    }
+
+
+def run(args):
+    with open(
+        os.path.join(
+            os.path.dirname(__file__), "..", "gpt_instructions", "flowchart_query.md"
+        )
+    ) as file:
+        prompt = file.read()
+    graph = generate_flowchart_graph(args.nodes, args.edges, seed=args.seed)
+    snapshot = GraphSnapshot(graph, 0)
+    index = NodeIndex()
+    index.build(graph["nodes"])
+
+    if args.recorded:
+        with open(args.recorded) as file:
+            queries = [json.loads(line) for line in file if line.strip()]
+    else:
+        queries = generate_queries(graph, args)
+
+    report = {"token_counter": TOKEN_COUNTER, "queries": len(queries)}
+    for name, layout in (("json", json_layout), ("compact", compact_layout)):
+        totals, cached, previous = [], [], []
+        for query in queries:
+            if query.get("use_relevant_context", True):
+                seeds = [name for name, _ in index.search(query["user_input"], 15)]
+                subgraph = snapshot.get_subgraph(seeds, 2, "both", 150, 300)
+            else:
+                subgraph = snapshot.to_graph()
+            messages = layout(prompt, query, subgraph)
+            tokens = count_tokens(messages)
+            totals.append(sum(tokens))
+            cached.append(cached_prefix_tokens(previous, messages, tokens))
+            previous = messages
+        report[name] = {
+            "prompt_tokens": summarize(totals),
+            "cacheable_prefix_tokens": summarize(cached),
+        }
+
+    report["reduction"] = round(
+        1
+        - report["compact"]["prompt_tokens"]["mean"]
+        / report["json"]["prompt_tokens"]["mean"],
+        3,
+    )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recorded", help="JSON lines file of /query bodies")
+    parser.add_argument("--sessions", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=12)
+    parser.add_argument("--nodes", type=int, default=300)
+    parser.add_argument("--edges", type=int, default=600)
+    parser.add_argument("--full-graph", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Time to first token: /query versus the server-sent events of /query/stream.
+
+GPT calls go to benchmarks/stub_llm_server.py, which streams its answer one
+token at a time, and the Neo4j calls are replaced with an in-memory graph.
+The backend is served by uvicorn on a local port so that events reach the
+client as they are sent. For /query the first token is the whole response.
+
+    python benchmarks/bench_query_stream.py --queries 20 --latency-ms 300 --token-latency-ms 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+import uvicorn
+
+import stub_llm_server
+from bench_concurrent_query import free_port, summarize
+from fakes import patch_graph_store
+from bench_subgraph import generate_graph
+
+QUERY = {
+    "user_input": "How does Node 1 reach Node 2?",
+    "conversation_history": [],
+    "use_relevant_context": True,
+}
+
+
+def start_backend(app, port):
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+async def time_query(client):
+    start = time.perf_counter()
+    response = await client.post("/query", json=QUERY)
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+async def time_stream(client):
+    start = time.perf_counter()
+    timings = {}
+    async with client.stream("POST", "/query/stream", json=QUERY) as response:
+        response.raise_for_status()
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: ") :]
+                # The first of each kind of event
+                timings.setdefault(event, time.perf_counter() - start)
+            elif line.startswith("data: ") and event == "error":
+                raise RuntimeError(json.loads(line[len("data: ") :])["detail"])
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+
+async def run(args, port):
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{port}", timeout=None
+    ) as client:
+        # Builds the search index and graph snapshot before measuring
+        await time_query(client)
+
+        query_latencies = [await time_query(client) for _ in range(args.queries)]
+        streams = [await time_stream(client) for _ in range(args.queries)]
+
+    return {
+        "llm_latency_ms": args.latency_ms,
+        "token_latency_ms": args.token_latency_ms,
+        "answer_words": args.answer_words,
+        "query": summarize(query_latencies),
+        "stream_subgraph_event": summarize([s["subgraph"] for s in streams]),
+        "stream_first_token": summarize([s["token"] for s in streams]),
+        "stream_first_image": summarize([s["image"] for s in streams if "image" in s]),
+        "stream_total": summarize([s["total"] for s in streams]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--token-latency-ms", type=float, default=20)
+    parser.add_argument("--answer-words", type=int, default=60)
+    parser.add_argument("--edges", type=int, default=5000)
+    args = parser.parse_args()
+
+    llm_port = free_port()
+    stub_llm_server.start_in_thread(
+        llm_port,
+        args.latency_ms / 1000,
+        token_latency=args.token_latency_ms / 1000,
+        answer_words=args.answer_words,
+    )
+    os.environ.update(
+        {
+            "AZURE_OPENAI_ENDPOINT_URL": f"http://127.0.0.1:{llm_port}",
+            "AZURE_OPENAI_API_KEY": "stub",
+            "AZURE_OPENAI_DEPLOYMENT_NAME": "stub",
+            "AZURE_OPENAI_API_VERSION": "2024-08-01-preview",
+        }
+    )
+    os.environ.setdefault("NEO4J_URI", "bolt://localhost:7687")
+    os.environ.setdefault("NEO4J_USER", "neo4j")
+    os.environ.setdefault("NEO4J_PASSWORD", "")
+    scratch_dir = tempfile.mkdtemp(prefix="bench-")
+    os.environ["JOBS_DIR"] = os.path.join(scratch_dir, "jobs")
+    os.environ["TILE_CACHE_PATH"] = os.path.join(scratch_dir, "tile_cache.sqlite3")
+    # main.py loads its prompt files relative to the working directory
+    os.chdir(BACKEND_DIR)
+
+    import main as backend
+
+    graph = patch_graph_store(backend)
+    asyncio.run(graph.save(generate_graph(args.edges, seed=0)))
+    port = free_port()
+    start_backend(backend.app, port)
+
+    print(json.dumps(asyncio.run(run(args, port)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""Compare the batched UNWIND write path of save_to_neo4j with the old per-row path.
+
+By default both paths run against an in-process fake driver that adds a fixed
+latency to every Cypher round-trip. Pass --neo4j to run against the database
+configured in .env instead (APOC is required, and the database is wiped).
+
+    python benchmarks/bench_save_to_neo4j.py --nodes 2000 --relationships 4000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+os.environ.setdefault("NEO4J_URI", "bolt://localhost:7687")
+os.environ.setdefault("NEO4J_USER", "neo4j")
+os.environ.setdefault("NEO4J_PASSWORD", "")
+
+import neo4j_utils
+
+
+def to_set(items):
+    return list(dict.fromkeys(items))
+
+
+class FakeResult:
+    def __init__(self, written):
+        self.written = written
+
+    def single(self):
+        return {"written": self.written}
+
+
+class FakeTransaction:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def run(self, query, **params):
+        return self.driver.round_trip(params)
+
+
+class FakeSession:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def run(self, query, **params):
+        self.driver.transactions += 1
+        return self.driver.round_trip(params)
+
+    def execute_write(self, transaction_function, *args, **kwargs):
+        self.driver.transactions += 1
+        return transaction_function(FakeTransaction(self.driver), *args, **kwargs)
+
+
+class FakeDriver:
+    """Understands just enough of the save queries to keep a comparable state."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.round_trips = 0
+        self.transactions = 0
+        self.nodes = {}
+        self.relationships = {}
+
+    def session(self):
+        return FakeSession(self)
+
+    def round_trip(self, params):
+        self.round_trips += 1
+        time.sleep(self.latency)
+        if "nodes" in params:
+            return FakeResult(sum(self.merge_node(node) for node in params["nodes"]))
+        if "relationships" in params:
+            return FakeResult(
+                sum(self.merge_relationship(rel) for rel in params["relationships"])
+            )
+        if "from_node" in params:
+            return FakeResult(
+                self.merge_relationship(
+                    {
+                        "name": params["name"],
+                        "from": params["from_node"],
+                        "to": params["to_node"],
+                        "context": params["context"],
+                        "imageSources": params["imageSources"],
+                    }
+                )
+            )
+        return FakeResult(self.merge_node(params))
+
+    def merge_node(self, node):
+        existing = self.nodes.setdefault(
+            node["name"], {"context": [], "imageSources": []}
+        )
+        existing["context"] = to_set(existing["context"] + node["context"])
+        existing["imageSources"] = to_set(
+            existing["imageSources"] + node["imageSources"]
+        )
+        return 1
+
+    def merge_relationship(self, relationship):
+        if (
+            relationship["from"] not in self.nodes
+            or relationship["to"] not in self.nodes
+        ):
+            return 0
+        key = (relationship["from"], relationship["to"], relationship["name"])
+        existing = self.relationships.setdefault(
+            key, {"context": [], "imageSources": []}
+        )
+        existing["context"] = to_set(existing["context"] + relationship["context"])
+        existing["imageSources"] = to_set(
+            existing["imageSources"] + relationship["imageSources"]
+        )
+        return 1
+
+
+def save_to_neo4j_per_row(graph):
+    # The write path save_to_neo4j used before batching: one auto-commit query per row
+    with neo4j_utils.get_driver().session() as session:
+        for node in graph["nodes"]:
+            query = """
+            MERGE (n:Node {collection: $collection, name: $name})
+            ON CREATE SET n.context = $context, n.imageSources = $imageSources
+            ON MATCH SET n.context = apoc.coll.toSet(n.context + $context), n.imageSources = apoc.coll.toSet(n.imageSources + $imageSources)
+            """
+            session.run(
+                query,
+                collection=neo4j_utils.DEFAULT_COLLECTION,
+                name=node["name"],
+                context=node["context"],
+                imageSources=node["imageSources"],
+            )
+
+        for relationship in graph["relationships"]:
+            query = """
+            MATCH (from:Node {collection: $collection, name: $from_node})
+            MATCH (to:Node {collection: $collection, name: $to_node})
+            MERGE (from)-[r:CONNECTED {name: $name}]->(to)
+            ON CREATE SET r.context = $context, r.imageSources = $imageSources
+            ON MATCH SET r.context = apoc.coll.toSet(r.context + $context), r.imageSources = apoc.coll.toSet(r.imageSources + $imageSources)
+            """
+            session.run(
+                query,
+                collection=neo4j_utils.DEFAULT_COLLECTION,
+                name=relationship["name"],
+                from_node=relationship["from"],
+                to_node=relationship["to"],
+                context=relationship["context"],
+                imageSources=relationship["imageSources"],
+            )
+
+
+def generate_graph(node_count, relationship_count, seed=0):
+    rng = random.Random(seed)
+    # Names repeat on purpose so the ON MATCH branch is exercised like overlapping tiles do
+    names = [f"Service {i % max(1, node_count * 3 // 4)}" for i in range(node_count)]
+    nodes = [
+        {
+            "name": name,
+            "context": [f"context {rng.randint(0, 5)}"],
+            "imageSources": [f"image-{rng.randint(0, 3)}.png"],
+        }
+        for name in names
+    ]
+    relationships = [
+        {
+            "name": f"call {rng.randint(0, 9)}",
+            "from": rng.choice(names),
+            "to": rng.choice(names),
+            "context": [],
+            "imageSources": [f"image-{rng.randint(0, 3)}.png"],
+        }
+        for _ in range(relationship_count)
+    ]
+    return {"nodes": nodes, "relationships": relationships}
+
+
+def run(label, save, graph, driver):
+    if isinstance(driver, FakeDriver):
+        neo4j_utils.neo4j_driver = driver
+    else:
+        neo4j_utils.delete_all_from_neo4j()
+
+    start = time.perf_counter()
+    save(graph)
+    elapsed = time.perf_counter() - start
+
+    result = {"path": label, "seconds": round(elapsed, 4)}
+    if isinstance(driver, FakeDriver):
+        result["round_trips"] = driver.round_trips
+        result["transactions"] = driver.transactions
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=1000)
+    parser.add_argument("--relationships", type=int, default=2000)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=1.0,
+        help="Simulated round-trip latency of the fake driver.",
+    )
+    parser.add_argument("--neo4j", action="store_true")
+    args = parser.parse_args()
+
+    graph = generate_graph(args.nodes, args.relationships)
+
+    def make_driver():
+        if args.neo4j:
+            return neo4j_utils.get_driver()
+        return FakeDriver(args.latency_ms / 1000)
+
+    per_row_driver = make_driver()
+    per_row = run("per_row", save_to_neo4j_per_row, graph, per_row_driver)
+
+    batched_driver = make_driver()
+    batched = run(
+        "batched",
+        lambda g: neo4j_utils.save_to_neo4j(g, chunk_size=args.chunk_size),
+        graph,
+        batched_driver,
+    )
+
+    report = {
+        "nodes": args.nodes,
+        "relationships": args.relationships,
+        "chunk_size": args.chunk_size,
+        "results": [per_row, batched],
+        "speedup": round(per_row["seconds"] / max(batched["seconds"], 1e-9), 2),
+    }
+    if not args.neo4j:
+        report["same_state"] = (
+            per_row_driver.nodes == batched_driver.nodes
+            and per_row_driver.relationships == batched_driver.relationships
+        )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""Write path before and after the :Node(collection, name) schema migrations.
+
+Needs a Neo4j with APOC, configured through NEO4J_URI / NEO4J_USER /
+NEO4J_PASSWORD (.env is read). The database is wiped and its schema dropped
+and recreated, so only point it at a scratch instance.
+
+For both states it reports:
+- save_to_neo4j on an empty graph, where every MERGE creates a node
+- saving the same graph again, where every MERGE and MATCH finds a node
+- the plan operator used to find a node by name
+- duplicate nodes left by concurrent writers saving the same names
+
+    python benchmarks/bench_schema.py --nodes 5000 --edges 10000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import neo4j_utils
+
+DROP_SCHEMA_QUERIES = [
+    "DROP CONSTRAINT node_name_unique IF EXISTS",
+    "DROP CONSTRAINT node_collection_name_unique IF EXISTS",
+    "DROP INDEX connected_name IF EXISTS",
+    "MATCH (s:SchemaVersion) DELETE s",
+]
+
+PROFILE_LOOKUP_QUERY = (
+    "PROFILE MATCH (n:Node {collection: $collection, name: $name}) RETURN n"
+)
+
+DUPLICATES_QUERY = """
+MATCH (n:Node)
+WITH n.collection AS collection, n.name AS name, count(*) AS copies
+WHERE copies > 1
+RETURN count(name) as names, sum(copies - 1) as duplicates
+"""
+
+
+def generate_graph(node_count, edge_count, seed):
+    rng = random.Random(seed)
+    names = [f"Component {i}" for i in range(node_count)]
+    return {
+        "nodes": [
+            {"name": name, "context": [f"{name} context"], "imageSources": ["a.png"]}
+            for name in names
+        ],
+        "relationships": [
+            {
+                "from": rng.choice(names),
+                "to": rng.choice(names),
+                "name": rng.choice(("calls", "reads", "writes")),
+                "context": [],
+                "imageSources": ["a.png"],
+            }
+            for _ in range(edge_count)
+        ],
+    }
+
+
+def get_lookup_operators(plan):
+    operators = [plan.get("operatorType", "")]
+    for child in plan.get("children", []):
+        operators += get_lookup_operators(child)
+    return [operator for operator in operators if "Node" in operator]
+
+
+def measure(graph, args):
+    neo4j_utils.delete_all_from_neo4j()
+    start = time.perf_counter()
+    neo4j_utils.save_to_neo4j(graph)
+    create_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    neo4j_utils.save_to_neo4j(graph)
+    merge_seconds = time.perf_counter() - start
+
+    with neo4j_utils.get_driver().session() as session:
+        summary = session.run(
+            PROFILE_LOOKUP_QUERY,
+            collection=neo4j_utils.DEFAULT_COLLECTION,
+            name=graph["nodes"][0]["name"],
+        ).consume()
+        operators = get_lookup_operators(summary.profile)
+
+    # Tile workers saving overlapping graphs at the same time
+    neo4j_utils.delete_all_from_neo4j()
+    shared = {"nodes": graph["nodes"][: args.shared_nodes], "relationships": []}
+    with ThreadPoolExecutor(max_workers=args.writers) as executor:
+        list(
+            executor.map(
+                lambda _: neo4j_utils.save_to_neo4j(shared, chunk_size=50),
+                range(args.writers),
+            )
+        )
+    with neo4j_utils.get_driver().session() as session:
+        duplicates = session.run(DUPLICATES_QUERY).single()
+
+    return {
+        "create_seconds": round(create_seconds, 3),
+        "merge_existing_seconds": round(merge_seconds, 3),
+        "lookup_operators": operators,
+        "duplicate_names_after_concurrent_writes": duplicates["names"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=5000)
+    parser.add_argument("--edges", type=int, default=10000)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--shared-nodes", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    graph = generate_graph(args.nodes, args.edges, args.seed)
+    with neo4j_utils.get_driver().session() as session:
+        for query in DROP_SCHEMA_QUERIES:
+            session.run(query).consume()
+    before = measure(graph, args)
+
+    neo4j_utils.delete_all_from_neo4j()
+    schema_version = neo4j_utils.ensure_schema()
+    # A second run has nothing left to do
+    neo4j_utils.ensure_schema()
+    after = measure(graph, args)
+
+    print(
+        json.dumps(
+            {
+                "nodes": args.nodes,
+                "edges": args.edges,
+                "schema_version": schema_version,
+                "without_schema": before,
+                "with_schema": after,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
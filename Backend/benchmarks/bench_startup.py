@@ -0,0 +1,255 @@
+"""Cold start and memory of the backend's worker processes.
+
+The backend runs under uvicorn with --workers worker processes, the embedded
+SQLite graph store and benchmarks/stub_llm_server.py in place of Azure
+OpenAI. The report has the time it takes to import main.py, the time from
+starting uvicorn until the backend answers /readiness (/healthcheck on trees
+without it), and for every worker process its resident memory and whether it
+has loaded OpenCV: once started, after one upload and after --queries
+queries. --backend-dir runs another checkout, to compare with an earlier
+commit. Linux only, as it reads /proc:
+
+    python benchmarks/bench_startup.py --workers 4
+    python benchmarks/bench_startup.py --workers 4 --backend-dir /tmp/before/Backend
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+import stub_llm_server
+from bench_concurrent_query import free_port
+from synthetic import generate_flowchart_base64
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import main
+print(time.perf_counter() - start)
+print(",".join(sorted(m for m in ("cv2", "numpy", "openai", "neo4j") if m in sys.modules)))
+"""
+
+
+def read_rss(pid):
+    # In MB
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def has_image_stack(pid):
+    with open(f"/proc/{pid}/maps") as file:
+        return any("cv2" in line for line in file)
+
+
+def get_worker_pids(pid):
+    # uvicorn runs the app in the process itself with one worker, in child
+    # processes with more. multiprocessing's resource tracker is left out
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as file:
+                parent = int(file.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{entry}/cmdline") as file:
+                command = file.read()
+        except OSError:
+            continue
+        if parent == pid and "resource_tracker" not in command:
+            children.append(int(entry))
+    return sorted(children) or [pid]
+
+
+def get_workers(pid):
+    workers = []
+    for worker_pid in get_worker_pids(pid):
+        try:
+            workers.append(
+                {
+                    "pid": worker_pid,
+                    "rss_mb": round(read_rss(worker_pid), 1),
+                    "image_stack": has_image_stack(worker_pid),
+                }
+            )
+        except OSError:
+            continue
+    return workers
+
+
+def measure_import(backend_dir, env, repeats):
+    seconds = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT],
+            cwd=backend_dir,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split("\n")
+        seconds.append(float(output[0]))
+    return {
+        "seconds": round(statistics.median(seconds), 3),
+        "modules": output[1].split(",") if output[1] else [],
+    }
+
+
+def wait_until_ready(base_url, timeout=120):
+    path = "/readiness"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = httpx.get(base_url + path)
+            if response.status_code == 404:
+                path = "/healthcheck"
+                continue
+            if response.status_code == 200:
+                return path
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.02)
+    raise RuntimeError("Backend did not become ready.")
+
+
+async def upload(client, image, args):
+    response = await client.post(
+        "/upload",
+        json={
+            "image_base64_array": [image],
+            "image_name_array": ["startup.png"],
+            "rows": args.rows,
+            "cols": args.cols,
+        },
+    )
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    while True:
+        job = (await client.get(f"/jobs/{job_id}")).json()
+        if job["status"] in ("completed", "failed"):
+            break
+        await asyncio.sleep(0.05)
+    if job["status"] == "failed":
+        raise RuntimeError(job["error"])
+
+
+async def send_queries(client, args):
+    async def send(i):
+        response = await client.post(
+            "/query",
+            json={"user_input": f"What does step {i} do?", "conversation_history": []},
+        )
+        response.raise_for_status()
+
+    for start in range(0, args.queries, args.concurrency):
+        end = min(args.queries, start + args.concurrency)
+        await asyncio.gather(*[send(i) for i in range(start, end)])
+
+
+async def load(base_url, image, args):
+    # New connections for every request, so they reach all the workers
+    limits = httpx.Limits(max_keepalive_connections=0)
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=None, limits=limits
+    ) as client:
+        await upload(client, image, args)
+        yield "after_upload"
+        await send_queries(client, args)
+        yield "after_queries"
+
+
+async def run_load(process, base_url, image, args, report):
+    async for stage in load(base_url, image, args):
+        report[stage] = get_workers(process.pid)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--backend-dir", default=BACKEND_DIR)
+    parser.add_argument("--import-repeats", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--settle-seconds", type=float, default=3)
+    parser.add_argument("--width", type=int, default=2000)
+    parser.add_argument("--height", type=int, default=1500)
+    parser.add_argument("--rows", type=int, default=2)
+    parser.add_argument("--cols", type=int, default=2)
+    args = parser.parse_args()
+
+    llm_port = free_port()
+    stub_llm_server.start_in_thread(llm_port, args.latency_ms / 1000)
+    scratch_dir = tempfile.mkdtemp(prefix="bench-")
+    env = dict(
+        os.environ,
+        AZURE_OPENAI_ENDPOINT_URL=f"http://127.0.0.1:{llm_port}",
+        AZURE_OPENAI_API_KEY="stub",
+        AZURE_OPENAI_DEPLOYMENT_NAME="stub",
+        AZURE_OPENAI_API_VERSION="2024-08-01-preview",
+        GRAPH_STORE="sqlite",
+        SQLITE_GRAPH_PATH=os.path.join(scratch_dir, "graph.sqlite3"),
+        JOBS_DIR=os.path.join(scratch_dir, "jobs"),
+        TILE_CACHE_PATH=os.path.join(scratch_dir, "tile_cache.sqlite3"),
+        GRAPH_VERSIONS_PATH=os.path.join(scratch_dir, "graph_versions.sqlite3"),
+        WEB_CONCURRENCY=str(args.workers),
+    )
+    backend_dir = os.path.abspath(args.backend_dir)
+    report = {
+        "config": vars(args),
+        "import": measure_import(backend_dir, env, args.import_repeats),
+    }
+    image = generate_flowchart_base64(args.width, args.height, boxes=30)
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--port",
+            str(port),
+            "--workers",
+            str(args.workers),
+            "--log-level",
+            "warning",
+        ],
+        cwd=backend_dir,
+        env=env,
+    )
+    try:
+        report["ready_path"] = wait_until_ready(base_url)
+        report["ready_seconds"] = round(time.perf_counter() - start, 3)
+        # Every worker has started by then
+        time.sleep(args.settle_seconds)
+        report["started"] = get_workers(process.pid)
+        asyncio.run(run_load(process, base_url, image, args, report))
+    finally:
+        process.terminate()
+        process.wait()
+
+    for stage in ("started", "after_upload", "after_queries"):
+        workers = report.get(stage) or []
+        report[f"{stage}_total_rss_mb"] = round(sum(w["rss_mb"] for w in workers), 1)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
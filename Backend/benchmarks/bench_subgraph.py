@@ -0,0 +1,158 @@
+"""Query-context subgraphs: BFS over the graph snapshot versus a relationship scan.
+
+get_subgraph_from_neo4j filters every relationship with
+`n.name IN $nodes OR m.name IN $nodes`. Without a database the scan is
+replayed in Python, which is a lower bound for the Cypher round-trip. With
+--neo4j the synthetic graph is written to the configured Neo4j (which is
+wiped first, so only point it at a scratch database) and the real query is
+timed as well.
+
+    python benchmarks/bench_subgraph.py --edges 10000 50000 100000
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from graph_utils import GraphSnapshot
+
+
+def generate_graph(edge_count, seed):
+    # Preferential attachment, so a few hub nodes have many edges as in real
+    # architecture diagrams
+    rng = random.Random(seed)
+    node_count = max(2, edge_count // 3)
+    names = [f"Node {i}" for i in range(node_count)]
+    targets = [0, 1]
+    relationships = set()
+    while len(relationships) < edge_count:
+        source = rng.randrange(node_count)
+        target = (
+            rng.choice(targets) if rng.random() < 0.5 else rng.randrange(node_count)
+        )
+        if source != target:
+            relationships.add((source, target))
+            targets.append(target)
+    return {
+        "nodes": [
+            {"name": name, "context": [f"{name} context"], "imageSources": ["a.png"]}
+            for name in names
+        ],
+        "relationships": [
+            {
+                "from": names[source],
+                "to": names[target],
+                "name": "calls",
+                "context": [],
+                "imageSources": ["a.png"],
+            }
+            for source, target in relationships
+        ],
+    }
+
+
+def scan_subgraph(graph, names):
+    names = set(names)
+    return [
+        relationship
+        for relationship in graph["relationships"]
+        if relationship["from"] in names or relationship["to"] in names
+    ]
+
+
+def edge_keys(relationships):
+    return {
+        (relationship["from"], relationship["to"], relationship["name"])
+        for relationship in relationships
+    }
+
+
+def time_calls(function, seed_sets):
+    timings = []
+    for seeds in seed_sets:
+        start = time.perf_counter()
+        result = function(seeds)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return result, {
+        "mean_ms": round(statistics.mean(timings) * 1000, 3),
+        "p95_ms": round(timings[int(len(timings) * 0.95) - 1] * 1000, 3),
+    }
+
+
+def run(edge_count, args):
+    graph = generate_graph(edge_count, args.seed)
+    rng = random.Random(args.seed)
+    seed_sets = [
+        [node["name"] for node in rng.sample(graph["nodes"], args.seeds)]
+        for _ in range(args.queries)
+    ]
+
+    start = time.perf_counter()
+    snapshot = GraphSnapshot(graph, 0)
+    build_seconds = time.perf_counter() - start
+
+    report = {
+        "nodes": len(graph["nodes"]),
+        "edges": edge_count,
+        "snapshot_build_seconds": round(build_seconds, 3),
+        "scan": time_calls(lambda seeds: scan_subgraph(graph, seeds), seed_sets)[1],
+        "bfs": {},
+    }
+    for hops in args.hops:
+        _, timings = time_calls(
+            lambda seeds: snapshot.get_subgraph(
+                seeds, hops, "both", args.max_nodes, args.max_edges
+            ),
+            seed_sets,
+        )
+        report["bfs"][f"{hops}_hops"] = timings
+
+    # One unlimited hop in both directions is exactly what the Cypher returns
+    same = all(
+        edge_keys(snapshot.get_subgraph(seeds, 1)["relationships"])
+        == edge_keys(scan_subgraph(graph, seeds))
+        for seeds in seed_sets[:20]
+    )
+    report["one_hop_matches_scan"] = same
+
+    if args.neo4j:
+        import neo4j_utils
+
+        neo4j_utils.delete_all_from_neo4j()
+        neo4j_utils.save_to_neo4j(graph)
+        report["neo4j"] = time_calls(
+            neo4j_utils.get_subgraph_from_neo4j, seed_sets[: args.neo4j_queries]
+        )[1]
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--edges", type=int, nargs="+", default=[10000, 50000, 100000])
+    parser.add_argument("--hops", type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument("--seeds", type=int, default=15)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--max-nodes", type=int, default=150)
+    parser.add_argument("--max-edges", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--neo4j", action="store_true")
+    parser.add_argument("--neo4j-queries", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.neo4j:
+        from dotenv import load_dotenv
+
+        load_dotenv()
+
+    print(json.dumps([run(edge_count, args) for edge_count in args.edges], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""Compare the old tiling path with image_utils.iter_encoded_tiles.
+
+The old path painted one cv2.rectangle per contour into a full-size mask,
+dilated it and then JPEG-encoded every tile one after the other at full
+resolution. Both paths run on the same synthetic high-resolution flowcharts.
+
+    python benchmarks/bench_tiling.py --width 8000 --height 6000 --rows 4 --cols 4
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import cv2
+import numpy as np
+
+import image_utils
+from synthetic import generate_flowchart_base64
+
+
+def legacy_tiles(image_base64, rows, cols, overlap):
+    image_data = base64.b64decode(image_base64)
+    image = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    binary = cv2.adaptiveThreshold(
+        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 11, 2
+    )
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    mask = np.zeros_like(gray)
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        cv2.rectangle(mask, (x, y), (x + w, y + h), 255, -1)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (overlap, overlap))
+    dilated = cv2.dilate(mask, kernel, iterations=1)
+
+    h, w = image.shape[:2]
+    step_h = h // rows
+    step_w = w // cols
+    for r in range(rows):
+        for c in range(cols):
+            y1 = max(r * step_h - overlap, 0)
+            y2 = min((r + 1) * step_h + overlap, h)
+            x1 = max(c * step_w - overlap, 0)
+            x2 = min((c + 1) * step_w + overlap, w)
+            if np.any(dilated[y1:y2, x1:x2]):
+                y1 = max(0, y1 - overlap)
+                y2 = min(h, y2 + overlap)
+                x1 = max(0, x1 - overlap)
+                x2 = min(w, x2 + overlap)
+            _, buffer = cv2.imencode(".jpg", image[y1:y2, x1:x2])
+            yield base64.b64encode(buffer).decode("utf-8"), (x1, y1, x2, y2)
+
+
+def measure(tiles):
+    start = time.perf_counter()
+    first_tile = None
+    coordinates = []
+    encoded_bytes = 0
+    for encoded, coords in tiles:
+        if first_tile is None:
+            first_tile = time.perf_counter() - start
+        coordinates.append(tuple(int(value) for value in coords))
+        encoded_bytes += len(encoded)
+    return {
+        "seconds": round(time.perf_counter() - start, 4),
+        "first_tile_seconds": round(first_tile, 4),
+        "encoded_bytes": encoded_bytes,
+    }, coordinates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--width", type=int, default=8000)
+    parser.add_argument("--height", type=int, default=6000)
+    parser.add_argument("--boxes", type=int, default=150)
+    parser.add_argument("--images", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=4)
+    parser.add_argument("--cols", type=int, default=4)
+    parser.add_argument("--overlap", type=int, default=50)
+    args = parser.parse_args()
+
+    report = {
+        "width": args.width,
+        "height": args.height,
+        "tiles_per_image": args.rows * args.cols,
+        "jpeg_quality": image_utils.TILE_JPEG_QUALITY,
+        "max_dimension": image_utils.TILE_MAX_DIMENSION,
+        "encode_workers": image_utils.TILE_ENCODE_WORKERS,
+        "images": [],
+    }
+    for seed in range(args.images):
+        image = generate_flowchart_base64(args.width, args.height, args.boxes, seed)
+        legacy, legacy_coordinates = measure(
+            legacy_tiles(image, args.rows, args.cols, args.overlap)
+        )
+        current, current_coordinates = measure(
+            image_utils.iter_encoded_tiles(image, args.rows, args.cols, args.overlap)
+        )
+        report["images"].append(
+            {
+                "legacy": legacy,
+                "current": current,
+                "speedup": round(legacy["seconds"] / current["seconds"], 2),
+                "same_tiles": legacy_coordinates == current_coordinates,
+                "tiles_per_mode": image_utils.count_tiles_base64(
+                    image, args.rows, args.cols, args.overlap
+                ),
+            }
+        )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
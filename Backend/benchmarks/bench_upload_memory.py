@@ -0,0 +1,229 @@
+"""Peak backend memory of an upload, JSON with base64 images vs multipart files.
+
+The backend runs under uvicorn in a child process, with the in-memory graph
+from benchmarks/fakes.py and FakeLLM, so only parsing the request, storing
+the job and tiling the images use memory. For each path a fresh child gets
+--images synthetic flowcharts of --width x --height pixels, with --noise
+added so they compress like scans, in one request. The report has its peak
+resident memory (VmHWM) during the upload over the resident memory before
+it, the bytes sent and the time until the job finished. Linux only, as it
+reads /proc:
+
+    python benchmarks/bench_upload_memory.py --images 8 --width 6000 --height 4500
+"""
+
+import argparse
+import base64
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(__file__))
+
+import cv2
+import httpx
+import numpy as np
+
+from bench_concurrent_query import free_port
+from synthetic import generate_flowchart_image
+
+PATHS = ("json", "multipart")
+
+
+def read_memory(pid):
+    # In kB, as /proc reports it
+    memory = {}
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM"):
+                memory[key] = int(value.split()[0])
+    return memory
+
+
+def reset_peak_memory(pid):
+    # Writing 5 sets VmHWM back to the current VmRSS
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def serve(port):
+    import uvicorn
+
+    import main
+    from fakes import FakeLLM, patch_graph_store, patch_llm
+
+    patch_graph_store(main)
+    patch_llm(main, FakeLLM(0.01, 0, 20))
+    uvicorn.run(main.app, port=port, log_level="warning")
+
+
+def start_server(port, scratch_dir):
+    env = dict(
+        os.environ,
+        AZURE_OPENAI_ENDPOINT_URL="http://127.0.0.1:9",
+        AZURE_OPENAI_API_KEY="stub",
+        AZURE_OPENAI_DEPLOYMENT_NAME="stub",
+        AZURE_OPENAI_API_VERSION="2024-08-01-preview",
+        JOBS_DIR=os.path.join(scratch_dir, "jobs"),
+        TILE_CACHE_PATH=os.path.join(scratch_dir, "tile_cache.sqlite3"),
+    )
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", str(port)],
+        cwd=BACKEND_DIR,
+        env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(300):
+        try:
+            httpx.get(base_url + "/metrics").raise_for_status()
+            return process, base_url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Backend did not start.")
+
+
+def wait_for_job(client, job_id):
+    while True:
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] in ("completed", "failed"):
+            if job["status"] == "failed":
+                raise RuntimeError(job["error"])
+            return
+        time.sleep(0.05)
+
+
+def send_json(client, paths, args):
+    # Encoded the way the frontend does, the base64 text is part of the body
+    images = []
+    for path in paths:
+        with open(path, "rb") as file:
+            images.append(file.read())
+    body = json.dumps(
+        {
+            "image_base64_array": [
+                base64.b64encode(image).decode() for image in images
+            ],
+            "image_name_array": [os.path.basename(path) for path in paths],
+            "rows": args.rows,
+            "cols": args.cols,
+        }
+    ).encode()
+    return client.post(
+        "/upload", content=body, headers={"Content-Type": "application/json"}
+    ), len(body)
+
+
+def send_multipart(client, paths, args):
+    files = [("images", (os.path.basename(path), open(path, "rb"))) for path in paths]
+    try:
+        request = client.build_request(
+            "POST",
+            "/upload/files",
+            files=files,
+            data={
+                "image_names": [os.path.basename(path) for path in paths],
+                "rows": str(args.rows),
+                "cols": str(args.cols),
+            },
+        )
+        size = int(request.headers["Content-Length"])
+        return client.send(request), size
+    finally:
+        for _, (_, file) in files:
+            file.close()
+
+
+def measure(upload_path, image_paths, args, scratch_dir):
+    process, base_url = start_server(
+        free_port(), os.path.join(scratch_dir, upload_path)
+    )
+    try:
+        with httpx.Client(base_url=base_url, timeout=None) as client:
+            before = read_memory(process.pid)
+            peak_reset = reset_peak_memory(process.pid)
+            start = time.perf_counter()
+            send = send_json if upload_path == "json" else send_multipart
+            response, request_bytes = send(client, image_paths, args)
+            response.raise_for_status()
+            wait_for_job(client, response.json()["job_id"])
+            elapsed = time.perf_counter() - start
+            after = read_memory(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+
+    # Without clear_refs the peak can be from before the upload, so only the
+    # growth since then is reported
+    peak = after["VmHWM"] if peak_reset else max(after["VmHWM"], before["VmRSS"])
+    return {
+        "request_mb": round(request_bytes / 2**20, 1),
+        "rss_before_mb": round(before["VmRSS"] / 1024, 1),
+        "peak_rss_mb": round(peak / 1024, 1),
+        "peak_growth_mb": round((peak - before["VmRSS"]) / 1024, 1),
+        "rss_after_mb": round(after["VmRSS"] / 1024, 1),
+        "seconds": round(elapsed, 2),
+        "peak_reset": peak_reset,
+    }
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == "--serve":
+        serve(int(sys.argv[2]))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--paths", default=",".join(PATHS), help="comma separated")
+    parser.add_argument("--images", type=int, default=8)
+    parser.add_argument("--width", type=int, default=6000)
+    parser.add_argument("--height", type=int, default=4500)
+    parser.add_argument("--boxes", type=int, default=120)
+    parser.add_argument("--rows", type=int, default=2)
+    parser.add_argument("--cols", type=int, default=2)
+    parser.add_argument(
+        "--noise", type=float, default=8, help="pixel noise, as in a scan or photo"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    scratch_dir = tempfile.mkdtemp(prefix="bench-")
+    image_paths = []
+    for i in range(args.images):
+        image = generate_flowchart_image(
+            args.width, args.height, args.boxes, seed=args.seed + i
+        )
+        rng = np.random.default_rng(args.seed + i)
+        noise = rng.normal(0, args.noise, image.shape)
+        image = np.clip(image + noise, 0, 255).astype(np.uint8)
+        path = os.path.join(scratch_dir, f"flowchart-{i}.png")
+        cv2.imwrite(path, image)
+        image_paths.append(path)
+    image_mb = sum(os.path.getsize(path) for path in image_paths) / 2**20
+    # One decoded image, which the tiling holds at a time
+    decoded_mb = args.width * args.height * 3 / 2**20
+
+    report = {
+        "images": args.images,
+        "image_files_mb": round(image_mb, 1),
+        "decoded_image_mb": round(decoded_mb, 1),
+        "paths": {},
+    }
+    for upload_path in args.paths.split(","):
+        report["paths"][upload_path] = measure(
+            upload_path, image_paths, args, scratch_dir
+        )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
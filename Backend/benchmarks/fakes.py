@@ -0,0 +1,256 @@
+"""In-process stand-ins for Neo4j and Azure OpenAI shared by the benchmarks.
+
+InMemoryGraph is a graph store kept in dicts, FakeLLM replaces the
+GPT calls, answering with the canned payloads of stub_llm_server after a
+fixed delay. Unlike the stub server FakeLLM skips the HTTP client and the
+dispatcher, so only the backend's own work is measured.
+"""
+
+import asyncio
+
+import storage_utils
+import stub_llm_server
+from storage_utils import DEFAULT_COLLECTION
+
+
+class InMemoryGraph(storage_utils.GraphStore):
+    # The part of the graph store main.py uses, with nothing but dict lookups
+    # behind it, so the benchmarks measure the backend itself. Each collection
+    # has its own nodes by name and relationships by (from, to, name)
+    name = "memory"
+
+    def __init__(self):
+        self.collections = {}
+
+    def _graph(self, collection):
+        return self.collections.setdefault(collection, ({}, {}))
+
+    async def get_collections(self):
+        return [
+            {"collection": collection, "nodes": len(nodes)}
+            for collection, (nodes, _) in sorted(self.collections.items())
+            if nodes
+        ]
+
+    async def get_all_nodes(self, collection=DEFAULT_COLLECTION):
+        nodes, _ = self._graph(collection)
+        return [
+            {"name": name, "context": node["context"]} for name, node in nodes.items()
+        ]
+
+    async def get_fullgraph(self, collection=DEFAULT_COLLECTION):
+        nodes, relationships = self._graph(collection)
+        return {
+            "nodes": [{"name": name, **node} for name, node in nodes.items()],
+            "relationships": [
+                {"from": key[0], "to": key[1], "name": key[2], **rel}
+                for key, rel in relationships.items()
+            ],
+        }
+
+    async def save(self, graph, collection=DEFAULT_COLLECTION):
+        nodes, relationships = self._graph(collection)
+        for node in graph["nodes"]:
+            existing = nodes.setdefault(
+                node["name"], {"context": [], "imageSources": []}
+            )
+            for key in ("context", "imageSources"):
+                existing[key] = list(dict.fromkeys(existing[key] + node[key]))
+        for rel in graph["relationships"]:
+            # Skipped without both nodes, as the stores do
+            if rel["from"] not in nodes or rel["to"] not in nodes:
+                continue
+            key = (rel["from"], rel["to"], rel["name"])
+            existing = relationships.setdefault(
+                key, {"context": [], "imageSources": []}
+            )
+            for field in ("context", "imageSources"):
+                existing[field] = list(dict.fromkeys(existing[field] + rel[field]))
+        storage_utils.notify_graph_change(
+            storage_utils.get_save_change(graph, collection)
+        )
+        return {
+            "nodes": len(graph["nodes"]),
+            "relationships": len(graph["relationships"]),
+            "transactions": 1,
+        }
+
+    async def ensure_schema(self):
+        return 0
+
+    async def get_neighbourhood(self, nodes, collection=DEFAULT_COLLECTION):
+        graph = await self.get_fullgraph(collection)
+        nodes = set(nodes)
+        relationships = [
+            rel
+            for rel in graph["relationships"]
+            if rel["from"] in nodes or rel["to"] in nodes
+        ]
+        names = nodes.union(*[(rel["from"], rel["to"]) for rel in relationships])
+        return {
+            "nodes": [node for node in graph["nodes"] if node["name"] in names],
+            "relationships": relationships,
+        }
+
+    async def get_nodes_page(self, after, limit, collection=DEFAULT_COLLECTION):
+        nodes, _ = self._graph(collection)
+        names = sorted(name for name in nodes if name > after)[:limit]
+        return [{"name": name, **nodes[name]} for name in names]
+
+    async def get_relationships_page(self, after, limit, collection=DEFAULT_COLLECTION):
+        _, relationships = self._graph(collection)
+        keys = sorted(key for key in relationships if key > tuple(after))[:limit]
+        return [
+            {"from": key[0], "to": key[1], "name": key[2], **relationships[key]}
+            for key in keys
+        ]
+
+    async def apply_diff(self, diff, collection=DEFAULT_COLLECTION):
+        nodes, relationships = self._graph(collection)
+        for node in diff["upserted_nodes"]:
+            nodes[node["name"]] = {
+                "context": node["context"],
+                "imageSources": node["imageSources"],
+            }
+        for rel in diff["deleted_relationships"]:
+            relationships.pop((rel["from"], rel["to"], rel["name"]), None)
+        for rel in diff["upserted_relationships"]:
+            if rel["from"] not in nodes or rel["to"] not in nodes:
+                continue
+            relationships[(rel["from"], rel["to"], rel["name"])] = {
+                "context": rel["context"],
+                "imageSources": rel["imageSources"],
+            }
+        for name in diff["deleted_nodes"]:
+            nodes.pop(name, None)
+            for key in [key for key in relationships if name in key[:2]]:
+                del relationships[key]
+        storage_utils.notify_graph_change(
+            storage_utils.get_diff_change(diff, collection)
+        )
+
+    async def get_subgraph(self, nodes, collection=DEFAULT_COLLECTION):
+        stored_nodes, relationships = self._graph(collection)
+        subgraph = {"nodes": [], "relationships": []}
+        nodes_set = set()
+        for (source, target, name), rel in relationships.items():
+            if source in nodes or target in nodes:
+                storage_utils.add_record_to_subgraph(
+                    subgraph,
+                    nodes_set,
+                    {
+                        "from": source,
+                        "to": target,
+                        "name": name,
+                        "relationship_context": rel["context"],
+                        "relationship_imageSources": rel["imageSources"],
+                        "from_context": stored_nodes[source]["context"],
+                        "from_imageSources": stored_nodes[source]["imageSources"],
+                        "to_context": stored_nodes[target]["context"],
+                        "to_imageSources": stored_nodes[target]["imageSources"],
+                    },
+                )
+        return subgraph
+
+    async def delete_all(self, collection=None):
+        if collection is None:
+            self.collections.clear()
+        else:
+            self.collections.pop(collection, None)
+        storage_utils.notify_graph_change({"cleared": True, "collection": collection})
+
+    async def edit_graph(
+        self, editedNodes, deletedEdges, addedEdges, collection=DEFAULT_COLLECTION
+    ):
+        # Same order and results as the real stores
+        nodes, relationships = self._graph(collection)
+        for node in editedNodes:
+            if node["oldName"] and node["newName"] in nodes:
+                raise ValueError(f"Node {node['newName']} already exists.")
+        changes = storage_utils.get_empty_edit_changes()
+        for edge in deletedEdges:
+            if relationships.pop((edge["from"], edge["to"], edge["label"]), None):
+                changes["deleted_relationships"].append(
+                    {"from": edge["from"], "to": edge["to"], "name": edge["label"]}
+                )
+        for edge in addedEdges:
+            if edge["from"] not in nodes or edge["to"] not in nodes:
+                continue
+            rel = relationships.setdefault(
+                (edge["from"], edge["to"], edge["label"]),
+                {"context": [], "imageSources": ["User Edited"]},
+            )
+            changes["upserted_relationships"].append(
+                {"from": edge["from"], "to": edge["to"], "name": edge["label"], **rel}
+            )
+        for node in editedNodes:
+            old_name, new_name = node["oldName"], node["newName"]
+            if old_name == "":
+                existing = nodes.setdefault(
+                    new_name, {"context": [], "imageSources": ["User Edited"]}
+                )
+                changes["upserted_nodes"].append({"name": new_name, **existing})
+            elif old_name not in nodes:
+                continue
+            elif new_name == "":
+                nodes.pop(old_name)
+                for key in [key for key in relationships if old_name in key[:2]]:
+                    del relationships[key]
+                changes["deleted_nodes"].append(old_name)
+            else:
+                nodes[new_name] = nodes.pop(old_name)
+                for key in [key for key in relationships if old_name in key[:2]]:
+                    new_key = tuple(
+                        new_name if name == old_name else name for name in key[:2]
+                    ) + (key[2],)
+                    relationships[new_key] = relationships.pop(key)
+                changes["renamed_nodes"].append([old_name, new_name])
+        storage_utils.notify_graph_change(
+            storage_utils.get_edit_graph_change(changes, collection)
+        )
+        return {
+            "version": storage_utils.get_graph_cache(collection).version,
+            "changes": changes,
+        }
+
+
+def patch_graph_store(main):
+    main.graph_store = InMemoryGraph()
+    return main.graph_store
+
+
+class FakeLLM:
+    # Deterministic: the same messages always get the same answer
+    def __init__(self, latency=0.3, token_latency=0.0, answer_words=0):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.answer_words = answer_words
+        self.calls = 0
+
+    async def get_gpt_response_async(self, messages, caller="default"):
+        self.calls += 1
+        content = stub_llm_server.canned_response(messages, self.answer_words)
+        await asyncio.sleep(
+            self.latency + self.token_latency * ((len(content) - 1) // 4)
+        )
+        return content
+
+    async def stream_gpt_response_async(self, messages, caller="default"):
+        self.calls += 1
+        content = stub_llm_server.canned_response(messages, self.answer_words)
+        await asyncio.sleep(self.latency)
+        # Four characters per token, as the stub server streams them
+        for i in range(0, len(content), 4):
+            if i:
+                await asyncio.sleep(self.token_latency)
+            yield content[i : i + 4]
+
+
+def patch_llm(main, llm):
+    import gpt_utils
+
+    main.get_gpt_response_async = llm.get_gpt_response_async
+    main.stream_gpt_response_async = llm.stream_gpt_response_async
+    # Re-ranking calls GPT from inside gpt_utils
+    gpt_utils.get_gpt_response_async = llm.get_gpt_response_async
+    return llm
@@ -0,0 +1,254 @@
+"""A local stand-in for the Azure OpenAI chat completions API.
+
+It answers every call the backend makes with canned but well-formed payloads
+after a configurable delay, so the request path can be exercised without a
+real deployment. A share of the calls can be answered with 429 and a
+Retry-After header, like a deployment over its quota. With
+--token-latency-ms every token after the first takes that long to generate,
+so streamed calls get their first token after the delay and the rest one by
+one, while other calls wait for the whole answer:
+
+    python benchmarks/stub_llm_server.py --port 8100 --latency-ms 500 --rate-limit-ratio 0.2
+
+and point AZURE_OPENAI_ENDPOINT_URL at http://127.0.0.1:8100.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+FLOWCHART_DATA_HEADER = "Flowchart data:"
+IMAGE_ID_PATTERN = re.compile(r"^(I\d+) = ", re.MULTILINE)
+
+
+def _text_content(message):
+    content = message.get("content")
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content)
+    return content or ""
+
+
+def _has_image(messages):
+    return any(
+        isinstance(message.get("content"), list)
+        and any(part.get("type") == "image_url" for part in message["content"])
+        for message in messages
+    )
+
+
+def tile_graph(seed_text, node_count=4):
+    digest = hashlib.sha1(seed_text.encode()).hexdigest()
+    names = [f"Module {digest[i]}{i}" for i in range(node_count)]
+    return {
+        "nodes": [{"name": name, "context": f"{name} context"} for name in names],
+        "relationships": [
+            {"name": "calls", "from": names[i], "to": names[i + 1], "context": ""}
+            for i in range(node_count - 1)
+        ],
+    }
+
+
+def query_answer(messages, answer_words):
+    # Cites a few of the images in the flowchart data by id, like a real answer
+    image_sources = []
+    for message in messages:
+        content = _text_content(message)
+        if message.get("role") == "user" and content.startswith(FLOWCHART_DATA_HEADER):
+            image_sources += IMAGE_ID_PATTERN.findall(content)
+    text = " ".join(["Stub answer."] + [f"word{i}" for i in range(answer_words)])
+    return json.dumps(
+        {"text": text, "imageSources": list(dict.fromkeys(image_sources))[:3]}
+    )
+
+
+def canned_response(messages, answer_words=0):
+    system = _text_content(messages[0]) if messages else ""
+    if _has_image(messages):
+        return json.dumps(tile_graph(_text_content(messages[-1])))
+    if system.startswith("Analyze the user query"):
+        return "[]"
+    if system.startswith("Decide which of the provided flowchart nodes"):
+        # Keeping every ambiguous group apart is a valid arbitration result
+        return "[]"
+    if system.startswith("Summarize the provided part of a conversation"):
+        return "The user asked about the flowchart and got stub answers."
+    return query_answer(messages, answer_words)
+
+
+def count_tokens(messages):
+    return sum(len(_text_content(message)) for message in messages) // 4
+
+
+def completion_payload(model, content, prompt_tokens=0):
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": prompt_tokens + len(content) // 4,
+        },
+    }
+
+
+def chunk_payload(model, content=None, usage=None):
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": (
+            []
+            if content is None
+            else [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+        ),
+        "usage": usage,
+    }
+
+
+async def stream_completion(model, content, prompt_tokens, token_latency, usage):
+    # Four characters per token, one server-sent event per token
+    for i in range(0, len(content), 4):
+        if i:
+            await asyncio.sleep(token_latency)
+        yield f"data: {json.dumps(chunk_payload(model, content[i : i + 4]))}\n\n"
+    if usage:
+        usage = completion_payload(model, content, prompt_tokens)["usage"]
+        yield f"data: {json.dumps(chunk_payload(model, usage=usage))}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def create_app(
+    latency=0.5,
+    rate_limit_ratio=0.0,
+    retry_after=1.0,
+    jitter=0.0,
+    seed=0,
+    token_latency=0.0,
+    answer_words=0,
+):
+    app = FastAPI()
+    app.state.latency = latency
+    app.state.token_latency = token_latency
+    app.state.rate_limit_ratio = rate_limit_ratio
+    app.state.retry_after = retry_after
+    # Answers the next this many calls with 429, whatever rate_limit_ratio says
+    app.state.rate_limit_next = 0
+    app.state.calls = 0
+    app.state.rate_limited = 0
+    # Calls being answered right now and the most there have been at once
+    app.state.in_flight = 0
+    app.state.max_in_flight = 0
+    rng = random.Random(seed)
+
+    @app.post("/openai/deployments/{deployment}/chat/completions")
+    async def chat_completions(deployment: str, request: Request):
+        body = await request.json()
+        app.state.calls += 1
+        if app.state.rate_limit_next or rng.random() < app.state.rate_limit_ratio:
+            app.state.rate_limit_next = max(0, app.state.rate_limit_next - 1)
+            app.state.rate_limited += 1
+            return JSONResponse(
+                {
+                    "error": {
+                        "code": "429",
+                        "message": "Requests to the deployment have exceeded the rate limit.",
+                    }
+                },
+                status_code=429,
+                headers={"retry-after": str(app.state.retry_after)},
+            )
+        app.state.in_flight += 1
+        app.state.max_in_flight = max(app.state.max_in_flight, app.state.in_flight)
+        streaming = False
+        try:
+            await asyncio.sleep(app.state.latency + rng.uniform(0, jitter))
+            content = canned_response(body["messages"], answer_words)
+            if body.get("stream"):
+                streaming = True
+                return StreamingResponse(
+                    finish_in_flight(
+                        stream_completion(
+                            deployment,
+                            content,
+                            count_tokens(body["messages"]),
+                            app.state.token_latency,
+                            (body.get("stream_options") or {}).get("include_usage"),
+                        )
+                    ),
+                    media_type="text/event-stream",
+                )
+            await asyncio.sleep(app.state.token_latency * ((len(content) - 1) // 4))
+            return completion_payload(
+                deployment, content, count_tokens(body["messages"])
+            )
+        finally:
+            if not streaming:
+                app.state.in_flight -= 1
+
+    async def finish_in_flight(events):
+        # A streamed call is in flight until its last event is sent
+        try:
+            async for event in events:
+                yield event
+        finally:
+            app.state.in_flight -= 1
+
+    return app
+
+
+def start_in_thread(port, latency=0.5, **options):
+    """Serve the stub from a daemon thread and return once it accepts requests."""
+    app = create_app(latency, **options)
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub Azure OpenAI server.")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=float, default=500)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--token-latency-ms", type=float, default=0)
+    parser.add_argument("--answer-words", type=int, default=0)
+    args = parser.parse_args()
+
+    app = create_app(
+        args.latency_ms / 1000,
+        rate_limit_ratio=args.rate_limit_ratio,
+        retry_after=args.retry_after,
+        jitter=args.jitter_ms / 1000,
+        token_latency=args.token_latency_ms / 1000,
+        answer_words=args.answer_words,
+    )
+    uvicorn.run(app, host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Synthetic inputs shared by the benchmarks."""
+
+import base64
+import json
+import random
+
+import cv2
+import numpy as np
+
+
+def generate_flowchart_image(width=4000, height=3000, boxes=60, seed=0):
+    """Draw a flowchart-like image of labelled boxes joined by arrows."""
+    rng = random.Random(seed)
+    image = np.full((height, width, 3), 255, dtype=np.uint8)
+
+    centers = []
+    for i in range(boxes):
+        box_w = rng.randint(width // 20, width // 10)
+        box_h = rng.randint(height // 30, height // 15)
+        x = rng.randint(0, width - box_w - 1)
+        y = rng.randint(0, height - box_h - 1)
+        cv2.rectangle(image, (x, y), (x + box_w, y + box_h), (0, 0, 0), 3)
+        cv2.putText(
+            image,
+            f"Module {i}",
+            (x + 10, y + box_h // 2),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            1.0,
+            (0, 0, 0),
+            2,
+        )
+        centers.append((x + box_w // 2, y + box_h // 2))
+
+    for start, end in zip(centers, centers[1:]):
+        cv2.arrowedLine(image, start, end, (0, 0, 0), 2, tipLength=0.02)
+
+    return image
+
+
+def generate_flowchart_base64(width=4000, height=3000, boxes=60, seed=0):
+    image = generate_flowchart_image(width, height, boxes, seed)
+    _, buffer = cv2.imencode(".png", image)
+    return base64.b64encode(buffer).decode("utf-8")
+
+
+SYSTEMS = (
+    "Auth Service, User DB, API Gateway, Order Service, Payment Service, "
+    "Inventory Service, Notification Service, Billing Job, Report Worker, "
+    "Search Index, Session Cache, Audit Log, Checkout Page, Admin Dashboard, "
+    "Shipping Service, Pricing Engine, Event Bus, File Store, Email Sender, "
+    "Fraud Check"
+).split(", ")
+ACTIONS = ("calls", "reads from", "writes to", "publishes to", "validates")
+CONTEXTS = (
+    "Validates the session token before forwarding the request",
+    "Retries failed calls three times with exponential backoff",
+    "Runs nightly and writes a summary to the reporting schema",
+    "Owned by the platform team and deployed in every region",
+    "Stores personally identifiable data, encrypted at rest",
+    "Emits an audit event for every state change",
+)
+
+
+def generate_flowchart_graph(node_count=300, edge_count=600, images=12, seed=0):
+    """A graph as the upload produces it: named components, shared boilerplate
+    contexts and hashed image names on every node and edge."""
+    rng = random.Random(seed)
+    image_names = [f"diagram-{i}.png_{rng.getrandbits(32):08x}" for i in range(images)]
+    names = [
+        f"{rng.choice(SYSTEMS)} {i}" if i >= len(SYSTEMS) else SYSTEMS[i]
+        for i in range(node_count)
+    ]
+
+    def context(name):
+        return [f"{name} handles part of the request flow"] + rng.sample(
+            CONTEXTS, rng.randint(0, 2)
+        )
+
+    return {
+        "nodes": [
+            {
+                "name": name,
+                "context": context(name),
+                "imageSources": rng.sample(image_names, rng.randint(1, 3)),
+            }
+            for name in names
+        ],
+        "relationships": [
+            {
+                "from": source,
+                "to": target,
+                "name": rng.choice(ACTIONS),
+                "context": rng.sample(CONTEXTS, rng.randint(0, 1)),
+                "imageSources": rng.sample(image_names, rng.randint(1, 2)),
+            }
+            for source, target in (rng.sample(names, 2) for _ in range(edge_count))
+        ],
+    }
+
+
+def generate_conversation(graph, turns, seed=0):
+    """Questions about the graph's components with JSON answers, as the
+    frontend keeps its conversation history."""
+    rng = random.Random(seed)
+    history = []
+    for _ in range(turns):
+        edge = rng.choice(graph["relationships"])
+        history.append(
+            {
+                "role": "user",
+                "content": f"How does {edge['from']} interact with {edge['to']}?",
+            }
+        )
+        answer = {
+            "text": f"{edge['from']} {edge['name']} {edge['to']}. "
+            + " ".join(edge["context"] or ["No further details are given."]),
+            "imageSources": edge["imageSources"],
+        }
+        history.append({"role": "assistant", "content": json.dumps(answer)})
+    return history
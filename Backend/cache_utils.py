@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from search_utils import tokenize
+
+logger = logging.getLogger(__name__)
+
+TILE_CACHE_PATH = os.getenv("TILE_CACHE_PATH", "cache/tile_cache.sqlite3")
+TILE_CACHE_MAX_BYTES = int(os.getenv("TILE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# 0 entries turns the answer cache off
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+# Questions at least this similar share an answer, 0 only reuses answers for
+# questions that normalize the same
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(
+    os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0")
+)
+
+
+def get_tile_cache_key(encoded_image, prompt, deployment):
+    digest = hashlib.sha256()
+    for part in (encoded_image, prompt, deployment or ""):
+        digest.update(part.encode("utf-8"))
+        # Separator so that moving bytes between parts changes the key
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class TileCache:
+    # Persistent GPT results for image tiles, evicted least recently used first
+    # once the stored responses exceed max_bytes
+    def __init__(self, path=TILE_CACHE_PATH, max_bytes=TILE_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS tile_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """)
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS tile_cache_last_access ON tile_cache (last_access)"
+        )
+        self.connection.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM tile_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.connection.execute(
+                "UPDATE tile_cache SET last_access = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self.connection.commit()
+            return row[0]
+
+    def put(self, key, value):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO tile_cache (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        total = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM tile_cache"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        evicted = 0
+        for key, size in self.connection.execute(
+            "SELECT key, size FROM tile_cache ORDER BY last_access"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            self.connection.execute("DELETE FROM tile_cache WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        logger.info(f"Evicted {evicted} entries from the tile cache.")
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tile_cache"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+def normalize_question(question):
+    # "How does the Auth Service validate tokens?" and "how does auth service
+    # validates tokens" are the same question
+    return " ".join(tokenize(question))
+
+
+def get_question_terms(normalized):
+    # Words and word pairs, so "A calls B" and "B calls A" are not alike
+    tokens = normalized.split()
+    return frozenset(tokens + [" ".join(pair) for pair in zip(tokens, tokens[1:])])
+
+
+def get_history_fingerprint(conversation_history):
+    return hashlib.sha256(
+        json.dumps(conversation_history, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class AnswerCache:
+    # GPT answers to /query by normalized question, collection, its graph
+    # version, conversation history and context mode. A graph write clears the
+    # answers of its collection, entries expire after ttl seconds and the
+    # least recently used go first once full
+    def __init__(
+        self,
+        max_entries=ANSWER_CACHE_MAX_ENTRIES,
+        ttl=ANSWER_CACHE_TTL_SECONDS,
+        similarity_threshold=ANSWER_CACHE_SIMILARITY_THRESHOLD,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        # key -> (expires_at, terms, answer), in least recently used order
+        self.entries = OrderedDict()
+        # (collection, version, history, mode) -> keys, to find near duplicates
+        self.groups = {}
+        # Latest graph version seen for each collection
+        self.versions = {}
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def _remove(self, key):
+        self.entries.pop(key)
+        group = self.groups[key[1:]]
+        group.discard(key)
+        if not group:
+            del self.groups[key[1:]]
+
+    def _live(self, key, now):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] <= now:
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def _find_similar(self, key, terms, now):
+        best, best_score = None, self.similarity_threshold
+        for other in list(self.groups.get(key[1:], ())):
+            entry = self._live(other, now)
+            if entry is None:
+                continue
+            union = len(terms | entry[1])
+            score = len(terms & entry[1]) / union if union else 0.0
+            if score >= best_score:
+                best, best_score = other, score
+        return best
+
+    def get(
+        self, question, collection, version, conversation_history, use_relevant_context
+    ):
+        if self.max_entries <= 0:
+            return None
+        normalized = normalize_question(question)
+        key = (
+            normalized,
+            collection,
+            version,
+            get_history_fingerprint(conversation_history),
+            use_relevant_context,
+        )
+        now = time.monotonic()
+        with self.lock:
+            entry = self._live(key, now)
+            if entry is None and self.similarity_threshold > 0:
+                similar = self._find_similar(key, get_question_terms(normalized), now)
+                if similar is not None:
+                    key, entry = similar, self.entries[similar]
+                    self.near_hits += 1
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(
+        self,
+        question,
+        collection,
+        version,
+        conversation_history,
+        use_relevant_context,
+        answer,
+    ):
+        if self.max_entries <= 0:
+            return
+        normalized = normalize_question(question)
+        key = (
+            normalized,
+            collection,
+            version,
+            get_history_fingerprint(conversation_history),
+            use_relevant_context,
+        )
+        with self.lock:
+            # An answer computed before the latest write is already stale
+            latest = self.versions.get(collection)
+            if latest is not None and version < latest:
+                return
+            self.versions[collection] = version
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (
+                time.monotonic() + self.ttl,
+                get_question_terms(normalized),
+                answer,
+            )
+            self.groups.setdefault(key[1:], set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, collection, version):
+        # Called for every graph write, answers about the collection may now be
+        # wrong. Without a collection every answer goes
+        with self.lock:
+            self.invalidations += 1
+            if collection is None:
+                self.versions.clear()
+                self.entries.clear()
+                self.groups.clear()
+                return
+            self.versions[collection] = version
+            for key in [key for key in self.entries if key[1] == collection]:
+                self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "near_duplicate_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,76 @@
+import os
+import zlib
+
+import zstandard
+
+# Levels for compressed responses, higher is smaller and slower
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "3"))
+# Smaller bodies are sent as they are, compressing them saves next to nothing
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+
+# In order of preference when a client accepts several
+ENCODINGS = ("zstd", "gzip")
+
+
+def choose_encoding(accept_encoding):
+    # The preferred encoding in an Accept-Encoding header, None for sending
+    # the body as it is. q=0 turns an encoding off
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, *params = part.split(";")
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def get_compressor(encoding):
+    if encoding == "gzip":
+        # wbits=31 writes the gzip header and trailer
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    raise ValueError(f"Unknown encoding {encoding}.")
+
+
+def compress(body, encoding):
+    compressor = get_compressor(encoding)
+    return compressor.compress(body) + compressor.flush()
+
+
+class StreamCompressor:
+    # Compresses a response body that is sent in chunks. Every chunk comes
+    # out flushed, so the client can decode each record as soon as it
+    # arrives instead of when the compressor's buffer fills up
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.compressor = get_compressor(encoding)
+        if encoding == "gzip":
+            self.flush_mode = zlib.Z_SYNC_FLUSH
+        else:
+            self.flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+
+    def compress(self, chunk):
+        return self.compressor.compress(chunk) + self.compressor.flush(self.flush_mode)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+async def compress_stream(chunks, encoding):
+    compressor = StreamCompressor(encoding)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
@@ -1,42 +1,106 @@
 import os
 import json
+import time
+import random
+import asyncio
+import functools
 import logging
-from openai import AzureOpenAI
+import threading
+from contextlib import aclosing
+from email.utils import parsedate_to_datetime
+from metrics_utils import (
+    llm_request_duration,
+    llm_wait_duration,
+    llm_first_token_duration,
+    llm_tokens,
+    llm_errors,
+)
+from openai import (
+    AsyncAzureOpenAI,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
 
 logger = logging.getLogger(__name__)
 
+# Calls in flight against the deployment, across all callers
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+# Deployment quota, 0 disables the corresponding limit
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "0"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "120"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "1"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "60"))
+# Tokens budgeted for the answer until the response reports actual usage
+LLM_COMPLETION_TOKEN_ESTIMATE = int(os.getenv("LLM_COMPLETION_TOKEN_ESTIMATE", "1000"))
+# Ask for token usage at the end of streamed answers, needs an API version
+# that supports stream_options
+LLM_STREAM_INCLUDE_USAGE = (
+    os.getenv("LLM_STREAM_INCLUDE_USAGE", "true").lower() == "true"
+)
+# A high detail image tile downscaled to 768px costs at most 765 prompt tokens
+IMAGE_TOKEN_ESTIMATE = 765
 
-def get_openai_client():
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+
+def get_async_openai_client():
     endpoint = os.getenv("AZURE_OPENAI_ENDPOINT_URL")
     deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
     subscription_key = os.getenv("AZURE_OPENAI_API_KEY")
     api_version = os.getenv("AZURE_OPENAI_API_VERSION")
 
-    client = AzureOpenAI(
+    client = AsyncAzureOpenAI(
         azure_endpoint=endpoint,
         api_key=subscription_key,
         api_version=api_version,
         azure_deployment=deployment,
+        # Retries are done by the dispatcher, which also honours Retry-After
+        max_retries=0,
     )
 
-    return client, deployment
+    return client
 
 
-openai_client, openai_model = get_openai_client()
+openai_model = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
 
+# Created on first use, or when the backend starts, so the module imports
+# without Azure OpenAI settings. Every worker process has its own client and
+# with it its own connection pool
+async_openai_client = None
 
-def get_gpt_response(messages):
-    completion = openai_client.chat.completions.create(
-        model=openai_model,
-        messages=messages,
-        temperature=0.73,
-        top_p=0.88,
-        frequency_penalty=0,
-        presence_penalty=0,
-        stop=None,
-        stream=False,
-    )
 
+def get_async_client():
+    global async_openai_client
+    if async_openai_client is None:
+        async_openai_client = get_async_openai_client()
+    return async_openai_client
+
+
+async def close_clients():
+    global async_openai_client
+    if async_openai_client is not None:
+        await async_openai_client.close()
+    async_openai_client = None
+
+
+def get_completion_params(messages):
+    return {
+        "model": openai_model,
+        "messages": messages,
+        "temperature": 0.73,
+        "top_p": 0.88,
+        "frequency_penalty": 0,
+        "presence_penalty": 0,
+        "stop": None,
+        "stream": False,
+    }
+
+
+def parse_completion(completion):
     completion_json = completion.to_json()
     logger.debug(f"GPT Completion Response: {completion_json}")
 
@@ -53,10 +117,379 @@ def get_gpt_response(messages):
         return None
 
 
-def identify_relevant_nodes_from_user_input(
-    user_input, nodes, find_relevant_nodes_prompt
-):
-    messages = [
+def estimate_tokens(messages):
+    # Roughly four characters per token, plus a fixed cost per image
+    tokens = LLM_COMPLETION_TOKEN_ESTIMATE
+    for message in messages:
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                tokens += IMAGE_TOKEN_ESTIMATE
+            else:
+                tokens += len(part.get("text", "")) // 4
+    return tokens
+
+
+def get_retry_after(error):
+    # Azure sends retry-after-ms and/or retry-after (seconds or an HTTP date)
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            value = headers["retry-after"]
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def get_backoff_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        return min(retry_after, LLM_BACKOFF_MAX_SECONDS)
+    # Exponential backoff with full jitter so callers do not retry in lockstep
+    return random.uniform(
+        0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2**attempt)
+    )
+
+
+class TokenBucket:
+    # Refills limit units per minute and may go into debt, the debt is how long
+    # the next caller has to wait. The limiter's lock lets callers on every
+    # event loop share it
+    def __init__(self, limit_per_minute):
+        self.capacity = limit_per_minute
+        self.rate = limit_per_minute / 60
+        self.available = float(limit_per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.available = min(
+            self.capacity, self.available + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def reserve(self, amount, now):
+        self._refill(now)
+        self.available -= amount
+        return max(0.0, -self.available / self.rate)
+
+    def adjust(self, amount, now):
+        self._refill(now)
+        self.available -= amount
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.requests = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens):
+        # Returns how long to wait before sending a request of this many tokens
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0.0, self.blocked_until - now)
+            if self.requests:
+                delay = max(delay, self.requests.reserve(1, now))
+            if self.tokens:
+                delay = max(delay, self.tokens.reserve(tokens, now))
+            return delay
+
+    def correct(self, estimated_tokens, actual_tokens):
+        if self.tokens and actual_tokens:
+            with self.lock:
+                self.tokens.adjust(actual_tokens - estimated_tokens, time.monotonic())
+
+    def block(self, seconds):
+        # A 429 applies to the whole deployment, not just the caller that got it
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class LLMMetrics:
+    FIELDS = (
+        "calls",
+        "succeeded",
+        "failed",
+        "retries",
+        "rate_limited",
+        "timeouts",
+        "prompt_tokens",
+        "completion_tokens",
+        "wait_seconds",
+        "latency_seconds",
+        "streams",
+        "first_token_seconds",
+    )
+
+    def __init__(self):
+        self.callers = {}
+        self.lock = threading.Lock()
+
+    def record(self, caller, **values):
+        with self.lock:
+            metrics = self.callers.setdefault(caller, dict.fromkeys(self.FIELDS, 0))
+            for field, value in values.items():
+                metrics[field] += value
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for caller, metrics in self.callers.items():
+                succeeded = metrics["succeeded"]
+                stats[caller] = {
+                    **metrics,
+                    "average_latency_seconds": (
+                        metrics["latency_seconds"] / succeeded if succeeded else 0.0
+                    ),
+                    "average_first_token_seconds": (
+                        metrics["first_token_seconds"] / metrics["streams"]
+                        if metrics["streams"]
+                        else 0.0
+                    ),
+                }
+            return stats
+
+
+class LLMDispatcher:
+    # Every chat completion goes through here: a global concurrency cap, the
+    # deployment's request and token quota, per-call timeouts and retries with
+    # backoff, with metrics kept per caller (tile, relevance, query, merge)
+    def __init__(
+        self,
+        max_concurrency=LLM_MAX_CONCURRENCY,
+        requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+        timeout=LLM_TIMEOUT_SECONDS,
+        max_retries=LLM_MAX_RETRIES,
+    ):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.metrics = LLMMetrics()
+        # asyncio primitives are bound to the loop they are first used on
+        self.async_semaphores = {}
+
+    def _get_async_semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self.async_semaphores:
+            self.async_semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self.async_semaphores[loop]
+
+    def _record_success(self, caller, usage, estimated_tokens, latency):
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        self.limiter.correct(estimated_tokens, prompt_tokens + completion_tokens)
+        llm_request_duration.observe(latency, caller=caller)
+        llm_tokens.inc(prompt_tokens, caller=caller, kind="prompt")
+        llm_tokens.inc(completion_tokens, caller=caller, kind="completion")
+        self.metrics.record(
+            caller,
+            succeeded=1,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            latency_seconds=latency,
+        )
+
+    def _handle_error(self, caller, error, attempt):
+        # Returns the delay before the next attempt, or re-raises
+        llm_errors.inc(caller=caller, error=type(error).__name__)
+        self.metrics.record(
+            caller,
+            rate_limited=int(isinstance(error, RateLimitError)),
+            timeouts=int(isinstance(error, APITimeoutError)),
+        )
+        if attempt >= self.max_retries:
+            self.metrics.record(caller, failed=1)
+            logger.error(f"GPT call for {caller} failed after {attempt + 1} attempts.")
+            raise error
+
+        retry_after = get_retry_after(error)
+        delay = get_backoff_delay(attempt, retry_after)
+        if isinstance(error, RateLimitError):
+            self.limiter.block(delay)
+        self.metrics.record(caller, retries=1)
+        logger.warning(
+            f"GPT call for {caller} failed ({type(error).__name__}), retrying in {delay:.2f}s."
+        )
+        return delay
+
+    async def create_async(self, client, params, caller):
+        estimated_tokens = estimate_tokens(params["messages"])
+        self.metrics.record(caller, calls=1)
+        attempt = 0
+        while True:
+            wait_start = time.perf_counter()
+            async with self._get_async_semaphore():
+                await asyncio.sleep(self.limiter.reserve(estimated_tokens))
+                wait_seconds = time.perf_counter() - wait_start
+                self.metrics.record(caller, wait_seconds=wait_seconds)
+                llm_wait_duration.observe(wait_seconds, caller=caller)
+                start = time.perf_counter()
+                try:
+                    completion = await client.chat.completions.create(
+                        **params, timeout=self.timeout
+                    )
+                except RETRYABLE_ERRORS as e:
+                    delay = self._handle_error(caller, e, attempt)
+                except Exception as e:
+                    self.metrics.record(caller, failed=1)
+                    llm_errors.inc(caller=caller, error=type(e).__name__)
+                    raise
+                else:
+                    self._record_success(
+                        caller,
+                        getattr(completion, "usage", None),
+                        estimated_tokens,
+                        time.perf_counter() - start,
+                    )
+                    return completion
+            # Back off outside the semaphore so other callers can use the slot
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _read_stream(self, stream, queue, caller, tokens, start):
+        # Reads the whole answer into the queue as soon as upstream sends it,
+        # however slowly the caller reads the text. The queue ends with None,
+        # or with the error that cut the answer short
+        usage = None
+        first_token = True
+        try:
+            async for chunk in stream:
+                usage = chunk.usage or usage
+                # Azure sends content filter results without choices
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                if first_token:
+                    first_token = False
+                    first_token_seconds = time.perf_counter() - start
+                    self.metrics.record(caller, first_token_seconds=first_token_seconds)
+                    llm_first_token_duration.observe(first_token_seconds, caller=caller)
+                queue.put_nowait(chunk.choices[0].delta.content)
+        except Exception as e:
+            self.metrics.record(caller, failed=1)
+            llm_errors.inc(caller=caller, error=type(e).__name__)
+            queue.put_nowait(e)
+            return
+        finally:
+            await stream.close()
+        self._record_success(caller, usage, tokens, time.perf_counter() - start)
+        queue.put_nowait(None)
+
+    def _finish_read(self, stream, queue, semaphore, reader):
+        # Frees the concurrency slot exactly once however the reader ended,
+        # even when it was cancelled before it started and so never reached
+        # its own finally. Closing a stream twice is harmless
+        semaphore.release()
+        if reader.cancelled():
+            asyncio.ensure_future(stream.close())
+            queue.put_nowait(RuntimeError("Reading the answer was cancelled."))
+
+    async def stream_async(self, client, params, caller):
+        # Yields the answer's text as GPT writes it. Only opening the stream is
+        # retried, once text has been handed out a failure is final. The slot
+        # is held while the answer comes from upstream, not while the caller
+        # reads it, so a slow client keeps at most one answer in memory
+        estimated_tokens = estimate_tokens(params["messages"])
+        self.metrics.record(caller, calls=1, streams=1)
+        params = {**params, "stream": True}
+        if LLM_STREAM_INCLUDE_USAGE:
+            params["stream_options"] = {"include_usage": True}
+        semaphore = self._get_async_semaphore()
+        attempt = 0
+        while True:
+            wait_start = time.perf_counter()
+            await semaphore.acquire()
+            try:
+                await asyncio.sleep(self.limiter.reserve(estimated_tokens))
+                wait_seconds = time.perf_counter() - wait_start
+                self.metrics.record(caller, wait_seconds=wait_seconds)
+                llm_wait_duration.observe(wait_seconds, caller=caller)
+                start = time.perf_counter()
+                stream = await client.chat.completions.create(
+                    **params, timeout=self.timeout
+                )
+            except RETRYABLE_ERRORS as e:
+                semaphore.release()
+                delay = self._handle_error(caller, e, attempt)
+            except Exception as e:
+                semaphore.release()
+                self.metrics.record(caller, failed=1)
+                llm_errors.inc(caller=caller, error=type(e).__name__)
+                raise
+            except BaseException:
+                # Cancelled while waiting or opening the stream
+                semaphore.release()
+                raise
+            else:
+                break
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        queue = asyncio.Queue()
+        reader = asyncio.create_task(
+            self._read_stream(stream, queue, caller, estimated_tokens, start)
+        )
+        reader.add_done_callback(
+            functools.partial(self._finish_read, stream, queue, semaphore)
+        )
+        try:
+            while True:
+                text = await queue.get()
+                if text is None:
+                    return
+                if isinstance(text, Exception):
+                    raise text
+                yield text
+        finally:
+            # Stops reading upstream when the caller went away before the end
+            reader.cancel()
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "callers": self.metrics.stats(),
+        }
+
+
+llm_dispatcher = LLMDispatcher()
+
+
+async def get_gpt_response_async(messages, caller="default"):
+    completion = await llm_dispatcher.create_async(
+        get_async_client(), get_completion_params(messages), caller
+    )
+    return parse_completion(completion)
+
+
+async def stream_gpt_response_async(messages, caller="default"):
+    # Closed with the caller's generator, so the stream stops right away when
+    # the client goes away rather than when the generator is collected
+    async with aclosing(
+        llm_dispatcher.stream_async(
+            get_async_client(), get_completion_params(messages), caller
+        )
+    ) as texts:
+        async for text in texts:
+            yield text
+
+
+def get_relevant_nodes_messages(user_input, nodes, find_relevant_nodes_prompt):
+    return [
         {
             "role": "system",
             "content": find_relevant_nodes_prompt,
@@ -67,10 +500,22 @@ def identify_relevant_nodes_from_user_input(
         },
     ]
 
-    response = get_gpt_response(messages)
+
+def parse_relevant_nodes(response):
     logger.info(f"Response from GPT: {response}")
 
     if response is None:
         return []
 
     return json.loads(response)
+
+
+async def identify_relevant_nodes_from_user_input_async(
+    user_input, nodes, find_relevant_nodes_prompt
+):
+    messages = get_relevant_nodes_messages(
+        user_input, nodes, find_relevant_nodes_prompt
+    )
+    return parse_relevant_nodes(
+        await get_gpt_response_async(messages, caller="relevance")
+    )
@@ -0,0 +1,238 @@
+import json
+import uuid
+import heapq
+import asyncio
+import logging
+import threading
+from array import array
+
+from compression_utils import compress
+
+logger = logging.getLogger(__name__)
+
+
+class GraphSnapshot:
+    # Read-only copy of the graph at one version. Nodes are numbered, edges
+    # are parallel arrays of node ids and every node has the ids of its
+    # outgoing and incoming edges, so lookups never scan the whole graph
+    def __init__(self, graph, version):
+        self.version = version
+        self.names = []
+        self.ids = {}
+        self.contexts = []
+        self.image_sources = []
+        for node in graph["nodes"]:
+            self._add_node(node["name"], node.get("context"), node.get("imageSources"))
+
+        self.edge_from = array("i")
+        self.edge_to = array("i")
+        self.edge_names = []
+        self.edge_contexts = []
+        self.edge_image_sources = []
+        self.outgoing = [[] for _ in self.names]
+        self.incoming = [[] for _ in self.names]
+        for relationship in graph["relationships"]:
+            self._add_edge(relationship)
+        self._json_bodies = {}
+
+    def _add_node(self, name, context, image_sources):
+        self.ids[name] = len(self.names)
+        self.names.append(name)
+        self.contexts.append(context)
+        self.image_sources.append(image_sources)
+        return self.ids[name]
+
+    def _add_edge(self, relationship):
+        ids = []
+        for name in (relationship["from"], relationship["to"]):
+            if name not in self.ids:
+                self._add_node(name, [], [])
+                self.outgoing.append([])
+                self.incoming.append([])
+            ids.append(self.ids[name])
+        edge = len(self.edge_names)
+        self.edge_from.append(ids[0])
+        self.edge_to.append(ids[1])
+        self.edge_names.append(relationship["name"])
+        self.edge_contexts.append(relationship.get("context"))
+        self.edge_image_sources.append(relationship.get("imageSources"))
+        self.outgoing[ids[0]].append(edge)
+        self.incoming[ids[1]].append(edge)
+
+    def node(self, node_id):
+        return {
+            "name": self.names[node_id],
+            "context": self.contexts[node_id],
+            "imageSources": self.image_sources[node_id],
+        }
+
+    def relationship(self, edge):
+        return {
+            "from": self.names[self.edge_from[edge]],
+            "to": self.names[self.edge_to[edge]],
+            "name": self.edge_names[edge],
+            "context": self.edge_contexts[edge],
+            "imageSources": self.edge_image_sources[edge],
+        }
+
+    def _edges_of(self, node_id, direction):
+        if direction in ("out", "both"):
+            yield from self.outgoing[node_id]
+        if direction in ("in", "both"):
+            yield from self.incoming[node_id]
+
+    def get_subgraph(
+        self, names, hops=1, direction="both", max_nodes=None, max_edges=None
+    ):
+        # Breadth-first search from the named nodes, following edges in the
+        # given direction ("out", "in" or "both") for up to hops steps. Nodes
+        # closer to the seeds, and earlier seeds, win once a limit is reached
+        if direction not in ("out", "in", "both"):
+            raise ValueError(f"Unknown direction {direction}.")
+
+        seeds = [self.ids[name] for name in dict.fromkeys(names) if name in self.ids]
+        visited = dict.fromkeys(seeds[:max_nodes] if max_nodes else seeds)
+        edges = {}
+        frontier = list(visited)
+        for _ in range(hops):
+            next_frontier = []
+            for node_id in frontier:
+                for edge in self._edges_of(node_id, direction):
+                    if edge in edges:
+                        continue
+                    if max_edges is not None and len(edges) >= max_edges:
+                        break
+                    other = self.edge_to[edge]
+                    if other == node_id:
+                        other = self.edge_from[edge]
+                    if other not in visited:
+                        if max_nodes is not None and len(visited) >= max_nodes:
+                            continue
+                        visited[other] = None
+                        next_frontier.append(other)
+                    edges[edge] = None
+            frontier = next_frontier
+            if not frontier:
+                break
+
+        return {
+            "nodes": [self.node(node_id) for node_id in visited],
+            "relationships": [self.relationship(edge) for edge in edges],
+        }
+
+    def get_hub_names(self, limit):
+        # The names of the nodes with the most edges, earlier nodes first on a
+        # tie, for questions that name no node in particular
+        node_ids = heapq.nlargest(
+            limit,
+            range(len(self.names)),
+            key=lambda node_id: (
+                len(self.outgoing[node_id]) + len(self.incoming[node_id]),
+                -node_id,
+            ),
+        )
+        return [self.names[node_id] for node_id in node_ids]
+
+    def to_graph(self):
+        return {
+            "nodes": [self.node(node_id) for node_id in range(len(self.names))],
+            "relationships": [
+                self.relationship(edge) for edge in range(len(self.edge_names))
+            ],
+        }
+
+    def iter_records(self):
+        # The same ("node", node) and ("relationship", relationship) pairs as
+        # GraphStore.iter_fullgraph
+        for node_id in range(len(self.names)):
+            yield "node", self.node(node_id)
+        for edge in range(len(self.edge_names)):
+            yield "relationship", self.relationship(edge)
+
+    def json_body(self, encoding=None):
+        # The /fullgraph response, serialized and compressed once per version
+        # and encoding
+        if encoding not in self._json_bodies:
+            if encoding is None:
+                body = json.dumps({"full_graph": self.to_graph()}).encode("utf-8")
+            else:
+                body = compress(self.json_body(), encoding)
+            self._json_bodies[encoding] = body
+        return self._json_bodies[encoding]
+
+
+class GraphCache:
+    # Holds the latest GraphSnapshot. Every write bumps the version, which
+    # drops the snapshot, and the next read loads a new one
+    def __init__(self):
+        self.version = 0
+        self.snapshot = None
+        self.hits = 0
+        self.misses = 0
+        # Versions restart with the process, so ETags carry a per-process id
+        self.instance_id = uuid.uuid4().hex[:12]
+        self.lock = threading.Lock()
+        self.load_locks = {}
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+            self.snapshot = None
+
+    def etag(self, version=None, encoding=None):
+        # Each encoding of a version is a different body, so it has its own tag
+        tag = f"{self.instance_id}-{self.version if version is None else version}"
+        return f'"{tag}-{encoding}"' if encoding else f'"{tag}"'
+
+    def cached(self):
+        # The snapshot if one is held, without loading one
+        with self.lock:
+            return self.snapshot
+
+    def _lookup(self):
+        with self.lock:
+            if self.snapshot is not None:
+                self.hits += 1
+                return self.snapshot, self.version
+            self.misses += 1
+            return None, self.version
+
+    def _store(self, graph, version):
+        snapshot = GraphSnapshot(graph, version)
+        with self.lock:
+            # A write that finished while loading makes this snapshot stale
+            if version == self.version:
+                self.snapshot = snapshot
+        return snapshot
+
+    async def get_async(self, loader):
+        snapshot, version = self._lookup()
+        if snapshot is not None:
+            return snapshot
+
+        # Concurrent misses wait for one load instead of each scanning Neo4j
+        loop = asyncio.get_running_loop()
+        if loop not in self.load_locks:
+            self.load_locks[loop] = asyncio.Lock()
+        async with self.load_locks[loop]:
+            with self.lock:
+                if self.snapshot is not None:
+                    return self.snapshot
+                version = self.version
+            graph = await loader()
+            return await asyncio.to_thread(self._store, graph, version)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "version": self.version,
+                "cached": self.snapshot is not None,
+                "nodes": len(self.snapshot.names) if self.snapshot else 0,
+                "relationships": (
+                    len(self.snapshot.edge_names) if self.snapshot else 0
+                ),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -1,12 +1,43 @@
+import os
 import cv2
 import numpy as np
 import base64
 import logging
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from metrics_utils import timed
 
 logger = logging.getLogger(__name__)
 
+TILE_JPEG_QUALITY = int(os.getenv("TILE_JPEG_QUALITY", "90"))
+# GPT vision (high detail) fits images into 2048x2048 and then scales the short
+# side down to 768px, so larger tiles only cost encoding time and bandwidth
+TILE_MAX_DIMENSION = int(os.getenv("TILE_MAX_DIMENSION", "2048"))
+TILE_MAX_SHORT_SIDE = int(os.getenv("TILE_MAX_SHORT_SIDE", "768"))
+TILE_ENCODE_WORKERS = int(os.getenv("TILE_ENCODE_WORKERS", str(os.cpu_count() or 1)))
+# Tiles of an image encoded ahead of the one being handed out, enough to keep
+# the encode pool busy without holding every encoded tile of a large image
+TILE_ENCODE_AHEAD = int(os.getenv("TILE_ENCODE_AHEAD", str(TILE_ENCODE_WORKERS)))
 
-def divide_image_with_adaptive_threshold_base64(image_base64, rows, cols, overlap=50):
+TILING_MODES = ("grid", "adaptive")
+# Adaptive tiling: largest tile side, most content boxes (roughly glyphs and
+# shapes) per tile, and the size below which busy tiles are not split further
+ADAPTIVE_TILE_MAX_SIZE = int(os.getenv("ADAPTIVE_TILE_MAX_SIZE", "2048"))
+ADAPTIVE_TILE_MAX_ITEMS = int(os.getenv("ADAPTIVE_TILE_MAX_ITEMS", "600"))
+ADAPTIVE_TILE_MIN_SIZE = int(os.getenv("ADAPTIVE_TILE_MIN_SIZE", "512"))
+REGION_MASK_SIZE = 1024
+# Groups a region may be counted against when merging regions into tiles
+MERGE_CANDIDATES = 8
+
+# cv2.imencode releases the GIL, so threads encode tiles in parallel
+tile_encode_executor = ThreadPoolExecutor(
+    max_workers=TILE_ENCODE_WORKERS, thread_name_prefix="tile-encode"
+)
+
+
+@timed("image.decode")
+def decode_image_base64(image_base64):
     logger.debug("Decoding and analyzing the image...")
     image_data = base64.b64decode(image_base64)
     np_image = np.frombuffer(image_data, dtype=np.uint8)
@@ -15,25 +46,74 @@ def divide_image_with_adaptive_threshold_base64(image_base64, rows, cols, overla
     if image is None:
         raise ValueError("Invalid base64 image data provided.")
 
+    return image
+
+
+@timed("image.decode")
+def decode_image_file(path):
+    # cv2 reads the file itself, so its bytes never become a Python object
+    logger.debug("Decoding and analyzing the image file...")
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+
+    if image is None:
+        raise ValueError("Invalid image file provided.")
+
+    return image
+
+
+def get_content_boxes(image, overlap):
+    # Bounding boxes (x1, y1, x2, y2 exclusive) of every external contour,
+    # grown by the same amount cv2.dilate with an overlap x overlap kernel would
+    # grow a mask of those boxes. Checking a tile for content is then an array
+    # comparison instead of painting and dilating a full-size mask
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     binary = cv2.adaptiveThreshold(
         gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 11, 2
     )
-
     contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    mask = np.zeros_like(gray)
-    for contour in contours:
-        x, y, w, h = cv2.boundingRect(contour)
-        cv2.rectangle(mask, (x, y), (x + w, y + h), 255, -1)
+    if not contours:
+        return np.zeros((0, 4), dtype=np.int64)
 
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (overlap, overlap))
-    dilated = cv2.dilate(mask, kernel, iterations=1)
+    # Bounding rectangles of all contours at once: reduce the concatenated
+    # points over each contour's slice instead of calling cv2.boundingRect
+    points = np.concatenate(contours)[:, 0, :]
+    starts = np.cumsum([0] + [len(contour) for contour in contours[:-1]])
+    left = np.minimum.reduceat(points[:, 0], starts).astype(np.int64)
+    top = np.minimum.reduceat(points[:, 1], starts).astype(np.int64)
+    # cv2.rectangle(mask, (x, y), (x + w, y + h)) also filled the far edge,
+    # and boundingRect's width is max - min + 1
+    right = np.maximum.reduceat(points[:, 0], starts).astype(np.int64) + 2
+    bottom = np.maximum.reduceat(points[:, 1], starts).astype(np.int64) + 2
 
-    h, w = image.shape[:2]
+    h, w = binary.shape
+    anchor = overlap // 2
+    return np.stack(
+        [
+            np.maximum(left - (overlap - 1 - anchor), 0),
+            np.maximum(top - (overlap - 1 - anchor), 0),
+            np.minimum(right + anchor, w),
+            np.minimum(bottom + anchor, h),
+        ],
+        axis=1,
+    )
+
+
+def has_content(boxes, x1, y1, x2, y2):
+    return bool(
+        np.any(
+            (boxes[:, 0] < x2)
+            & (boxes[:, 2] > x1)
+            & (boxes[:, 1] < y2)
+            & (boxes[:, 3] > y1)
+        )
+    )
+
+
+def get_grid_tile_coordinates(image_shape, boxes, rows, cols, overlap):
+    h, w = image_shape[:2]
     step_h = h // rows
     step_w = w // cols
 
-    sections = []
     section_coordinates = []
     for r in range(rows):
         for c in range(cols):
@@ -42,21 +122,247 @@ def divide_image_with_adaptive_threshold_base64(image_base64, rows, cols, overla
             x1 = max(c * step_w - overlap, 0)
             x2 = min((c + 1) * step_w + overlap, w)
 
-            if np.any(dilated[y1:y2, x1:x2]):
+            if has_content(boxes, x1, y1, x2, y2):
                 y1 = max(0, y1 - overlap)
                 y2 = min(h, y2 + overlap)
                 x1 = max(0, x1 - overlap)
                 x2 = min(w, x2 + overlap)
 
-            section = image[y1:y2, x1:x2]
-            sections.append(section)
             section_coordinates.append((x1, y1, x2, y2))
+    return section_coordinates
+
+
+def get_content_regions(image_shape, boxes):
+    # Connected components of the dilated content mask. Overlapping boxes are
+    # the same component, so the boxes are painted onto a mask shrunk to at
+    # most REGION_MASK_SIZE pixels a side and labelled there
+    h, w = image_shape[:2]
+    if len(boxes) == 0:
+        return []
+
+    factor = max(1, -(-max(h, w) // REGION_MASK_SIZE))
+    small_h, small_w = -(-h // factor), -(-w // factor)
+    x1 = boxes[:, 0] // factor
+    y1 = boxes[:, 1] // factor
+    x2 = -(-boxes[:, 2] // factor)
+    y2 = -(-boxes[:, 3] // factor)
+
+    # Paint all boxes at once with a 2D prefix sum
+    diff = np.zeros((small_h + 1, small_w + 1), dtype=np.int32)
+    np.add.at(diff, (y1, x1), 1)
+    np.add.at(diff, (y1, x2), -1)
+    np.add.at(diff, (y2, x1), -1)
+    np.add.at(diff, (y2, x2), 1)
+    mask = (diff.cumsum(axis=0).cumsum(axis=1)[:small_h, :small_w] > 0).astype(np.uint8)
+
+    count, labels = cv2.connectedComponents(mask, connectivity=8)
+    box_labels = labels[y1, x1]
+    regions = []
+    for label in range(1, count):
+        members = boxes[box_labels == label]
+        if len(members):
+            regions.append(
+                (
+                    int(members[:, 0].min()),
+                    int(members[:, 1].min()),
+                    int(members[:, 2].max()),
+                    int(members[:, 3].max()),
+                )
+            )
+    return regions
+
+
+def get_box_centers(boxes):
+    return (boxes[:, 0] + boxes[:, 2]) // 2, (boxes[:, 1] + boxes[:, 3]) // 2
+
+
+def count_centers_in_region(centers, region):
+    x1, y1, x2, y2 = region
+    centers_x, centers_y = centers
+    return int(
+        np.count_nonzero(
+            (centers_x >= x1) & (centers_x < x2) & (centers_y >= y1) & (centers_y < y2)
+        )
+    )
+
+
+def count_boxes_in_region(boxes, region):
+    return count_centers_in_region(get_box_centers(boxes), region)
+
+
+def split_region(region, boxes, overlap):
+    # Halve regions that are too large or too busy for one GPT call, along the
+    # longer side, with the halves overlapping so edges across the cut survive
+    x1, y1, x2, y2 = region
+    too_large = max(x2 - x1, y2 - y1) > ADAPTIVE_TILE_MAX_SIZE
+    too_dense = count_boxes_in_region(boxes, region) > ADAPTIVE_TILE_MAX_ITEMS
+    if (
+        not (too_large or too_dense)
+        or max(x2 - x1, y2 - y1) < 2 * ADAPTIVE_TILE_MIN_SIZE
+    ):
+        return [region]
+
+    if x2 - x1 >= y2 - y1:
+        middle = (x1 + x2) // 2
+        halves = [(x1, y1, middle + overlap, y2), (middle - overlap, y1, x2, y2)]
+    else:
+        middle = (y1 + y2) // 2
+        halves = [(x1, y1, x2, middle + overlap), (x1, middle - overlap, x2, y2)]
+    return [tile for half in halves for tile in split_region(half, boxes, overlap)]
+
+
+def get_union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def sweep_merge_regions(regions, centers):
+    # One pass from left to right. Each region joins the open group whose
+    # bounding box it grows the least while that still fits one tile, or
+    # starts a new group. Regions come in order of their left edge, so a
+    # group starting more than a tile width further left can take no later
+    # region and is closed for good
+    groups = []
+    open_groups = []
+    for region in sorted(regions):
+        open_groups = [
+            g for g in open_groups if groups[g][0] >= region[0] - ADAPTIVE_TILE_MAX_SIZE
+        ]
+        candidates = []
+        for g in open_groups:
+            union = get_union(groups[g], region)
+            if max(union[2] - union[0], union[3] - union[1]) <= ADAPTIVE_TILE_MAX_SIZE:
+                area = (union[2] - union[0]) * (union[3] - union[1])
+                candidates.append((area, g, union))
+        # Counting boxes is the expensive check, so only the best few
+        # candidates get it
+        for _, g, union in sorted(candidates)[:MERGE_CANDIDATES]:
+            if count_centers_in_region(centers, union) <= ADAPTIVE_TILE_MAX_ITEMS:
+                groups[g] = union
+                break
+        else:
+            open_groups.append(len(groups))
+            groups.append(region)
+    return groups
+
+
+def merge_regions(regions, boxes):
+    # Combine small regions whose joint bounding box still fits one tile,
+    # sweeping again while a pass still joins groups
+    centers = get_box_centers(boxes)
+    regions = list(regions)
+    while True:
+        merged = sweep_merge_regions(regions, centers)
+        if len(merged) == len(regions):
+            return merged
+        regions = merged
+
+
+def get_adaptive_tile_coordinates(image_shape, boxes, overlap):
+    h, w = image_shape[:2]
+    regions = merge_regions(get_content_regions(image_shape, boxes), boxes)
+
+    section_coordinates = []
+    for region in regions:
+        for x1, y1, x2, y2 in split_region(region, boxes, overlap):
+            section_coordinates.append((max(0, x1), max(0, y1), min(w, x2), min(h, y2)))
+    # Reading order keeps tile keys stable between runs
+    return sorted(section_coordinates, key=lambda coord: (coord[1], coord[0]))
+
+
+@timed("image.tiling")
+def get_tile_coordinates(image, rows, cols, overlap, tiling_mode="grid"):
+    boxes = get_content_boxes(image, overlap)
+    if tiling_mode == "adaptive":
+        return get_adaptive_tile_coordinates(image.shape, boxes, overlap)
+    if tiling_mode == "grid":
+        return get_grid_tile_coordinates(image.shape, boxes, rows, cols, overlap)
+    raise ValueError(f"Unknown tiling mode {tiling_mode}.")
+
+
+def count_tiles_base64(image_base64, rows, cols, overlap=50):
+    image = decode_image_base64(image_base64)
+    return {
+        tiling_mode: len(get_tile_coordinates(image, rows, cols, overlap, tiling_mode))
+        for tiling_mode in TILING_MODES
+    }
+
+
+def divide_image_with_adaptive_threshold_base64(image_base64, rows, cols, overlap=50):
+    image = decode_image_base64(image_base64)
+    boxes = get_content_boxes(image, overlap)
+    section_coordinates = get_grid_tile_coordinates(
+        image.shape, boxes, rows, cols, overlap
+    )
+    sections = [image[y1:y2, x1:x2] for x1, y1, x2, y2 in section_coordinates]
 
     logger.debug("Image successfully divided using adaptive thresholding.")
     return sections, section_coordinates
 
 
-def encode_image_to_base64(image):
+@timed("image.encode")
+def encode_image_to_base64(
+    image,
+    quality=TILE_JPEG_QUALITY,
+    max_dimension=TILE_MAX_DIMENSION,
+    max_short_side=TILE_MAX_SHORT_SIDE,
+):
     logger.debug("Encoding image to base64.")
-    _, buffer = cv2.imencode(".jpg", image)
+    h, w = image.shape[:2]
+    scale = 1.0
+    if max_dimension and max(h, w) > max_dimension:
+        scale = max_dimension / max(h, w)
+    if max_short_side and min(h, w) * scale > max_short_side:
+        scale = max_short_side / min(h, w)
+    if scale < 1.0:
+        image = cv2.resize(
+            image,
+            (max(1, round(w * scale)), max(1, round(h * scale))),
+            interpolation=cv2.INTER_AREA,
+        )
+    _, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
     return base64.b64encode(buffer).decode("utf-8")
+
+
+def iter_encoded_image_tiles(image, rows, cols, overlap=50, tiling_mode="grid"):
+    # Keep up to TILE_ENCODE_AHEAD tiles in the encode pool and yield
+    # (encoded_tile, coordinates) in tile order as soon as each one is ready.
+    # The next tile is only submitted once one has been taken, so a consumer
+    # that stops asking stops the encoding too
+    section_coordinates = get_tile_coordinates(image, rows, cols, overlap, tiling_mode)
+    logger.debug("Image successfully divided using adaptive thresholding.")
+
+    def submit(coordinates):
+        x1, y1, x2, y2 = coordinates
+        # Each tile carries the request id of the upload into the pool
+        future = tile_encode_executor.submit(
+            contextvars.copy_context().run, encode_image_to_base64, image[y1:y2, x1:x2]
+        )
+        return future, coordinates
+
+    pending = iter(section_coordinates)
+    window = deque()
+    try:
+        for coordinates in pending:
+            window.append(submit(coordinates))
+            if len(window) >= max(1, TILE_ENCODE_AHEAD):
+                break
+        while window:
+            future, coordinates = window.popleft()
+            encoded = future.result()
+            next_coordinates = next(pending, None)
+            if next_coordinates is not None:
+                window.append(submit(next_coordinates))
+            yield encoded, coordinates
+    finally:
+        for future, _ in window:
+            future.cancel()
+
+
+def iter_encoded_tiles(image_base64, rows, cols, overlap=50, tiling_mode="grid"):
+    image = decode_image_base64(image_base64)
+    yield from iter_encoded_image_tiles(image, rows, cols, overlap, tiling_mode)
+
+
+def iter_encoded_tiles_file(path, rows, cols, overlap=50, tiling_mode="grid"):
+    image = decode_image_file(path)
+    yield from iter_encoded_image_tiles(image, rows, cols, overlap, tiling_mode)
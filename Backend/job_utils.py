@@ -0,0 +1,491 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from metrics_utils import request_id_var
+
+logger = logging.getLogger(__name__)
+
+JOBS_DIR = os.getenv("JOBS_DIR", "jobs")
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "2"))
+# With several worker processes only the one holding the lock in JOBS_DIR
+# runs uploads, it looks for jobs the others queued this often. The others
+# try to take over the lock as often, in case its holder stops
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+UPLOAD_LOCK_FILE = ".upload.lock"
+# Finished jobs kept in memory, older ones are read from disk when asked for
+JOB_CACHE_SIZE = int(os.getenv("JOB_CACHE_SIZE", "64"))
+# Finished jobs are deleted with their files after this long, 0 keeps them
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", str(7 * 24 * 3600)))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+
+# Images from a JSON upload are kept as their base64 text, uploaded files as
+# they came
+IMAGE_BASE64 = "base64"
+IMAGE_FILE = "file"
+# Read size when copying uploaded files
+IMAGE_COPY_CHUNK_SIZE = 1024 * 1024
+
+TILE_PENDING = "pending"
+TILE_RUNNING = "running"
+TILE_COMPLETED = "completed"
+TILE_FAILED = "failed"
+
+
+def try_lock(path):
+    # The open lock file if this process got the lock, None if another one
+    # holds it. The operating system releases it when the process ends
+    file = open(path, "a+")
+    try:
+        if os.name == "nt":
+            import msvcrt
+
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        file.close()
+        return None
+    return file
+
+
+class JobStore:
+    # Jobs live in memory and are mirrored to JOBS_DIR/<id>, so finished
+    # tiles survive a failed attempt or a restart. job.json has the job
+    # without its tiles and is rewritten on every change, tile updates are
+    # appended to tiles.jsonl and tile graphs have a file each in graphs/, so
+    # a change costs a write the size of the change rather than of the job.
+    # A job is read again when its files were changed by another worker
+    # process. The *_async methods change the job right away and write it
+    # in a thread
+    def __init__(
+        self,
+        jobs_dir=JOBS_DIR,
+        cache_size=JOB_CACHE_SIZE,
+        ttl_seconds=JOB_TTL_SECONDS,
+    ):
+        self.jobs_dir = jobs_dir
+        self.cache_size = cache_size
+        self.ttl_seconds = ttl_seconds
+        # Least recently used first, finished jobs beyond cache_size are
+        # dropped and read from disk again when asked for
+        self.jobs = OrderedDict()
+        # job id -> modification times of job.json and tiles.jsonl when they
+        # were last read or written here
+        self.mtimes = {}
+        # job id -> (modification time, status, finished_at) of job.json, so
+        # scanning the jobs only reads the ones that changed
+        self.statuses = {}
+        # job id -> number of the last save of job.json, so a slow write
+        # never replaces a newer one
+        self.saves = {}
+        self.written = {}
+        self.lock = threading.Lock()
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.jobs_dir, job_id)
+
+    def _image_path(self, job_id, index):
+        return os.path.join(self._job_dir(job_id), "images", f"{index}.b64")
+
+    def _image_file_path(self, job_id, index):
+        return os.path.join(self._job_dir(job_id), "images", f"{index}.img")
+
+    def _job_path(self, job_id):
+        return os.path.join(self._job_dir(job_id), "job.json")
+
+    def _tiles_path(self, job_id):
+        return os.path.join(self._job_dir(job_id), "tiles.jsonl")
+
+    def _tile_graph_path(self, job_id, key):
+        # Tile keys are "<image>:<tile>", which is no file name on Windows
+        name = key.replace(":", "-")
+        return os.path.join(self._job_dir(job_id), "graphs", f"{name}.json")
+
+    def create_job(self, image_base64_array, image_name_array, params):
+        job_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self._job_dir(job_id), "images"))
+        for index, image_base64 in enumerate(image_base64_array):
+            with open(self._image_path(job_id, index), "w") as f:
+                f.write(image_base64)
+
+        return self._new_job(job_id, image_name_array, params, IMAGE_BASE64)
+
+    def create_job_from_files(self, image_files, image_name_array, params):
+        # Copied a chunk at a time, so memory use does not grow with the
+        # size or number of the images
+        job_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self._job_dir(job_id), "images"))
+        for index, image_file in enumerate(image_files):
+            with open(self._image_file_path(job_id, index), "wb") as f:
+                shutil.copyfileobj(image_file, f, IMAGE_COPY_CHUNK_SIZE)
+
+        return self._new_job(job_id, image_name_array, params, IMAGE_FILE)
+
+    def _new_job(self, job_id, image_name_array, params, image_format):
+        job = {
+            "job_id": job_id,
+            "status": JOB_QUEUED,
+            "stage": None,
+            "error": None,
+            "attempts": 0,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "image_names": list(image_name_array),
+            "image_format": image_format,
+            "params": params,
+            "timings": {},
+            "tiles": {},
+            # Log lines of the job carry the id of the request that created it
+            "request_id": request_id_var.get(),
+        }
+        self.save(job)
+        return job
+
+    def load_image(self, job, index):
+        with open(self._image_path(job["job_id"], index), "r") as f:
+            return f.read()
+
+    def image_file_path(self, job, index):
+        return self._image_file_path(job["job_id"], index)
+
+    def _remember(self, job):
+        # Called with self.lock held
+        job_id = job["job_id"]
+        self.jobs[job_id] = job
+        self.jobs.move_to_end(job_id)
+        if len(self.jobs) <= self.cache_size:
+            return
+        for cached_id, cached in list(self.jobs.items()):
+            if len(self.jobs) <= self.cache_size:
+                break
+            # Jobs still queued or running are shared with their worker
+            if cached["status"] in (JOB_COMPLETED, JOB_FAILED):
+                del self.jobs[cached_id]
+                self.mtimes.pop(cached_id, None)
+
+    def _read_mtimes(self, job_id):
+        mtimes = []
+        for path in (self._job_path(job_id), self._tiles_path(job_id)):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def _record_mtimes(self, job_id):
+        with self.lock:
+            self.mtimes[job_id] = self._read_mtimes(job_id)
+
+    def _prepare_save(self, job):
+        # The job.json body, serialized now so that later changes to the job
+        # do not race the write
+        with self.lock:
+            self._remember(job)
+            save = self.saves.get(job["job_id"], 0) + 1
+            self.saves[job["job_id"]] = save
+        body = json.dumps({k: v for k, v in job.items() if k != "tiles"})
+        return job["job_id"], body, save
+
+    def _write_job(self, job_id, body, save):
+        path = self._job_path(job_id)
+        # Unique per process and thread, workers may save the same job
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(body)
+        with self.lock:
+            if save < self.written.get(job_id, 0):
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, path)
+            self.written[job_id] = save
+        self._record_mtimes(job_id)
+
+    def _prepare_tiles(self, job, fields_by_key):
+        with self.lock:
+            self._remember(job)
+        lines = []
+        for key, fields in fields_by_key.items():
+            job["tiles"].setdefault(key, {}).update(fields)
+            lines.append(json.dumps({"key": key, **fields}) + "\n")
+        return "".join(lines)
+
+    def _append_tiles(self, job_id, lines):
+        with self.lock:
+            with open(self._tiles_path(job_id), "a") as f:
+                f.write(lines)
+        self._record_mtimes(job_id)
+
+    def _read_tiles(self, job_id):
+        # The last fields written for each tile. A line another process is
+        # still writing is left out
+        tiles = {}
+        try:
+            with open(self._tiles_path(job_id), "r") as f:
+                for line in f:
+                    try:
+                        fields = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    tiles.setdefault(fields.pop("key"), {}).update(fields)
+        except FileNotFoundError:
+            pass
+        return tiles
+
+    def save(self, job):
+        self._write_job(*self._prepare_save(job))
+
+    async def save_async(self, job):
+        await asyncio.to_thread(self._write_job, *self._prepare_save(job))
+
+    def get(self, job_id):
+        mtimes = self._read_mtimes(job_id)
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and (
+                mtimes[0] is None or self.mtimes.get(job_id) == mtimes
+            ):
+                self.jobs.move_to_end(job_id)
+                return job
+        if mtimes[0] is None:
+            return None
+
+        try:
+            with open(self._job_path(job_id), "r") as f:
+                loaded = json.load(f)
+        except FileNotFoundError:
+            return None
+        loaded["tiles"] = self._read_tiles(job_id)
+        with self.lock:
+            self._remember(loaded)
+            self.mtimes[job_id] = mtimes
+        return loaded
+
+    async def get_async(self, job_id):
+        return await asyncio.to_thread(self.get, job_id)
+
+    def _get_status(self, job_id):
+        # (status, finished_at) from job.json, read only when it changed
+        try:
+            mtime = os.stat(self._job_path(job_id)).st_mtime_ns
+        except OSError:
+            return None, None
+        cached = self.statuses.get(job_id)
+        if cached is None or cached[0] != mtime:
+            try:
+                with open(self._job_path(job_id), "r") as f:
+                    job = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                return None, None
+            cached = (mtime, job["status"], job.get("finished_at"))
+            self.statuses[job_id] = cached
+        return cached[1], cached[2]
+
+    def _job_ids(self):
+        return [
+            entry
+            for entry in sorted(os.listdir(self.jobs_dir))
+            if entry != UPLOAD_LOCK_FILE
+        ]
+
+    def unfinished_job_ids(self):
+        return [
+            job_id
+            for job_id in self._job_ids()
+            if self._get_status(job_id)[0] in (JOB_QUEUED, JOB_RUNNING)
+        ]
+
+    def remove_expired(self, now=None):
+        # Deletes finished jobs older than ttl_seconds with all their files,
+        # returns how many
+        if not self.ttl_seconds:
+            return 0
+        cutoff = (now or time.time()) - self.ttl_seconds
+        removed = 0
+        for job_id in self._job_ids():
+            status, finished_at = self._get_status(job_id)
+            if status not in (JOB_COMPLETED, JOB_FAILED) or not finished_at:
+                continue
+            if finished_at < cutoff:
+                shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
+                with self.lock:
+                    for cache in (self.jobs, self.mtimes, self.saves, self.written):
+                        cache.pop(job_id, None)
+                self.statuses.pop(job_id, None)
+                removed += 1
+        return removed
+
+    def remove_inputs(self, job):
+        # The images and tile graphs of a completed job, which only a retry
+        # would need
+        for name in ("images", "graphs"):
+            shutil.rmtree(
+                os.path.join(self._job_dir(job["job_id"]), name), ignore_errors=True
+            )
+
+    def update(self, job, **fields):
+        job.update(fields)
+        self.save(job)
+
+    async def update_async(self, job, **fields):
+        job.update(fields)
+        await self.save_async(job)
+
+    def update_tile(self, job, key, **fields):
+        self.update_tiles(job, {key: fields})
+
+    async def update_tile_async(self, job, key, **fields):
+        await self.update_tiles_async(job, {key: fields})
+
+    def update_tiles(self, job, fields_by_key):
+        # Several tiles with one write of the tile log
+        self._append_tiles(job["job_id"], self._prepare_tiles(job, fields_by_key))
+
+    async def update_tiles_async(self, job, fields_by_key):
+        lines = self._prepare_tiles(job, fields_by_key)
+        await asyncio.to_thread(self._append_tiles, job["job_id"], lines)
+
+    def save_tile_graph(self, job, key, graph):
+        path = self._tile_graph_path(job["job_id"], key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(graph, f)
+
+    async def save_tile_graph_async(self, job, key, graph):
+        await asyncio.to_thread(self.save_tile_graph, job, key, graph)
+
+    def iter_tile_graphs(self, job):
+        # One at a time, for the tiles whose graph was saved
+        for key in list(job["tiles"]):
+            try:
+                with open(self._tile_graph_path(job["job_id"], key), "r") as f:
+                    yield json.load(f)
+            except FileNotFoundError:
+                continue
+
+
+def get_job_progress(job):
+    tiles = job["tiles"].values()
+    return {
+        "total_tiles": len(job["tiles"]),
+        "completed_tiles": sum(tile["status"] == TILE_COMPLETED for tile in tiles),
+        "failed_tiles": sum(tile["status"] == TILE_FAILED for tile in tiles),
+        "running_tiles": sum(tile["status"] == TILE_RUNNING for tile in tiles),
+    }
+
+
+class JobQueue:
+    # Runs upload jobs in the process holding the upload lock of the job
+    # store. Every process can submit jobs, the lock holder finds the ones
+    # queued elsewhere in the store
+    def __init__(
+        self, store, handler, workers=UPLOAD_WORKERS, poll_seconds=JOB_POLL_SECONDS
+    ):
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.queue = asyncio.Queue()
+        self.tasks = []
+        self.lock_file = None
+        # Jobs queued or running in this process
+        self.pending = set()
+
+    @property
+    def leader(self):
+        return self.lock_file is not None
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._watch())]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    async def submit(self, job_id):
+        job = await self.store.get_async(job_id)
+        await self.store.update_async(
+            job, status=JOB_QUEUED, error=None, finished_at=None
+        )
+        if self.leader:
+            self._enqueue(job_id)
+
+    def _enqueue(self, job_id):
+        if job_id not in self.pending:
+            self.pending.add(job_id)
+            self.queue.put_nowait(job_id)
+
+    def depth(self):
+        return self.queue.qsize()
+
+    async def _watch(self):
+        lock_path = os.path.join(self.store.jobs_dir, UPLOAD_LOCK_FILE)
+        while not self.leader:
+            self.lock_file = try_lock(lock_path)
+            if not self.leader:
+                await asyncio.sleep(self.poll_seconds)
+        logger.info(f"Process {os.getpid()} runs the upload jobs.")
+        self.tasks += [
+            asyncio.create_task(self._worker(i)) for i in range(self.workers)
+        ]
+        # Jobs queued or interrupted by the last shutdown the first time,
+        # after that the ones other processes queued
+        while True:
+            job_ids = await asyncio.to_thread(self.store.unfinished_job_ids)
+            for job_id in job_ids:
+                if job_id not in self.pending:
+                    logger.info(f"Picking up upload job {job_id}.")
+                    job = await self.store.get_async(job_id)
+                    await self.store.update_async(job, status=JOB_QUEUED)
+                    self._enqueue(job_id)
+            removed = await asyncio.to_thread(self.store.remove_expired)
+            if removed:
+                logger.info(f"Removed {removed} expired upload jobs.")
+            await asyncio.sleep(self.poll_seconds)
+
+    async def _worker(self, worker_id):
+        while True:
+            job_id = await self.queue.get()
+            job = await self.store.get_async(job_id)
+            token = request_id_var.set(job.get("request_id") or job_id)
+            logger.info(f"Worker {worker_id} started upload job {job_id}.")
+            try:
+                await self.store.update_async(
+                    job,
+                    status=JOB_RUNNING,
+                    started_at=time.time(),
+                    attempts=job["attempts"] + 1,
+                )
+                await self.handler(job)
+                await self.store.update_async(
+                    job, status=JOB_COMPLETED, stage=None, finished_at=time.time()
+                )
+                await asyncio.to_thread(self.store.remove_inputs, job)
+                logger.info(f"Upload job {job_id} completed.")
+            except Exception as e:
+                logger.error(f"Upload job {job_id} failed: {e}")
+                await self.store.update_async(
+                    job, status=JOB_FAILED, finished_at=time.time(), error=str(e)
+                )
+            finally:
+                request_id_var.reset(token)
+                self.pending.discard(job_id)
+                self.queue.task_done()
@@ -1,53 +1,164 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import (
+    FastAPI,
+    HTTPException,
+    Request,
+    Response,
+    UploadFile,
+    File,
+    Form,
+    Query,
+)
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-import uvicorn
+from fastapi.responses import StreamingResponse, JSONResponse
+from pydantic import BaseModel, Field
 import json
 import logging
+import functools
 from dotenv import load_dotenv
-import concurrent.futures
-from typing import List
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager, aclosing
+from typing import List, Literal, Optional
 
 load_dotenv()
 
-from neo4j_utils import (
-    get_all_nodes_from_neo4j,
-    get_subgraph_from_neo4j,
-    get_fullgraph_from_neo4j,
-    save_to_neo4j,
-    delete_all_from_neo4j,
-    process_edit_graph,
+from storage_utils import (
+    DEFAULT_COLLECTION,
+    GRAPH_PAGE_SIZE,
+    GRAPH_PAGE_MAX_SIZE,
+    graph_caches,
+    get_graph_cache,
+    add_graph_change_listener,
+    share_graph_changes,
+    sync_graph_changes,
+    get_graph_store,
+    GraphWriter,
 )
 from gpt_utils import (
-    get_gpt_response,
-    identify_relevant_nodes_from_user_input,
+    openai_model,
+    llm_dispatcher,
+    get_async_client,
+    close_clients,
+    get_gpt_response_async,
+    stream_gpt_response_async,
+    identify_relevant_nodes_from_user_input_async,
+)
+from cache_utils import TileCache, AnswerCache, get_tile_cache_key
+from search_utils import NodeIndex
+from merge_utils import find_merge_candidates, merge_graph, get_graph_diff
+from stream_utils import (
+    AnswerStreamParser,
+    parse_answer,
+    format_sse_event,
+    format_ndjson_record,
+)
+from compression_utils import (
+    COMPRESS_MIN_BYTES,
+    choose_encoding,
+    compress,
+    compress_stream,
+)
+from prompt_utils import (
+    SummaryCache,
+    serialize_graph,
+    resolve_image_sources,
+    split_history,
+    get_history_block_key,
+    get_query_messages,
 )
-from image_utils import (
-    divide_image_with_adaptive_threshold_base64,
-    encode_image_to_base64,
+from metrics_utils import (
+    registry,
+    span,
+    http_request_duration,
+    request_id_var,
+    new_request_id,
+    RequestIdFilter,
+)
+from job_utils import (
+    JobStore,
+    JobQueue,
+    get_job_progress,
+    IMAGE_FILE,
+    JOB_COMPLETED,
+    JOB_FAILED,
+    TILE_PENDING,
+    TILE_RUNNING,
+    TILE_COMPLETED,
+    TILE_FAILED,
 )
 
-# Configure logging
+# Configure logging, every line carries the id of the request or upload job
+# it belongs to
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
+    format="%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s",
     handlers=[
         logging.StreamHandler(),  # Output to console
         logging.FileHandler("app.log"),  # Output to file
     ],
 )
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
 logger = logging.getLogger(__name__)
 
 
-# Load GPT instructions from file
-image_to_graph_prompt = open("gpt_instructions/image_to_graph.md", "r").read()
-find_relevant_nodes_prompt = open("gpt_instructions/find_relevant_nodes.md", "r").read()
-flowchart_query_prompt = open("gpt_instructions/flowchart_query.md", "r").read()
-merge_nodes_and_fix_graph_prompt = open(
-    "gpt_instructions/merge_nodes_and_fix_graph.md", "r"
-).read()
+# Worker processes serving the app, as uvicorn's --workers. Each has its own
+# graph store and GPT connection pools, and one of them runs the upload jobs
+SERVER_WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# GPT instructions in gpt_instructions/<name>.md
+PROMPTS = (
+    "image_to_graph",
+    "find_relevant_nodes",
+    "flowchart_query",
+    "arbitrate_node_merges",
+    "summarize_conversation",
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_prompt(name):
+    with open(f"gpt_instructions/{name}.md", "r") as file:
+        return file.read()
+
+
+# Filled in by the startup, reported by /readiness
+readiness = {"started": False, "graph_store": None}
 
-app = FastAPI()
+
+async def check_graph_store():
+    # Without the schema name lookups still work in Neo4j, just as label scans
+    try:
+        await get_store().ensure_schema()
+        readiness["graph_store"] = "ok"
+    except Exception as e:
+        logger.error(f"Error applying the {get_store().name} graph schema: {e}")
+        readiness["graph_store"] = str(e)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Clients, files and connections are set up here rather than on import,
+    # so importing the app is cheap and every worker process gets its own
+    if SERVER_WORKERS > 1:
+        share_graph_changes()
+    for name in PROMPTS:
+        get_prompt(name)
+    get_async_client()
+    get_tile_cache()
+    get_answer_cache()
+    await check_graph_store()
+    get_upload_queue().start()
+    readiness["started"] = True
+    yield
+    readiness["started"] = False
+    await get_upload_queue().stop()
+    await get_store().close()
+    await close_clients()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -55,9 +166,38 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
 
+@app.middleware("http")
+async def track_request(request: Request, call_next):
+    # Callers can pass their own id to follow a request across services
+    request_id = request.headers.get("x-request-id") or new_request_id()
+    token = request_id_var.set(request_id)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        # The route template keeps job ids out of the labels
+        route = request.scope.get("route")
+        http_request_duration.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            route=route.path if route else "unmatched",
+            status=status,
+        )
+        request_id_var.reset(token)
+
+
+# Collection ids are used as they are in the graph store and in URLs
+COLLECTION_ID_PATTERN = r"^[A-Za-z0-9_.-]{1,64}$"
+
+
 # Define request and response models
 class FlowchartRequest(BaseModel):
     image_base64_array: List[str]
@@ -65,96 +205,430 @@ class FlowchartRequest(BaseModel):
     rows: int = 2
     cols: int = 2
     overlap: int = 50
+    # "grid" always sends rows x cols tiles, "adaptive" follows the content
+    tiling_mode: Literal["grid", "adaptive"] = "grid"
+    # The flowcharts are added to this collection and merged only within it
+    collection_id: str = Field(DEFAULT_COLLECTION, pattern=COLLECTION_ID_PATTERN)
 
 
 class QueryRequest(BaseModel):
     user_input: str
     conversation_history: list
     use_relevant_context: bool = True
+    collection_id: str = Field(DEFAULT_COLLECTION, pattern=COLLECTION_ID_PATTERN)
 
 
 class GraphEditRequest(BaseModel):
     editedNodes: List[dict] = []
     deletedEdges: List[dict] = []
     addedEdges: List[dict] = []
+    collection_id: str = Field(DEFAULT_COLLECTION, pattern=COLLECTION_ID_PATTERN)
 
 
 class FullGraphResponse(BaseModel):
     full_graph: dict
 
 
+class GraphPageResponse(BaseModel):
+    # next_cursor asks for the page after this one, None after the last
+    nodes: List[dict]
+    relationships: List[dict]
+    next_cursor: Optional[str]
+
+
+class GraphEditResponse(BaseModel):
+    # Graph version after the edit and only the nodes and edges it changed
+    version: int
+    changes: dict
+
+
+class TilePreviewResponse(BaseModel):
+    images: List[dict]
+    total: dict
+
+
+class UploadJobResponse(BaseModel):
+    job_id: str
+    status: str
+
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    status: str
+    stage: Optional[str]
+    error: Optional[str]
+    attempts: int
+    created_at: float
+    started_at: Optional[float]
+    finished_at: Optional[float]
+    image_names: List[str]
+    params: dict
+    progress: dict
+    timings: dict
+    request_id: Optional[str] = None
+    write_stats: Optional[dict] = None
+
+
+class JobTilesResponse(BaseModel):
+    tiles: List[dict]
+
+
 class QueryResponse(BaseModel):
     response: str
     image_names: List[str]
     relevant_subgraph: dict
 
 
-def get_relevant_subgraph_from_neo4j(user_input):
-    nodes = get_all_nodes_from_neo4j()
-    logger.debug(f"Nodes in Neo4j: {[node['name'] for node in nodes]}")
+# Created on first use, or when the backend starts, so importing the app
+# opens no store, cache file or jobs directory and every worker process gets
+# its own. The graph store is Neo4j or the embedded SQLite store, picked by
+# GRAPH_STORE
+graph_store = None
+tile_cache = None
+answer_cache = None
 
-    relevant_nodes = identify_relevant_nodes_from_user_input(
-        user_input, nodes, find_relevant_nodes_prompt
-    )
+
+def get_store():
+    global graph_store
+    if graph_store is None:
+        graph_store = get_graph_store()
+    return graph_store
+
+
+def get_tile_cache():
+    global tile_cache
+    if tile_cache is None:
+        tile_cache = TileCache()
+    return tile_cache
+
+
+def get_answer_cache():
+    global answer_cache
+    if answer_cache is None:
+        answer_cache = AnswerCache()
+    return answer_cache
+
+
+# Upper bound on image sections in flight at the same time, GPT calls among
+# them are further limited by the dispatcher in gpt_utils
+MAX_PARALLEL_SECTIONS = int(
+    os.getenv("MAX_PARALLEL_SECTIONS", str(min(32, (os.cpu_count() or 1) + 4)))
+)
+
+
+# Number of seed nodes taken from the search index for each query
+RELEVANT_NODES_TOP_K = int(os.getenv("RELEVANT_NODES_TOP_K", "15"))
+# Let GPT re-rank the seed nodes, costs one extra GPT call per query
+RELEVANT_NODES_RERANK = os.getenv("RELEVANT_NODES_RERANK", "false").lower() == "true"
+# How far from the seed nodes the query context reaches: hops, edge direction
+# ("out", "in" or "both") and a cap on the size of the context sent to GPT
+SUBGRAPH_HOPS = int(os.getenv("SUBGRAPH_HOPS", "2"))
+SUBGRAPH_DIRECTION = os.getenv("SUBGRAPH_DIRECTION", "both")
+SUBGRAPH_MAX_NODES = int(os.getenv("SUBGRAPH_MAX_NODES", "150"))
+SUBGRAPH_MAX_EDGES = int(os.getenv("SUBGRAPH_MAX_EDGES", "300"))
+
+# Search index over the nodes of each collection, built on first use
+node_indexes = {}
+summary_cache = SummaryCache()
+
+
+def get_node_index(collection):
+    node_index = node_indexes.get(collection)
+    if node_index is None:
+        node_index = node_indexes.setdefault(collection, NodeIndex())
+    return node_index
+
+
+def apply_graph_change(change):
+    # The graph cache has already moved to the new version
+    collection = change.get("collection")
+    if collection is None:
+        for node_index in list(node_indexes.values()):
+            node_index.apply_change(change)
+        get_answer_cache().invalidate(None, None)
+        return
+    get_node_index(collection).apply_change(change)
+    get_answer_cache().invalidate(collection, get_graph_cache(collection).version)
+
+
+add_graph_change_listener(apply_graph_change)
+
+
+async def ensure_node_index(collection):
+    node_index = get_node_index(collection)
+    if not node_index.ready:
+        nodes = await get_store().get_all_nodes(collection)
+        logger.debug(f"Nodes in Neo4j: {[node['name'] for node in nodes]}")
+        await asyncio.to_thread(node_index.build, nodes)
+    return node_index
+
+
+async def get_relevant_subgraph_from_neo4j(user_input, collection):
+    node_index = await ensure_node_index(collection)
+
+    seed_nodes = node_index.search(user_input, RELEVANT_NODES_TOP_K)
+    logger.info(f"Seed nodes from search index: {seed_nodes}")
+    relevant_nodes = [name for name, _ in seed_nodes]
+
+    if RELEVANT_NODES_RERANK and relevant_nodes:
+        reranked_nodes = await identify_relevant_nodes_from_user_input_async(
+            user_input,
+            node_index.get_nodes(relevant_nodes),
+            get_prompt("find_relevant_nodes"),
+        )
+        # Only trust names that were actually offered to GPT
+        reranked_nodes = [name for name in reranked_nodes if name in relevant_nodes]
+        if reranked_nodes:
+            relevant_nodes = reranked_nodes
     logger.info(f"Relevant nodes based on user input: {relevant_nodes}")
 
+    snapshot = await get_store().get_snapshot(collection)
     if len(relevant_nodes) == 0:
-        relevant_nodes = [node["name"] for node in nodes]
+        # A broad question ("what does this flowchart do?") names no node, it
+        # gets the best connected nodes and the edges between them, capped as
+        # any other subgraph rather than the whole graph
+        hub_nodes = snapshot.get_hub_names(SUBGRAPH_MAX_NODES)
+        logger.info(f"No seed nodes, using the {len(hub_nodes)} best connected.")
+        return snapshot.get_subgraph(
+            hub_nodes,
+            hops=1,
+            max_nodes=SUBGRAPH_MAX_NODES,
+            max_edges=SUBGRAPH_MAX_EDGES,
+        )
 
-    subgraph = get_subgraph_from_neo4j(relevant_nodes)
-    logger.debug(f"Subgraph from Neo4j based on relevant nodes: {subgraph}")
+    subgraph = snapshot.get_subgraph(
+        relevant_nodes,
+        hops=SUBGRAPH_HOPS,
+        direction=SUBGRAPH_DIRECTION,
+        max_nodes=SUBGRAPH_MAX_NODES,
+        max_edges=SUBGRAPH_MAX_EDGES,
+    )
+    logger.debug(f"Subgraph based on relevant nodes: {subgraph}")
 
     return subgraph
 
 
-def process_query(user_input, conversation_history, use_relevant_context):
-    logger.info("Querying GPT with user input.")
-    relevant_subgraph = (
-        get_relevant_subgraph_from_neo4j(user_input)
-        if use_relevant_context
-        else get_fullgraph_from_neo4j()
-    )
+async def get_query_subgraph(user_input, use_relevant_context, collection):
+    with span("query.subgraph", collection=collection):
+        relevant_subgraph = (
+            await get_relevant_subgraph_from_neo4j(user_input, collection)
+            if use_relevant_context
+            else (await get_store().get_snapshot(collection)).to_graph()
+        )
     logger.debug(f"Relevant subgraph from Neo4j: {relevant_subgraph}")
+    return relevant_subgraph
 
-    messages = [
-        {
-            "role": "system",
-            "content": flowchart_query_prompt,
-        },
-        {
-            "role": "user",
-            "content": "Here is the data for a flowchart: "
-            + json.dumps(relevant_subgraph),
-        },
-    ]
 
-    conversation_history = (
-        messages
-        + conversation_history[-10:]
-        + [{"role": "user", "content": user_input}]
+async def summarize_history_block(block):
+    key = get_history_block_key(block)
+    summary = summary_cache.get(key)
+    if summary is not None:
+        return summary
+
+    transcript = "\n".join(
+        f"{message['role']}: "
+        + (
+            parse_answer(message["content"])[0]
+            if message["role"] == "assistant"
+            else message["content"]
+        )
+        for message in block
+    )
+    try:
+        summary = await get_gpt_response_async(
+            [
+                {"role": "system", "content": get_prompt("summarize_conversation")},
+                {"role": "user", "content": transcript},
+            ],
+            caller="summary",
+        )
+    except Exception as e:
+        # Without a summary the block is left out, as it was before
+        logger.error(f"Error summarizing conversation history: {e}")
+        return None
+    if summary:
+        summary_cache.set(key, summary)
+    return summary
+
+
+async def build_query_messages(
+    user_input, conversation_history, relevant_subgraph, use_relevant_context
+):
+    # Returns the messages for GPT and the image name behind each image id
+    blocks, recent_history = split_history(conversation_history)
+    with span("query.summaries", blocks=len(blocks)):
+        summaries = await asyncio.gather(
+            *[summarize_history_block(block) for block in blocks]
+        )
+    with span("query.prompt"):
+        graph_text, image_names = await asyncio.to_thread(
+            serialize_graph, relevant_subgraph
+        )
+    messages = get_query_messages(
+        get_prompt("flowchart_query"),
+        user_input,
+        [summary for summary in summaries if summary],
+        recent_history,
+        graph_text,
+        # The full graph is the same for every question until the next write
+        stable_graph=not use_relevant_context,
+    )
+
+    logger.debug(f"Conversation history: {messages}")
+    return messages, image_names
+
+
+async def process_query(
+    user_input, conversation_history, use_relevant_context, collection
+):
+    sync_graph_changes()
+    version = get_graph_cache(collection).version
+    cache_key = (
+        user_input,
+        collection,
+        version,
+        conversation_history,
+        use_relevant_context,
     )
+    cached = get_answer_cache().get(*cache_key)
+    if cached is not None:
+        logger.info("Answering query from the answer cache.")
+        return cached
 
-    logger.debug(f"Conversation history: {conversation_history}")
+    logger.info("Querying GPT with user input.")
+    relevant_subgraph = await get_query_subgraph(
+        user_input, use_relevant_context, collection
+    )
+    conversation_history, image_names = await build_query_messages(
+        user_input, conversation_history, relevant_subgraph, use_relevant_context
+    )
 
-    response = get_gpt_response(conversation_history)
+    with span("query.answer"):
+        response = await get_gpt_response_async(conversation_history, caller="query")
 
+    # Nothing to answer with, GPT is the upstream that failed
     if response is None:
-        return None, relevant_subgraph
+        raise HTTPException(status_code=502, detail="No valid response from GPT.")
 
     conversation_history.append({"role": "assistant", "content": response})
     logger.info(response)
 
+    text, image_sources = parse_answer(response)
+    answer = (
+        text,
+        resolve_image_sources(image_sources, image_names),
+        relevant_subgraph,
+    )
+    get_answer_cache().put(*cache_key, answer)
+    return answer
+
+
+async def stream_query(
+    user_input, conversation_history, use_relevant_context, collection
+):
+    # Server-sent events: the subgraph the answer is based on, then the answer
+    # text and image names as GPT writes them, then the complete answer
     try:
-        response = json.loads(response)
-    except json.JSONDecodeError:
-        response = {"text": response, "imageSources": []}
+        sync_graph_changes()
+        version = get_graph_cache(collection).version
+        cache_key = (
+            user_input,
+            collection,
+            version,
+            conversation_history,
+            use_relevant_context,
+        )
+        cached = get_answer_cache().get(*cache_key)
+        if cached is not None:
+            logger.info("Answering query from the answer cache.")
+            text, image_names, relevant_subgraph = cached
+            yield format_sse_event("subgraph", {"relevant_subgraph": relevant_subgraph})
+            yield format_sse_event("token", {"text": text})
+            for image_name in image_names:
+                yield format_sse_event("image", {"image_name": image_name})
+            yield format_sse_event(
+                "done", {"response": text, "image_names": image_names}
+            )
+            return
 
-    return response["text"], response["imageSources"], relevant_subgraph
+        relevant_subgraph = await get_query_subgraph(
+            user_input, use_relevant_context, collection
+        )
+        yield format_sse_event("subgraph", {"relevant_subgraph": relevant_subgraph})
 
+        messages, image_ids = await build_query_messages(
+            user_input, conversation_history, relevant_subgraph, use_relevant_context
+        )
+        parser = AnswerStreamParser()
+        image_names = set()
+        # Includes the time the client takes to read the events
+        with span("query.answer", streamed=True):
+            async with aclosing(
+                stream_gpt_response_async(messages, caller="query")
+            ) as chunks:
+                async for chunk in chunks:
+                    text, new_image_names = parser.feed(chunk)
+                    if text:
+                        yield format_sse_event("token", {"text": text})
+                    for image_name in resolve_image_sources(new_image_names, image_ids):
+                        if image_name not in image_names:
+                            image_names.add(image_name)
+                            yield format_sse_event("image", {"image_name": image_name})
+
+        text, image_names = parser.result()
+        image_names = resolve_image_sources(image_names, image_ids)
+        get_answer_cache().put(*cache_key, (text, image_names, relevant_subgraph))
+        logger.info(text)
+        yield format_sse_event("done", {"response": text, "image_names": image_names})
+    except Exception as e:
+        # The status code has already been sent, so errors become an event
+        logger.error(f"Error streaming GPT answer: {e}")
+        yield format_sse_event("error", {"detail": str(e)})
+
+
+def iter_job_tiles(job, index, rows, cols, overlap, tiling_mode):
+    # Imported here so that only the process running uploads loads OpenCV
+    # and NumPy
+    from image_utils import iter_encoded_tiles, iter_encoded_tiles_file
+
+    # An image is only read from the job directory when its turn comes, so
+    # one image at a time is in memory however many the upload has
+    if job.get("image_format") == IMAGE_FILE:
+        yield from iter_encoded_tiles_file(
+            get_job_store().image_file_path(job, index),
+            rows,
+            cols,
+            overlap,
+            tiling_mode,
+        )
+    else:
+        yield from iter_encoded_tiles(
+            get_job_store().load_image(job, index), rows, cols, overlap, tiling_mode
+        )
 
-def convert_image_section_to_graph(image_section, section_coordinates):
+
+async def iter_encoded_tiles_async(job, index, rows, cols, overlap, tiling_mode):
+    # Reading, decoding, thresholding and encoding are blocking or CPU bound,
+    # so the tile generator is advanced in a worker thread and each tile is
+    # handed over once ready
+    tiles = iter_job_tiles(job, index, rows, cols, overlap, tiling_mode)
+    while True:
+        tile = await asyncio.to_thread(next, tiles, None)
+        if tile is None:
+            return
+        yield tile
+
+
+async def convert_image_section_to_graph(encoded_image, section_coordinates):
     logger.debug("Sending image section to GPT.")
-    encoded_image = encode_image_to_base64(image_section)
+
+    # The same tile from a re-uploaded image gives the same graph, skip GPT for it
+    image_to_graph_prompt = get_prompt("image_to_graph")
+    cache_key = get_tile_cache_key(encoded_image, image_to_graph_prompt, openai_model)
+    cached_response = await asyncio.to_thread(get_tile_cache().get, cache_key)
+    if cached_response is not None:
+        logger.debug("Using cached graph for image section.")
+        return cached_response
 
     messages = [
         {
@@ -176,173 +650,691 @@ def convert_image_section_to_graph(image_section, section_coordinates):
         },
     ]
 
-    return get_gpt_response(messages)
-
-
-def fix_and_recreate_graph():
+    response = await get_gpt_response_async(messages, caller="tile")
 
-    current_graph = get_fullgraph_from_neo4j()
-
-    # Send the graph to GPT to merge similar nodes
-    messages = [
-        {
-            "role": "system",
-            "content": merge_nodes_and_fix_graph_prompt,
-        },
-        {
-            "role": "user",
-            "content": json.dumps(current_graph),
-        },
+    # Only cache responses that can be used, so a bad answer is retried next time
+    try:
+        json.loads(response)
+        await asyncio.to_thread(get_tile_cache().put, cache_key, response)
+    except (TypeError, json.JSONDecodeError):
+        pass
+
+    return response
+
+
+# Ambiguous merge groups sent to GPT in one call
+MERGE_ARBITRATION_BATCH_SIZE = int(os.getenv("MERGE_ARBITRATION_BATCH_SIZE", "20"))
+
+
+async def arbitrate_merge_groups(groups, nodes):
+    # GPT only sees the groups the local matcher was unsure about, and only
+    # names it was offered are merged
+    async def arbitrate_batch(batch):
+        messages = [
+            {
+                "role": "system",
+                "content": get_prompt("arbitrate_node_merges"),
+            },
+            {
+                "role": "user",
+                "content": json.dumps(
+                    [
+                        [
+                            {"name": name, "context": nodes[name].get("context")}
+                            for name in group
+                        ]
+                        for group in batch
+                    ]
+                ),
+            },
+        ]
+        response = await get_gpt_response_async(messages, caller="merge")
+        try:
+            merges = json.loads(response)
+        except (TypeError, json.JSONDecodeError):
+            logger.warning("Invalid merge arbitration response from GPT, skipping.")
+            return []
+
+        offered = {name for group in batch for name in group}
+        return [
+            [name for name in merge if name in offered]
+            for merge in merges
+            if isinstance(merge, list)
+        ]
+
+    batches = [
+        groups[i : i + MERGE_ARBITRATION_BATCH_SIZE]
+        for i in range(0, len(groups), MERGE_ARBITRATION_BATCH_SIZE)
     ]
+    results = await asyncio.gather(*[arbitrate_batch(batch) for batch in batches])
+    return [merge for result in results for merge in result if len(merge) > 1]
+
+
+async def fix_uploaded_graph(touched_names, collection):
+    # Only the nodes this upload wrote are checked for duplicates, against the
+    # node names of its collection, and only they, their merge partners and
+    # their neighbours are read back and rewritten
+    sync_graph_changes()
+    node_index = await ensure_node_index(collection)
+    with span("merge.match", touched=len(touched_names)):
+        groups, ambiguous_groups = await asyncio.to_thread(
+            find_merge_candidates, node_index.names(), touched_names
+        )
+    logger.info(
+        f"Found {len(groups)} node groups to merge and {len(ambiguous_groups)} ambiguous groups."
+    )
+    if not groups and not ambiguous_groups:
+        logger.info("Nothing to merge in the graph.")
+        return
+
+    scope = list(
+        set(touched_names)
+        .union(*groups, *ambiguous_groups)
+        .intersection(node_index.names())
+    )
+    current_graph = await get_store().get_neighbourhood(scope, collection)
+    if ambiguous_groups:
+        nodes = {node["name"]: node for node in current_graph["nodes"]}
+        ambiguous_groups = [
+            [name for name in group if name in nodes] for group in ambiguous_groups
+        ]
+        ambiguous_groups = [group for group in ambiguous_groups if len(group) > 1]
+        with span("merge.arbitrate", groups=len(ambiguous_groups)):
+            groups += await arbitrate_merge_groups(ambiguous_groups, nodes)
+
+    with span("merge.apply", groups=len(groups)):
+        new_graph, renamed = await asyncio.to_thread(merge_graph, current_graph, groups)
+        diff = get_graph_diff(current_graph, new_graph, renamed)
+        await get_store().apply_diff(diff, collection)
+
+
+def normalize_section_graph(graph, image_name):
+    for node in graph["nodes"]:
+        node["imageSources"] = [image_name]
+        if not node["context"]:
+            node["context"] = []
+        else:
+            node["context"] = [node["context"]]
+    for relationship in graph["relationships"]:
+        relationship["imageSources"] = [image_name]
+        if not relationship["context"]:
+            relationship["context"] = []
+        else:
+            relationship["context"] = [relationship["context"]]
+    return graph
+
+
+async def process_flowchart_images(job):
+    logger.info(f"Processing flowchart with GPT for job {job['job_id']}.")
+    rows = job["params"]["rows"]
+    cols = job["params"]["cols"]
+    overlap = job["params"]["overlap"]
+    tiling_mode = job["params"].get("tiling_mode", "grid")
+    # Jobs from before collections existed went into the default one
+    collection = job["params"].get("collection_id", DEFAULT_COLLECTION)
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_SECTIONS)
+    # Time each tile started, to time it up to the save of its graph
+    tile_starts = {}
+
+    async def complete_tiles(keys, error):
+        # Tiles are only done once the writer has saved their graphs, so a
+        # retry of the job redoes the ones that were never saved
+        now = time.perf_counter()
+        fields = {"status": TILE_FAILED, "error": str(error)} if error else {}
+        await get_job_store().update_tiles_async(
+            job,
+            {
+                key: {
+                    "status": TILE_COMPLETED,
+                    **fields,
+                    "duration_seconds": now - tile_starts[key],
+                }
+                for key in keys
+            },
+        )
 
-    # Retry upto 3 times
-    # If the response is not a valid JSON, retry
-    # Also if all nodes in relationships are not present in the nodes, retry
-    for i in range(3):
-        logger.debug(f"Fixing graph attempt {i + 1}.")
-        response = get_gpt_response(messages)
+    async def process_section(key, encoded_image, coord, image_name):
+        # The slot was taken before the task was created and is given back here
         try:
-            new_graph = json.loads(response)
-
-            # Check if all nodes(from/to) in relationships are present in the nodes(name)
-            node_names = [node["name"] for node in new_graph["nodes"]]
-            relationship_nodes = [
-                relationship["from"] for relationship in new_graph["relationships"]
-            ] + [relationship["to"] for relationship in new_graph["relationships"]]
-            if all(node in node_names for node in relationship_nodes):
-                # Delete the current graph from Neo4j
-                delete_all_from_neo4j()
-                # Save the new graph to Neo4j
-                save_to_neo4j(new_graph)
-                logger.info("New graph saved to Neo4j.")
-                return new_graph
-            # If i is 2, then it is the last iteration
-            # Raise an exception if the graph is still not valid
-            if i == 2:
-                raise ValueError("Invalid graph response from GPT after 3 attempts.")
-
-        except json.JSONDecodeError:
-            continue
-
-
-def process_flowchart_images(
-    image_base64_arr, image_name_array, rows=2, cols=2, overlap=50
-):
-    logger.info("Processing flowchart with GPT.")
-
-    def process_section(section, coord, image_name):
-        gpt_response = convert_image_section_to_graph(section, coord)
-        if gpt_response:
-            graph = json.loads(gpt_response)
-
-            for node in graph["nodes"]:
-                node["imageSources"] = [image_name]
-                if not node["context"]:
-                    node["context"] = []
-                else:
-                    node["context"] = [node["context"]]
-            for relationship in graph["relationships"]:
-                relationship["imageSources"] = [image_name]
-                if not relationship["context"]:
-                    relationship["context"] = []
-                else:
-                    relationship["context"] = [relationship["context"]]
-
-            save_to_neo4j(graph)
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for index, image_base64 in enumerate(image_base64_arr):
-            sections, coordinates = divide_image_with_adaptive_threshold_base64(
-                image_base64, rows, cols, overlap
+            await get_job_store().update_tile_async(
+                job, key, status=TILE_RUNNING, started_at=time.time(), error=None
             )
-            for i, (section, coord) in enumerate(zip(sections, coordinates)):
-                logger.info(
-                    f"Submitting section {i + 1} of image {image_name_array[index]} for processing."
+            start = tile_starts[key] = time.perf_counter()
+            try:
+                with span("upload.tile", tile=key):
+                    with span("upload.tile.gpt", tile=key):
+                        gpt_response = await convert_image_section_to_graph(
+                            encoded_image, coord
+                        )
+                    graph = None
+                    if gpt_response:
+                        graph = normalize_section_graph(
+                            json.loads(gpt_response), image_name
+                        )
+            except Exception as e:
+                await get_job_store().update_tile_async(
+                    job,
+                    key,
+                    status=TILE_FAILED,
+                    duration_seconds=time.perf_counter() - start,
+                    error=str(e),
                 )
-                futures.append(
-                    executor.submit(
-                        process_section, section, coord, image_name_array[index]
+                raise
+            if not graph:
+                await complete_tiles([key], None)
+                return
+            await get_job_store().save_tile_graph_async(job, key, graph)
+            # Waits while the writer is behind, which holds back new GPT calls
+            with span("upload.tile.queue", tile=key):
+                await writer.put(key, graph)
+        finally:
+            semaphore.release()
+
+    await get_job_store().update_async(job, stage="extracting")
+    extract_start = time.perf_counter()
+    tasks = []
+    # One writer saves the graphs of all tiles, coalesced into batches
+    writer = GraphWriter(get_store(), complete_tiles, collection=collection)
+    writer.start()
+    with span("upload.extract", level=logging.INFO, job=job["job_id"]):
+        try:
+            for index, image_name in enumerate(job["image_names"]):
+                i = 0
+                async for encoded_image, coord in iter_encoded_tiles_async(
+                    job, index, rows, cols, overlap, tiling_mode
+                ):
+                    key = f"{index}:{i}"
+                    i += 1
+                    tile = job["tiles"].get(key)
+                    # Tiles finished by an earlier attempt are already in Neo4j
+                    if tile and tile["status"] == TILE_COMPLETED:
+                        continue
+                    await get_job_store().update_tile_async(
+                        job,
+                        key,
+                        image_name=image_name,
+                        coordinates=list(coord),
+                        status=TILE_PENDING,
+                    )
+                    # Waiting for a free slot before asking for the next tile
+                    # keeps the encoded tiles in memory to the ones being
+                    # processed and the TILE_ENCODE_AHEAD being encoded
+                    await semaphore.acquire()
+                    logger.info(
+                        f"Submitting section {i} of image {image_name} for processing."
+                    )
+                    tasks.append(
+                        asyncio.create_task(
+                            process_section(key, encoded_image, coord, image_name)
+                        )
                     )
-                )
 
-        for future in concurrent.futures.as_completed(futures):
-            future.result()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            write_stats = await writer.close()
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.cancel()
+    job["timings"]["extract_seconds"] = time.perf_counter() - extract_start
+    await get_job_store().update_async(job, write_stats=write_stats)
+    logger.info(
+        f"Saved {write_stats['graphs']} tile graphs in {write_stats['flushes']} batches "
+        f"and {write_stats['transactions']} transactions."
+    )
+
+    failed = [result for result in results if isinstance(result, Exception)]
+    if failed or writer.errors:
+        raise RuntimeError(
+            f"{len(failed) + write_stats['failed']} of {len(results)} image sections failed, "
+            f"first error: {(failed + writer.errors)[0]}"
+        )
 
     logger.info("Flowchart processing complete.")
 
     # Analyze the full graph and merge nodes with similar names
-    return fix_and_recreate_graph()
+    await get_job_store().update_async(job, stage="merging")
+    merge_start = time.perf_counter()
+    touched_names = await asyncio.to_thread(get_touched_names, job)
+    with span("upload.merge", level=logging.INFO, job=job["job_id"]):
+        await fix_uploaded_graph(touched_names, collection)
+    job["timings"]["merge_seconds"] = time.perf_counter() - merge_start
+
+
+def get_touched_names(job):
+    # Node names in the tile graphs of this job, read a tile at a time
+    return {
+        node["name"]
+        for graph in get_job_store().iter_tile_graphs(job)
+        for node in ((graph or {}).get("nodes") or [])
+    }
+
+
+job_store = None
+upload_queue = None
+
 
+def get_job_store():
+    global job_store
+    if job_store is None:
+        job_store = JobStore()
+    return job_store
 
-@app.post("/upload", response_model=FullGraphResponse)
+
+def get_upload_queue():
+    global upload_queue
+    if upload_queue is None:
+        upload_queue = JobQueue(get_job_store(), process_flowchart_images)
+    return upload_queue
+
+
+def get_hit_rate(cache):
+    # The metrics do not create a cache that has not been used yet
+    if cache is None:
+        return 0.0
+    lookups = cache.hits + cache.misses
+    return cache.hits / lookups if lookups else 0.0
+
+
+registry.gauge(
+    "upload_queue_depth",
+    "Upload jobs waiting for a worker.",
+    callback=lambda: get_upload_queue().depth() if upload_queue else 0,
+)
+registry.gauge(
+    "graph_version",
+    "Writes to the graph, the versions of all collections added up.",
+    callback=lambda: sum(cache.version for cache in list(graph_caches.values())),
+)
+registry.gauge(
+    "tile_cache_hit_rate",
+    "Share of tile lookups answered from the tile cache.",
+    callback=lambda: get_hit_rate(tile_cache),
+)
+registry.gauge(
+    "answer_cache_hit_rate",
+    "Share of queries answered from the answer cache.",
+    callback=lambda: get_hit_rate(answer_cache),
+)
+
+
+def get_job_status(job):
+    # Polled while the upload runs, so it leaves out the tiles and the graph,
+    # which have endpoints of their own
+    return {
+        **{key: value for key, value in job.items() if key != "tiles"},
+        "progress": get_job_progress(job),
+    }
+
+
+@app.post("/upload", response_model=UploadJobResponse, status_code=202)
 async def upload_flowchart(request: FlowchartRequest):
     try:
         logger.info("Received request to process flowchart.")
-        response = process_flowchart_images(
+        if len(request.image_base64_array) != len(request.image_name_array):
+            raise ValueError("Each image needs a matching image name.")
+        job = get_job_store().create_job(
             request.image_base64_array,
             request.image_name_array,
-            request.rows,
-            request.cols,
-            request.overlap,
+            {
+                "rows": request.rows,
+                "cols": request.cols,
+                "overlap": request.overlap,
+                "tiling_mode": request.tiling_mode,
+                "collection_id": request.collection_id,
+            },
         )
-        return {"full_graph": response}
+        await get_upload_queue().submit(job["job_id"])
+        return {"job_id": job["job_id"], "status": job["status"]}
     except Exception as e:
         logger.error(f"Error processing flowchart: {e}")
         raise HTTPException(status_code=400, detail=str(e))
 
 
+@app.post("/upload/files", response_model=UploadJobResponse, status_code=202)
+async def upload_flowchart_files(
+    images: List[UploadFile] = File(...),
+    image_names: Optional[List[str]] = Form(None),
+    rows: int = Form(2),
+    cols: int = Form(2),
+    overlap: int = Form(50),
+    tiling_mode: Literal["grid", "adaptive"] = Form("grid"),
+    collection_id: str = Form(DEFAULT_COLLECTION, pattern=COLLECTION_ID_PATTERN),
+):
+    # The same job as /upload with the images sent as multipart files rather
+    # than base64 text in JSON. Starlette spools the files to disk while
+    # parsing the body and they are copied into the job from there, so memory
+    # use does not depend on the size of the upload
+    try:
+        logger.info("Received request to process flowchart files.")
+        image_names = image_names or [image.filename for image in images]
+        if len(images) != len(image_names):
+            raise ValueError("Each image needs a matching image name.")
+        job = await asyncio.to_thread(
+            get_job_store().create_job_from_files,
+            [image.file for image in images],
+            image_names,
+            {
+                "rows": rows,
+                "cols": cols,
+                "overlap": overlap,
+                "tiling_mode": tiling_mode,
+                "collection_id": collection_id,
+            },
+        )
+        await get_upload_queue().submit(job["job_id"])
+        return {"job_id": job["job_id"], "status": job["status"]}
+    except Exception as e:
+        logger.error(f"Error processing flowchart files: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/tiles/preview", response_model=TilePreviewResponse)
+async def preview_tiles(request: FlowchartRequest):
+    # Number of GPT calls each tiling mode would make, without making them.
+    # Loads the image stack in the worker serving it
+    from image_utils import count_tiles_base64, TILING_MODES
+
+    try:
+        logger.info("Received request to preview tiling.")
+        images = []
+        for image_base64, image_name in zip(
+            request.image_base64_array, request.image_name_array
+        ):
+            counts = await asyncio.to_thread(
+                count_tiles_base64,
+                image_base64,
+                request.rows,
+                request.cols,
+                request.overlap,
+            )
+            images.append({"image_name": image_name, **counts})
+        total = {mode: sum(image[mode] for image in images) for mode in TILING_MODES}
+        return {"images": images, "total": total}
+    except Exception as e:
+        logger.error(f"Error previewing tiles: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def get_existing_job(job_id):
+    job = await get_job_store().get_async(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+
+@app.get("/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_job(job_id: str):
+    return get_job_status(await get_existing_job(job_id))
+
+
+@app.get("/jobs/{job_id}/tiles", response_model=JobTilesResponse)
+async def get_job_tiles(job_id: str):
+    job = await get_existing_job(job_id)
+    return {"tiles": [{"key": key, **tile} for key, tile in job["tiles"].items()]}
+
+
+@app.get("/jobs/{job_id}/graph", response_model=FullGraphResponse)
+async def get_job_graph(request: Request, job_id: str):
+    # The graph of the collection the job uploaded into, as /fullgraph
+    job = await get_existing_job(job_id)
+    if job["status"] != JOB_COMPLETED:
+        raise HTTPException(status_code=409, detail="The job has not completed.")
+    collection = job["params"].get("collection_id", DEFAULT_COLLECTION)
+    return await get_fullgraph(request, collection)
+
+
+@app.post("/jobs/{job_id}/retry", response_model=UploadJobResponse, status_code=202)
+async def retry_job(job_id: str):
+    job = await get_existing_job(job_id)
+    if job["status"] != JOB_FAILED:
+        raise HTTPException(status_code=409, detail="Only failed jobs can be retried.")
+    logger.info(f"Retrying upload job {job_id}.")
+    await get_upload_queue().submit(job_id)
+    return {"job_id": job_id, "status": job["status"]}
+
+
 @app.post("/query", response_model=QueryResponse)
 async def query(request: QueryRequest):
     try:
         logger.info("Received query for GPT.")
-        response, image_names, relevant_subgraph = process_query(
+        response, image_names, relevant_subgraph = await process_query(
             request.user_input,
             request.conversation_history,
             request.use_relevant_context,
+            request.collection_id,
         )
         return {
             "response": response,
             "image_names": image_names,
             "relevant_subgraph": relevant_subgraph,
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error querying GPT: {e}")
         raise HTTPException(status_code=400, detail=str(e))
 
 
+@app.post("/query/stream")
+async def query_stream(request: QueryRequest):
+    logger.info("Received streaming query for GPT.")
+    return StreamingResponse(
+        stream_query(
+            request.user_input,
+            request.conversation_history,
+            request.use_relevant_context,
+            request.collection_id,
+        ),
+        media_type="text/event-stream",
+        # Keep proxies from buffering the events
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# NDJSON lines of /fullgraph/stream are sent in chunks of about this size
+GRAPH_STREAM_CHUNK_BYTES = int(os.getenv("GRAPH_STREAM_CHUNK_BYTES", "65536"))
+
+
+def get_response_encoding(request):
+    # zstd or gzip, whichever the client prefers, None for neither
+    return choose_encoding(request.headers.get("accept-encoding"))
+
+
+def get_json_body(data, encoding):
+    # Serialized and, when it is large enough to be worth it, compressed.
+    # Returns the body and the encoding it ended up in
+    body = json.dumps(data).encode("utf-8")
+    if encoding is None or len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    return compress(body, encoding), encoding
+
+
+async def iter_snapshot_records(snapshot):
+    for record in snapshot.iter_records():
+        yield record
+
+
+async def iter_fullgraph_ndjson(collection):
+    # One line per node and then per relationship. A snapshot that is held
+    # already is streamed from memory, otherwise the records come from the
+    # store as it reads them and the graph is never held in full
+    snapshot = get_graph_cache(collection).cached()
+    if snapshot is not None:
+        records = iter_snapshot_records(snapshot)
+    else:
+        records = get_store().iter_fullgraph(collection)
+    lines = []
+    size = 0
+    try:
+        async for kind, record in records:
+            line = format_ndjson_record(kind, record)
+            lines.append(line)
+            size += len(line)
+            if size >= GRAPH_STREAM_CHUNK_BYTES:
+                yield "".join(lines).encode("utf-8")
+                lines = []
+                size = 0
+    except Exception as e:
+        # The status code has already been sent, so errors become a record
+        logger.error(f"Error streaming full graph: {e}")
+        lines.append(format_ndjson_record("error", {"detail": str(e)}))
+    if lines:
+        yield "".join(lines).encode("utf-8")
+
+
 @app.get("/fullgraph", response_model=FullGraphResponse)
-async def get_fullgraph():
+async def get_fullgraph(
+    request: Request,
+    collection_id: str = Query(DEFAULT_COLLECTION, pattern=COLLECTION_ID_PATTERN),
+):
     try:
-        logger.info("Received request for full graph.")
-        response = get_fullgraph_from_neo4j()
-        return {"full_graph": response}
+        logger.info(f"Received request for full graph of {collection_id}.")
+        sync_graph_changes()
+        graph_cache = get_graph_cache(collection_id)
+        encoding = get_response_encoding(request)
+        # no-cache makes browsers revalidate with If-None-Match every time
+        headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        # Small graphs are sent uncompressed, under the tag without encoding
+        etags = (graph_cache.etag(), graph_cache.etag(encoding=encoding))
+        if request.headers.get("if-none-match") in etags:
+            headers["ETag"] = request.headers["if-none-match"]
+            return Response(status_code=304, headers=headers)
+
+        snapshot = await get_store().get_snapshot(collection_id)
+        body = await asyncio.to_thread(snapshot.json_body)
+        if encoding is not None and len(body) >= COMPRESS_MIN_BYTES:
+            body = await asyncio.to_thread(snapshot.json_body, encoding)
+            headers["Content-Encoding"] = encoding
+        else:
+            encoding = None
+        headers["ETag"] = graph_cache.etag(snapshot.version, encoding)
+        return Response(content=body, media_type="application/json", headers=headers)
     except Exception as e:
         logger.error(f"Error getting full graph: {e}")
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.post("/editgraph", response_model=FullGraphResponse)
+@app.get("/fullgraph/page", response_model=GraphPageResponse)
+async def get_fullgraph_page(
+    request: Request,
+    collection_id: str = Query(DEFAULT_COLLECTION, pattern=COLLECTION_ID_PATTERN),
+    cursor: Optional[str] = None,
+    limit: int = Query(GRAPH_PAGE_SIZE, ge=1, le=GRAPH_PAGE_MAX_SIZE),
+):
+    # The graph a page at a time, each read from the store on its own
+    try:
+        logger.info(f"Received request for a page of the graph of {collection_id}.")
+        sync_graph_changes()
+        page = await get_store().get_graph_page(cursor, limit, collection_id)
+        body, encoding = await asyncio.to_thread(
+            get_json_body, page, get_response_encoding(request)
+        )
+        headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type="application/json", headers=headers)
+    except Exception as e:
+        logger.error(f"Error getting page of graph: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/fullgraph/stream")
+async def stream_fullgraph(
+    request: Request,
+    collection_id: str = Query(DEFAULT_COLLECTION, pattern=COLLECTION_ID_PATTERN),
+):
+    logger.info(f"Received request to stream the graph of {collection_id}.")
+    sync_graph_changes()
+    chunks = iter_fullgraph_ndjson(collection_id)
+    # Keep proxies from buffering the records
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+        "Vary": "Accept-Encoding",
+    }
+    encoding = get_response_encoding(request)
+    if encoding is not None:
+        chunks = compress_stream(chunks, encoding)
+        headers["Content-Encoding"] = encoding
+    return StreamingResponse(chunks, media_type="application/x-ndjson", headers=headers)
+
+
+@app.post("/editgraph", response_model=GraphEditResponse)
 async def edit_graph(request: GraphEditRequest):
     try:
         logger.info("Received request to edit graph.")
-        response = process_edit_graph(
-            request.editedNodes, request.deletedEdges, request.addedEdges
+        return await get_store().edit_graph(
+            request.editedNodes,
+            request.deletedEdges,
+            request.addedEdges,
+            request.collection_id,
         )
-        return {"full_graph": response}
     except Exception as e:
         logger.error(f"Error editing graph: {e}")
         raise HTTPException(status_code=400, detail=str(e))
 
 
+@app.get("/collections")
+async def get_collections():
+    try:
+        return {"collections": await get_store().get_collections()}
+    except Exception as e:
+        logger.error(f"Error listing collections: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {
+        "tile_cache": await asyncio.to_thread(get_tile_cache().stats),
+        "graph_cache": {
+            collection: cache.stats()
+            for collection, cache in list(graph_caches.items())
+        },
+        "history_summaries": summary_cache.stats(),
+        "answer_cache": get_answer_cache().stats(),
+    }
+
+
+@app.get("/llm/stats")
+async def llm_stats():
+    return llm_dispatcher.stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus text exposition format
+    return Response(content=registry.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/healthcheck")
 async def healthcheck():
     return {"status": "ok"}
 
 
+@app.get("/readiness")
+async def readiness_check():
+    # Unlike /healthcheck only ok once the startup is done and the graph store
+    # could be reached, which is tried again until it could
+    if readiness["started"] and readiness["graph_store"] != "ok":
+        await check_graph_store()
+    ready = readiness["started"] and readiness["graph_store"] == "ok"
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else "starting",
+            "graph_store": readiness["graph_store"],
+            "runs_uploads": get_upload_queue().leader,
+            "pid": os.getpid(),
+        },
+    )
+
+
 # Run the FastAPI application
 if __name__ == "__main__":
+    import uvicorn
 
     logger.info("Starting Flowchart Query System FastAPI application.")
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Passed by name so that each worker process imports the app itself
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=SERVER_WORKERS)
@@ -0,0 +1,350 @@
+import os
+import re
+import logging
+from collections import defaultdict
+from functools import lru_cache
+
+from search_utils import tokenize
+
+logger = logging.getLogger(__name__)
+
+# Names at least this similar are merged without asking GPT
+MERGE_SIMILARITY_THRESHOLD = float(os.getenv("MERGE_SIMILARITY_THRESHOLD", "0.85"))
+# Names between this and MERGE_SIMILARITY_THRESHOLD are left to GPT to decide
+MERGE_AMBIGUOUS_THRESHOLD = float(os.getenv("MERGE_AMBIGUOUS_THRESHOLD", "0.6"))
+# Blocks larger than this are not compared pair by pair, only each name with
+# its neighbours in sorted order
+MERGE_MAX_BLOCK_SIZE = int(os.getenv("MERGE_MAX_BLOCK_SIZE", "50"))
+MERGE_BLOCK_WINDOW = int(os.getenv("MERGE_BLOCK_WINDOW", "8"))
+# Ambiguous groups larger than this are not worth a GPT call
+MERGE_MAX_AMBIGUOUS_GROUP = int(os.getenv("MERGE_MAX_AMBIGUOUS_GROUP", "20"))
+BLOCK_PREFIX_LENGTH = 4
+# Shorter tokens are too short for a one-letter difference to be a typo
+TYPO_MIN_LENGTH = 5
+
+NUMBER_PATTERN = re.compile(r"^\d+$")
+DIGIT_BOUNDARY_PATTERN = re.compile(r"(?<=[A-Za-z])(?=\d)|(?<=\d)(?=[A-Za-z])")
+
+
+class UnionFind:
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        self.parent.setdefault(item, item)
+        while self.parent[item] != item:
+            # Path halving keeps the trees flat without recursion
+            self.parent[item] = self.parent[self.parent[item]]
+            item = self.parent[item]
+        return item
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[root_b] = root_a
+
+    def groups(self):
+        groups = defaultdict(list)
+        for item in self.parent:
+            groups[self.find(item)].append(item)
+        return [members for members in groups.values() if len(members) > 1]
+
+
+def normalize_name(name):
+    # "AuthService2", "auth-service 2" and "Auth Services 2" all become
+    # "auth servic 2"
+    return " ".join(tokenize(DIGIT_BOUNDARY_PATTERN.sub(" ", name)))
+
+
+def within_one_edit(a, b):
+    # Damerau-Levenshtein distance of at most one: one insertion, deletion,
+    # substitution or swap of two neighbouring letters
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return (
+            a[i + 1 :] == b[i + 1 :]
+            or a[i : i + 2] == b[i : i + 2][::-1]
+            and a[i + 2 :] == b[i + 2 :]
+        )
+    return a[i:] == b[i + 1 :]
+
+
+def is_abbreviation(short, long):
+    # "auth" for "authentication", "db" for "database"
+    if len(short) < 2 or len(short) >= len(long) or short[0] != long[0]:
+        return False
+    letters = iter(long)
+    return all(letter in letters for letter in short)
+
+
+# Node names reuse a small vocabulary, so the same token pairs come up often
+@lru_cache(maxsize=65536)
+def token_similarity(a, b):
+    if a == b:
+        return 1.0
+    if min(len(a), len(b)) >= TYPO_MIN_LENGTH and within_one_edit(a, b):
+        return 1.0
+    short, long = sorted((a, b), key=len)
+    # Abbreviations are likely but not certain, GPT gets to decide
+    if not short.isdigit() and is_abbreviation(short, long):
+        return 0.5
+    return 0.0
+
+
+def name_similarity(a, b):
+    # a and b are (normalized, tokens) pairs
+    if a[0] == b[0] or a[0].replace(" ", "") == b[0].replace(" ", ""):
+        return 1.0
+    # "Step 1" and "Step 2" are never the same thing however similar they look
+    if {t for t in a[1] if NUMBER_PATTERN.match(t)} != {
+        t for t in b[1] if NUMBER_PATTERN.match(t)
+    }:
+        return 0.0
+
+    unmatched = list(b[1])
+    matched = 0.0
+    for token in a[1]:
+        scores = [token_similarity(token, other) for other in unmatched]
+        if scores and max(scores) > 0:
+            best = scores.index(max(scores))
+            matched += scores[best]
+            del unmatched[best]
+    return matched / max(len(a[1]), len(b[1]), 1)
+
+
+def get_block_keys(tokens):
+    # A token prefix catches abbreviations and typos late in a word, the sorted
+    # letters catch swapped letters anywhere in it
+    keys = set()
+    for token in tokens:
+        if not token.isdigit():
+            keys.add("prefix:" + token[:BLOCK_PREFIX_LENGTH])
+            keys.add("letters:" + "".join(sorted(token)))
+    return keys
+
+
+def get_block_pairs(members, features):
+    if len(members) <= MERGE_MAX_BLOCK_SIZE:
+        for i, a in enumerate(members):
+            for b in members[i + 1 :]:
+                yield a, b
+        return
+
+    # Sorted neighbourhood: names sharing a common word are only compared with
+    # the names next to them alphabetically
+    members = sorted(members, key=lambda name: features[name][0])
+    for i, a in enumerate(members):
+        for b in members[i + 1 : i + 1 + MERGE_BLOCK_WINDOW]:
+            yield a, b
+
+
+def find_merge_candidates(names, focus=None):
+    # Groups of names similar enough to merge straight away, and groups whose
+    # members are only somewhat alike and need a second opinion. With focus,
+    # only pairs involving one of those names are considered
+    features = {}
+    for name in names:
+        normalized = normalize_name(name)
+        features[name] = (normalized, normalized.split())
+
+    # Only names sharing a blocking key are compared, instead of all pairs
+    blocks = defaultdict(list)
+    for name, feature in features.items():
+        for key in get_block_keys(feature[1]) or {feature[0]}:
+            blocks[key].append(name)
+    if focus is not None:
+        focus = set(focus)
+        focus_keys = {
+            key
+            for name in focus
+            if name in features
+            for key in get_block_keys(features[name][1]) or {features[name][0]}
+        }
+        blocks = {key: blocks[key] for key in focus_keys}
+
+    confident = UnionFind()
+    ambiguous_pairs = []
+    compared = set()
+    for members in blocks.values():
+        for a, b in get_block_pairs(members, features):
+            pair = (a, b) if a < b else (b, a)
+            if pair in compared or (
+                focus is not None and a not in focus and b not in focus
+            ):
+                continue
+            compared.add(pair)
+            score = name_similarity(features[a], features[b])
+            if score >= MERGE_SIMILARITY_THRESHOLD:
+                confident.union(a, b)
+            elif score >= MERGE_AMBIGUOUS_THRESHOLD:
+                ambiguous_pairs.append(pair)
+
+    # Names that normalize the same might only share oversized blocks
+    by_normalized = defaultdict(list)
+    for name, feature in features.items():
+        by_normalized[feature[0].replace(" ", "")].append(name)
+    for members in by_normalized.values():
+        if focus is not None and focus.isdisjoint(members):
+            continue
+        for other in members[1:]:
+            confident.union(members[0], other)
+
+    # Ambiguous pairs link whole confident clusters together
+    ambiguous = UnionFind()
+    for a, b in ambiguous_pairs:
+        if confident.find(a) != confident.find(b):
+            ambiguous.union(confident.find(a), confident.find(b))
+    clusters = defaultdict(list)
+    for name in confident.parent:
+        clusters[confident.find(name)].append(name)
+    ambiguous_groups = []
+    for roots in ambiguous.groups():
+        group = [name for root in roots for name in clusters[root]]
+        if len(group) <= MERGE_MAX_AMBIGUOUS_GROUP:
+            ambiguous_groups.append(group)
+        else:
+            logger.info(f"Skipping ambiguous merge group of {len(group)} names.")
+
+    logger.info(f"Compared {len(compared)} of the possible node name pairs.")
+    return confident.groups(), ambiguous_groups
+
+
+def merge_lists(*lists):
+    return list(dict.fromkeys(item for items in lists for item in (items or [])))
+
+
+def choose_canonical_name(members, nodes, degrees):
+    # The name seen in most images and edges wins, then the more descriptive one
+    return max(
+        members,
+        key=lambda name: (
+            len(nodes[name].get("imageSources") or []),
+            degrees[name],
+            len(name),
+            name,
+        ),
+    )
+
+
+def merge_graph(graph, groups):
+    # Merge every group of node names into one node and point the edges at it.
+    # Also returns which name replaced each removed name
+    nodes = {node["name"]: node for node in graph["nodes"]}
+    degrees = defaultdict(int)
+    for relationship in graph["relationships"]:
+        degrees[relationship["from"]] += 1
+        degrees[relationship["to"]] += 1
+
+    union_find = UnionFind()
+    for group in groups:
+        present = [name for name in group if name in nodes]
+        for name in present[1:]:
+            union_find.union(present[0], name)
+
+    renamed = {}
+    for members in union_find.groups():
+        canonical = choose_canonical_name(members, nodes, degrees)
+        for name in members:
+            if name != canonical:
+                renamed[name] = canonical
+
+    merged_nodes = {}
+    for name, node in nodes.items():
+        target = renamed.get(name, name)
+        existing = merged_nodes.setdefault(
+            target, {"name": target, "context": [], "imageSources": []}
+        )
+        existing["context"] = merge_lists(existing["context"], node.get("context"))
+        existing["imageSources"] = merge_lists(
+            existing["imageSources"], node.get("imageSources")
+        )
+
+    merged_relationships = {}
+    for relationship in graph["relationships"]:
+        source = renamed.get(relationship["from"], relationship["from"])
+        target = renamed.get(relationship["to"], relationship["to"])
+        # An edge between two names of the same node is a tiling artefact
+        if source == target and relationship["from"] != relationship["to"]:
+            continue
+        key = (source, target, normalize_name(relationship["name"] or ""))
+        existing = merged_relationships.setdefault(
+            key,
+            {
+                "from": source,
+                "to": target,
+                "name": relationship["name"],
+                "context": [],
+                "imageSources": [],
+            },
+        )
+        existing["context"] = merge_lists(
+            existing["context"], relationship.get("context")
+        )
+        existing["imageSources"] = merge_lists(
+            existing["imageSources"], relationship.get("imageSources")
+        )
+
+    merged_graph = {
+        "nodes": list(merged_nodes.values()),
+        "relationships": list(merged_relationships.values()),
+    }
+    logger.info(
+        f"Merged {len(renamed)} nodes and {len(graph['relationships']) - len(merged_relationships)} relationships."
+    )
+    return merged_graph, renamed
+
+
+def get_relationship_key(relationship):
+    return (relationship["from"], relationship["to"], relationship["name"])
+
+
+def get_graph_diff(before, after, renamed):
+    # The writes that turn before into after, leaving identical nodes and
+    # edges alone
+    before_nodes = {node["name"]: node for node in before["nodes"]}
+    upserted_nodes = [
+        node
+        for node in after["nodes"]
+        if before_nodes.get(node["name"]) is None
+        or list(before_nodes[node["name"]].get("context") or []) != node["context"]
+        or list(before_nodes[node["name"]].get("imageSources") or [])
+        != node["imageSources"]
+    ]
+
+    before_relationships = {
+        get_relationship_key(relationship): relationship
+        for relationship in before["relationships"]
+    }
+    after_relationships = {
+        get_relationship_key(relationship): relationship
+        for relationship in after["relationships"]
+    }
+    deleted_relationships = [
+        {"from": key[0], "to": key[1], "name": key[2]}
+        for key in before_relationships
+        if key not in after_relationships
+        # Edges of removed nodes go with the node
+        and key[0] not in renamed and key[1] not in renamed
+    ]
+    upserted_relationships = []
+    for key, relationship in after_relationships.items():
+        previous = before_relationships.get(key)
+        if (
+            previous is None
+            or list(previous.get("context") or []) != relationship["context"]
+            or list(previous.get("imageSources") or []) != relationship["imageSources"]
+        ):
+            upserted_relationships.append(relationship)
+
+    return {
+        "upserted_nodes": upserted_nodes,
+        "deleted_nodes": list(renamed),
+        "deleted_relationships": deleted_relationships,
+        "upserted_relationships": upserted_relationships,
+    }
@@ -0,0 +1,247 @@
+import time
+import uuid
+import asyncio
+import logging
+import functools
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from a cached lookup to a whole upload
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+)
+
+# Set for every HTTP request and upload job, and copied into tasks and
+# threads started from there
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+class RequestIdFilter(logging.Filter):
+    # Makes %(request_id)s available to log formats
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=()):
+    pairs = [
+        f'{name}="{escape_label_value(value)}"'
+        for name, value in list(zip(names, values)) + list(extra)
+    ]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    # A counter, gauge or histogram in the Prometheus text format, one series
+    # per combination of label values. A gauge can instead be read from a
+    # callback at scrape time
+    def __init__(
+        self, name, kind, help, labels=(), buckets=DEFAULT_BUCKETS, callback=None
+    ):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.callback = callback
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.series[self._key(labels)] = value
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                # Count per bucket, then sum and count of all observations
+                series = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if self.callback is not None:
+            try:
+                value = self.callback()
+            except Exception as e:
+                logger.warning(f"Could not read metric {self.name}: {e}")
+                return lines
+            lines.append(f"{self.name} {value}")
+            return lines
+
+        with self.lock:
+            series = {
+                key: list(value) if isinstance(value, list) else value
+                for key, value in self.series.items()
+            }
+        for key, value in sorted(series.items()):
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), value):
+                cumulative += count
+                labels = format_labels(self.labels, key, [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {value[-2]}")
+            lines.append(f"{self.name}_count{labels} {value[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Metric(name, "counter", help, labels))
+
+    def gauge(self, name, help, labels=(), callback=None):
+        return self._add(Metric(name, "gauge", help, labels, callback=callback))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Metric(name, "histogram", help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+stage_duration = registry.histogram(
+    "stage_duration_seconds",
+    "Time spent in each stage of handling uploads and queries.",
+    ("stage", "status"),
+)
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds",
+    "Time to respond to HTTP requests, up to the response headers.",
+    ("method", "route", "status"),
+)
+llm_request_duration = registry.histogram(
+    "llm_request_duration_seconds",
+    "Duration of successful GPT calls, per caller.",
+    ("caller",),
+)
+llm_wait_duration = registry.histogram(
+    "llm_wait_seconds",
+    "Time GPT calls waited for a concurrency slot and the rate limit.",
+    ("caller",),
+)
+llm_first_token_duration = registry.histogram(
+    "llm_time_to_first_token_seconds",
+    "Time from opening a streamed GPT call to its first token.",
+    ("caller",),
+)
+llm_tokens = registry.counter(
+    "llm_tokens_total",
+    "Tokens used by GPT calls as reported by the completion usage.",
+    ("caller", "kind"),
+)
+llm_errors = registry.counter(
+    "llm_errors_total",
+    "GPT call attempts that failed, by error type.",
+    ("caller", "error"),
+)
+neo4j_round_trips = registry.counter(
+    "neo4j_round_trips_total",
+    "Cypher statements sent to Neo4j, per operation.",
+    ("operation",),
+)
+
+
+def _log_span(stage, status, duration, level, fields):
+    if logger.isEnabledFor(level):
+        details = "".join(f" {key}={value}" for key, value in fields.items())
+        logger.log(
+            level,
+            f"span stage={stage} status={status} duration_ms={duration * 1000:.1f}{details}",
+        )
+
+
+@contextmanager
+def span(stage, level=logging.DEBUG, **fields):
+    # Times a block of code into stage_duration_seconds and logs it with the
+    # request id. Works around awaits as well, measuring wall time
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        stage_duration.observe(duration, stage=stage, status=status)
+        _log_span(stage, status, duration, level, fields)
+
+
+def timed(stage, level=logging.DEBUG):
+    # Decorator form of span for whole functions, sync or async
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage, level):
+                    return await function(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage, level):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count_round_trips(operation, count=1):
+    neo4j_round_trips.inc(count, operation=operation)
@@ -1,208 +1,731 @@
 import os
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, AsyncGraphDatabase
 import logging
+from metrics_utils import timed, count_round_trips
+from storage_utils import (
+    GraphStore,
+    notify_graph_change,
+    chunk_list,
+    add_record_to_subgraph,
+    DEFAULT_COLLECTION,
+    get_graph_cache,
+    get_save_change,
+    get_diff_change,
+    get_empty_edit_changes,
+    get_edit_graph_change,
+    split_edited_nodes,
+    log_save_counts,
+    log_diff_counts,
+)
 
 logger = logging.getLogger(__name__)
 
+# Connections each worker process keeps open to Neo4j at most
+NEO4J_MAX_CONNECTION_POOL_SIZE = int(os.getenv("NEO4J_MAX_CONNECTION_POOL_SIZE", "100"))
+
 
 def get_neo4j_driver():
     uri = os.getenv("NEO4J_URI")
     user = os.getenv("NEO4J_USER")
     password = os.getenv("NEO4J_PASSWORD")
 
-    driver = GraphDatabase.driver(uri, auth=(user, password))
+    driver = GraphDatabase.driver(
+        uri,
+        auth=(user, password),
+        max_connection_pool_size=NEO4J_MAX_CONNECTION_POOL_SIZE,
+    )
     return driver
 
 
-neo4j_driver = get_neo4j_driver()
+def get_async_neo4j_driver():
+    uri = os.getenv("NEO4J_URI")
+    user = os.getenv("NEO4J_USER")
+    password = os.getenv("NEO4J_PASSWORD")
+
+    driver = AsyncGraphDatabase.driver(
+        uri,
+        auth=(user, password),
+        max_connection_pool_size=NEO4J_MAX_CONNECTION_POOL_SIZE,
+    )
+    return driver
+
+
+# Created on first use, so the module imports without Neo4j settings
+neo4j_driver = None
+async_neo4j_driver = None
+
+
+def get_driver():
+    global neo4j_driver
+    if neo4j_driver is None:
+        neo4j_driver = get_neo4j_driver()
+    return neo4j_driver
+
+
+def get_async_driver():
+    global async_neo4j_driver
+    if async_neo4j_driver is None:
+        async_neo4j_driver = get_async_neo4j_driver()
+    return async_neo4j_driver
+
+
+# Schema changes, applied in order once each. The version reached is kept on
+# a :SchemaVersion node, and every statement is safe to run again in case a
+# migration was interrupted
+MERGE_DUPLICATE_NODES_QUERY = """
+MATCH (n:Node)
+WITH n.name AS name, collect(n) AS nodes
+WHERE size(nodes) > 1
+CALL apoc.refactor.mergeNodes(nodes, {properties: "combine", mergeRels: true})
+YIELD node
+SET node.name = name, node.context = apoc.coll.toSet(apoc.coll.flatten([node.context])), node.imageSources = apoc.coll.toSet(apoc.coll.flatten([node.imageSources]))
+RETURN count(node) as merged
+"""
+
+SCHEMA_MIGRATIONS = [
+    (
+        1,
+        "Unique node names",
+        [
+            # The constraint cannot be created while duplicates exist
+            MERGE_DUPLICATE_NODES_QUERY,
+            "CREATE CONSTRAINT node_name_unique IF NOT EXISTS FOR (n:Node) REQUIRE n.name IS UNIQUE",
+        ],
+    ),
+    (
+        2,
+        "Index relationship names",
+        [
+            "CREATE INDEX connected_name IF NOT EXISTS FOR ()-[r:CONNECTED]-() ON (r.name)",
+        ],
+    ),
+    (
+        3,
+        "Node names unique per collection",
+        [
+            'MATCH (n:Node) WHERE n.collection IS NULL SET n.collection = "default"',
+            "DROP CONSTRAINT node_name_unique IF EXISTS",
+            # Backed by a composite index, which also serves lookups of all
+            # the nodes of one collection
+            "CREATE CONSTRAINT node_collection_name_unique IF NOT EXISTS FOR (n:Node) REQUIRE (n.collection, n.name) IS UNIQUE",
+        ],
+    ),
+]
+
+GET_SCHEMA_VERSION_QUERY = """
+MATCH (s:SchemaVersion {id: "graph"})
+RETURN s.version as version
+"""
+
+SET_SCHEMA_VERSION_QUERY = """
+MERGE (s:SchemaVersion {id: "graph"})
+SET s.version = $version
+"""
 
+COLLECTIONS_QUERY = """
+MATCH (n:Node)
+RETURN n.collection as collection, count(n) as nodes
+ORDER BY collection
+"""
 
-def get_all_nodes_from_neo4j():
+ALL_NODES_QUERY = """
+MATCH (n:Node {collection: $collection})
+RETURN n.name as name, n.context as context
+"""
+
+SUBGRAPH_QUERY = """
+MATCH (n:Node {collection: $collection})-[r:CONNECTED]->(m:Node)
+WHERE n.name in $nodes OR m.name in $nodes
+RETURN n.name as from, m.name as to, r.name as name, r.context as relationship_context, n.context as from_context, m.context as to_context, r.imageSources as relationship_imageSources, n.imageSources as from_imageSources, m.imageSources as to_imageSources
+"""
+
+FULLGRAPH_NODES_QUERY = """
+MATCH (n:Node {collection: $collection})
+RETURN n.name as name, n.context as context, n.imageSources as imageSources
+"""
+
+FULLGRAPH_RELATIONSHIPS_QUERY = """
+MATCH (n:Node {collection: $collection})-[r:CONNECTED]->(m:Node)
+RETURN n.name as from, m.name as to, r.name as name, r.context as context, r.imageSources as imageSources
+"""
+
+# Pages walk the name index from the last record of the previous page. Node
+# names are unique within a collection, so (from, to, name) orders the
+# relationships completely. Relationships without a name sort as "", the
+# cursor then carries "" too, so they are neither skipped nor repeated
+NODES_PAGE_QUERY = """
+MATCH (n:Node {collection: $collection})
+WHERE n.name > $after
+RETURN n.name as name, n.context as context, n.imageSources as imageSources
+ORDER BY n.name
+LIMIT $limit
+"""
+
+RELATIONSHIPS_PAGE_QUERY = """
+MATCH (n:Node {collection: $collection})
+WHERE n.name >= $after_from
+MATCH (n)-[r:CONNECTED]->(m:Node)
+WHERE n.name > $after_from
+    OR m.name > $after_to
+    OR (m.name = $after_to AND coalesce(r.name, '') > $after_name)
+RETURN n.name as from, m.name as to, r.name as name, r.context as context, r.imageSources as imageSources
+ORDER BY n.name, m.name, coalesce(r.name, '')
+LIMIT $limit
+"""
+
+NEIGHBOURHOOD_NODES_QUERY = """
+MATCH (n:Node {collection: $collection})
+WHERE n.name IN $nodes
+OPTIONAL MATCH (n)-[:CONNECTED]-(m:Node)
+WITH collect(n) + collect(m) AS found
+UNWIND found AS node
+WITH DISTINCT node
+RETURN node.name as name, node.context as context, node.imageSources as imageSources
+"""
+
+NEIGHBOURHOOD_RELATIONSHIPS_QUERY = """
+MATCH (n:Node {collection: $collection})-[r:CONNECTED]->(m:Node)
+WHERE n.name IN $nodes OR m.name IN $nodes
+RETURN n.name as from, m.name as to, r.name as name, r.context as context, r.imageSources as imageSources
+"""
+
+DELETE_ALL_QUERY = """
+MATCH (n:Node)
+DETACH DELETE n
+"""
+
+DELETE_COLLECTION_QUERY = """
+MATCH (n:Node {collection: $collection})
+DETACH DELETE n
+"""
+
+DELETE_EDGES_QUERY = """
+UNWIND $edges AS edge
+MATCH (from:Node {collection: $collection, name: edge.from})-[r:CONNECTED {name: edge.label}]->(to:Node {collection: $collection, name: edge.to})
+DELETE r
+RETURN from.name as from, to.name as to, edge.label as name
+"""
+
+ADD_EDGES_QUERY = """
+UNWIND $edges AS edge
+MATCH (from:Node {collection: $collection, name: edge.from})
+MATCH (to:Node {collection: $collection, name: edge.to})
+MERGE (from)-[r:CONNECTED {name: edge.label}]->(to)
+ON CREATE SET r.context = [], r.imageSources = ["User Edited"]
+RETURN from.name as from, to.name as to, r.name as name, r.context as context, r.imageSources as imageSources
+"""
+
+CREATE_NODES_QUERY = """
+UNWIND $names AS name
+MERGE (n:Node {collection: $collection, name: name})
+ON CREATE SET n.context = [], n.imageSources = ["User Edited"]
+RETURN n.name as name, n.context as context, n.imageSources as imageSources
+"""
+
+RENAME_NODES_QUERY = """
+UNWIND $renames AS rename
+MATCH (n:Node {collection: $collection, name: rename.oldName})
+SET n.name = rename.newName
+RETURN rename.oldName as oldName, n.name as newName
+"""
+
+
+@timed("neo4j.ensure_schema")
+def ensure_schema():
+    with get_driver().session() as session:
+        record = session.run(GET_SCHEMA_VERSION_QUERY).single()
+        count_round_trips("ensure_schema")
+        version = record["version"] if record else 0
+        for migration_version, description, statements in SCHEMA_MIGRATIONS:
+            if migration_version <= version:
+                continue
+            logger.info(
+                f"Applying schema migration {migration_version}: {description}."
+            )
+            # Schema statements cannot share a transaction with data writes
+            for statement in statements:
+                session.run(statement).consume()
+            session.run(SET_SCHEMA_VERSION_QUERY, version=migration_version).consume()
+            count_round_trips("ensure_schema", len(statements) + 1)
+            version = migration_version
+
+    logger.info(f"Neo4j schema is at version {version}.")
+    return version
+
+
+@timed("neo4j.ensure_schema")
+async def ensure_schema_async():
+    async with get_async_driver().session() as session:
+        result = await session.run(GET_SCHEMA_VERSION_QUERY)
+        record = await result.single()
+        count_round_trips("ensure_schema")
+        version = record["version"] if record else 0
+        for migration_version, description, statements in SCHEMA_MIGRATIONS:
+            if migration_version <= version:
+                continue
+            logger.info(
+                f"Applying schema migration {migration_version}: {description}."
+            )
+            for statement in statements:
+                await (await session.run(statement)).consume()
+            await (
+                await session.run(SET_SCHEMA_VERSION_QUERY, version=migration_version)
+            ).consume()
+            count_round_trips("ensure_schema", len(statements) + 1)
+            version = migration_version
+
+    logger.info(f"Neo4j schema is at version {version}.")
+    return version
+
+
+@timed("neo4j.collections")
+async def get_collections_from_neo4j_async():
+    async with get_async_driver().session() as session:
+        result = await session.run(COLLECTIONS_QUERY)
+        count_round_trips("collections")
+        return await result.data()
+
+
+@timed("neo4j.all_nodes")
+async def get_all_nodes_from_neo4j_async(collection=DEFAULT_COLLECTION):
     logger.info("Getting all nodes from Neo4j.")
 
-    with neo4j_driver.session() as session:
-        query = """
-        MATCH (n) 
-        RETURN n.name as name, n.context as context
-        """
-        result = session.run(query)
-        return result.data()
+    async with get_async_driver().session() as session:
+        result = await session.run(ALL_NODES_QUERY, collection=collection)
+        count_round_trips("all_nodes")
+        return await result.data()
 
 
-def get_subgraph_from_neo4j(nodes):
+@timed("neo4j.subgraph")
+def get_subgraph_from_neo4j(nodes, collection=DEFAULT_COLLECTION):
     logger.info("Getting subgraph from Neo4j.")
-    with neo4j_driver.session() as session:
-        query = """
-        MATCH (n:Node)-[r:CONNECTED]->(m:Node)
-        WHERE n.name in $nodes OR m.name in $nodes
-        RETURN n.name as from, m.name as to, r.name as name, r.context as relationship_context, n.context as from_context, m.context as to_context, r.imageSources as relationship_imageSources, n.imageSources as from_imageSources, m.imageSources as to_imageSources
-        """
-        result = session.run(query, nodes=nodes)
+    with get_driver().session() as session:
+        result = session.run(SUBGRAPH_QUERY, nodes=nodes, collection=collection)
+        count_round_trips("subgraph")
         subgraph = {
             "nodes": [],
             "relationships": [],
         }
         nodes_set = set()
         for record in result:
-            relationship = {
-                "name": record["name"],
-                "from": record["from"],
-                "to": record["to"],
-                "context": record["relationship_context"],
-                "imageSources": record["relationship_imageSources"],
-            }
-            subgraph["relationships"].append(relationship)
-
-            from_node = {
-                "name": record["from"],
-                "context": record["from_context"],
-                "imageSources": record["from_imageSources"],
-            }
-            if from_node["name"] not in nodes_set:
-                subgraph["nodes"].append(from_node)
-                nodes_set.add(from_node["name"])
-
-            to_node = {
-                "name": record["to"],
-                "context": record["to_context"],
-                "imageSources": record["to_imageSources"],
-            }
-            if to_node["name"] not in nodes_set:
-                subgraph["nodes"].append(to_node)
-                nodes_set.add(to_node["name"])
+            add_record_to_subgraph(subgraph, nodes_set, record)
+
+        return subgraph
+
+
+@timed("neo4j.subgraph")
+async def get_subgraph_from_neo4j_async(nodes, collection=DEFAULT_COLLECTION):
+    logger.info("Getting subgraph from Neo4j.")
+    async with get_async_driver().session() as session:
+        result = await session.run(SUBGRAPH_QUERY, nodes=nodes, collection=collection)
+        count_round_trips("subgraph")
+        subgraph = {
+            "nodes": [],
+            "relationships": [],
+        }
+        nodes_set = set()
+        async for record in result:
+            add_record_to_subgraph(subgraph, nodes_set, record)
 
         return subgraph
 
 
-def get_fullgraph_from_neo4j():
+@timed("neo4j.fullgraph")
+async def get_fullgraph_from_neo4j_async(collection=DEFAULT_COLLECTION):
     logger.info("Getting full graph from Neo4j.")
     graph = {
         "nodes": [],
         "relationships": [],
     }
-    with neo4j_driver.session() as session:
-        queryNodes = """
-        MATCH (n:Node)
-        RETURN n.name as name, n.context as context, n.imageSources as imageSources
-        """
-        resultNodes = session.run(queryNodes)
-        graph["nodes"] = resultNodes.data()
-
-        queryRelationships = """
-        MATCH (n:Node)-[r:CONNECTED]->(m:Node)
-        RETURN n.name as from, m.name as to, r.name as name, r.context as context, r.imageSources as imageSources
-        """
-        resultRelationships = session.run(queryRelationships)
-        graph["relationships"] = resultRelationships.data()
+    async with get_async_driver().session() as session:
+        resultNodes = await session.run(FULLGRAPH_NODES_QUERY, collection=collection)
+        graph["nodes"] = await resultNodes.data()
+
+        resultRelationships = await session.run(
+            FULLGRAPH_RELATIONSHIPS_QUERY, collection=collection
+        )
+        count_round_trips("fullgraph", 2)
+        graph["relationships"] = await resultRelationships.data()
+
+    return graph
+
+
+async def iter_fullgraph_from_neo4j_async(collection=DEFAULT_COLLECTION):
+    # ("node", node) and then ("relationship", relationship) pairs as the
+    # driver fetches them, fetch_size records at a time. Both queries run in
+    # one transaction, so they see the same graph
+    logger.info("Streaming full graph from Neo4j.")
+    async with get_async_driver().session() as session:
+        async with await session.begin_transaction() as tx:
+            result = await tx.run(FULLGRAPH_NODES_QUERY, collection=collection)
+            async for record in result:
+                yield "node", record.data()
+            result = await tx.run(FULLGRAPH_RELATIONSHIPS_QUERY, collection=collection)
+            count_round_trips("fullgraph", 2)
+            async for record in result:
+                yield "relationship", record.data()
 
+
+@timed("neo4j.nodes_page")
+async def get_nodes_page_from_neo4j_async(after, limit, collection=DEFAULT_COLLECTION):
+    async with get_async_driver().session() as session:
+        result = await session.run(
+            NODES_PAGE_QUERY, after=after, limit=limit, collection=collection
+        )
+        count_round_trips("nodes_page")
+        return await result.data()
+
+
+@timed("neo4j.relationships_page")
+async def get_relationships_page_from_neo4j_async(
+    after, limit, collection=DEFAULT_COLLECTION
+):
+    async with get_async_driver().session() as session:
+        result = await session.run(
+            RELATIONSHIPS_PAGE_QUERY,
+            after_from=after[0],
+            after_to=after[1],
+            after_name=after[2],
+            limit=limit,
+            collection=collection,
+        )
+        count_round_trips("relationships_page")
+        return await result.data()
+
+
+@timed("neo4j.neighbourhood")
+async def get_neighbourhood_from_neo4j_async(nodes, collection=DEFAULT_COLLECTION):
+    # The given nodes, their direct neighbours and every edge of the given nodes
+    logger.info("Getting neighbourhood of nodes from Neo4j.")
+    async with get_async_driver().session() as session:
+        result = await session.run(
+            NEIGHBOURHOOD_NODES_QUERY, nodes=nodes, collection=collection
+        )
+        graph = {"nodes": await result.data()}
+        result = await session.run(
+            NEIGHBOURHOOD_RELATIONSHIPS_QUERY, nodes=nodes, collection=collection
+        )
+        count_round_trips("neighbourhood", 2)
+        graph["relationships"] = await result.data()
     return graph
 
 
-def save_to_neo4j(graph):
+SAVE_NODES_QUERY = """
+UNWIND $nodes AS node
+MERGE (n:Node {collection: $collection, name: node.name})
+ON CREATE SET n.context = node.context, n.imageSources = node.imageSources
+ON MATCH SET n.context = apoc.coll.toSet(n.context + node.context), n.imageSources = apoc.coll.toSet(n.imageSources + node.imageSources)
+RETURN count(n) as written
+"""
+
+SAVE_RELATIONSHIPS_QUERY = """
+UNWIND $relationships AS relationship
+MATCH (from:Node {collection: $collection, name: relationship.from})
+MATCH (to:Node {collection: $collection, name: relationship.to})
+MERGE (from)-[r:CONNECTED {name: relationship.name}]->(to)
+ON CREATE SET r.context = relationship.context, r.imageSources = relationship.imageSources
+ON MATCH SET r.context = apoc.coll.toSet(r.context + relationship.context), r.imageSources = apoc.coll.toSet(r.imageSources + relationship.imageSources)
+RETURN count(r) as written
+"""
+
+DEFAULT_WRITE_CHUNK_SIZE = int(os.getenv("NEO4J_WRITE_CHUNK_SIZE", "500"))
+
+
+def _write_batch(tx, query, **params):
+    return tx.run(query, **params).single()["written"]
+
+
+async def _write_batch_async(tx, query, **params):
+    result = await tx.run(query, **params)
+    return (await result.single())["written"]
+
+
+def get_save_batches(graph, collection, chunk_size):
+    nodes = [
+        {
+            "name": node["name"],
+            "context": node["context"],
+            "imageSources": node["imageSources"],
+        }
+        for node in graph["nodes"]
+    ]
+    relationships = [
+        {
+            "name": relationship["name"],
+            "from": relationship["from"],
+            "to": relationship["to"],
+            "context": relationship["context"],
+            "imageSources": relationship["imageSources"],
+        }
+        for relationship in graph["relationships"]
+    ]
+
+    # Nodes have to be written before the relationships that MATCH them
+    for batch in chunk_list(nodes, chunk_size):
+        yield "nodes", SAVE_NODES_QUERY, {"nodes": batch, "collection": collection}
+    for batch in chunk_list(relationships, chunk_size):
+        yield "relationships", SAVE_RELATIONSHIPS_QUERY, {
+            "relationships": batch,
+            "collection": collection,
+        }
+
+
+@timed("neo4j.save")
+def save_to_neo4j(
+    graph, collection=DEFAULT_COLLECTION, chunk_size=DEFAULT_WRITE_CHUNK_SIZE
+):
+    logger.info("Saving connections to Neo4j.")
+    counts = {"nodes": 0, "relationships": 0, "transactions": 0}
+    with get_driver().session() as session:
+        for kind, query, params in get_save_batches(graph, collection, chunk_size):
+            counts[kind] += session.execute_write(_write_batch, query, **params)
+            counts["transactions"] += 1
+            count_round_trips("save")
+
+    log_save_counts(counts)
+    notify_graph_change(get_save_change(graph, collection))
+    return counts
+
+
+@timed("neo4j.save")
+async def save_to_neo4j_async(
+    graph, collection=DEFAULT_COLLECTION, chunk_size=DEFAULT_WRITE_CHUNK_SIZE
+):
     logger.info("Saving connections to Neo4j.")
-    with neo4j_driver.session() as session:
-        for node in graph["nodes"]:
-            name = node["name"]
-            context = node["context"]
-            imageSources = node["imageSources"]
-            query = """
-            MERGE (n:Node {name: $name})
-            ON CREATE SET n.context = $context, n.imageSources = $imageSources
-            ON MATCH SET n.context = apoc.coll.toSet(n.context + $context), n.imageSources = apoc.coll.toSet(n.imageSources + $imageSources)
-            """
-            session.run(query, name=name, context=context, imageSources=imageSources)
-
-        for relationship in graph["relationships"]:
-            name = relationship["name"]
-            from_node = relationship["from"]
-            to_node = relationship["to"]
-            context = relationship["context"]
-            imageSources = relationship["imageSources"]
-            query = """
-            MATCH (from:Node {name: $from_node})
-            MATCH (to:Node {name: $to_node})
-            MERGE (from)-[r:CONNECTED {name: $name}]->(to)
-            ON CREATE SET r.context = $context, r.imageSources = $imageSources
-            ON MATCH SET r.context = apoc.coll.toSet(r.context + $context), r.imageSources = apoc.coll.toSet(r.imageSources + $imageSources)
-            """
-            session.run(
-                query,
-                name=name,
-                from_node=from_node,
-                to_node=to_node,
-                context=context,
-                imageSources=imageSources,
+    counts = {"nodes": 0, "relationships": 0, "transactions": 0}
+    async with get_async_driver().session() as session:
+        for kind, query, params in get_save_batches(graph, collection, chunk_size):
+            counts[kind] += await session.execute_write(
+                _write_batch_async, query, **params
             )
+            counts["transactions"] += 1
+            count_round_trips("save")
+
+    log_save_counts(counts)
+    notify_graph_change(get_save_change(graph, collection))
+    return counts
+
 
+UPSERT_NODES_QUERY = """
+UNWIND $nodes AS node
+MERGE (n:Node {collection: $collection, name: node.name})
+SET n.context = node.context, n.imageSources = node.imageSources
+RETURN count(n) as written
+"""
 
-def delete_all_from_neo4j():
+DELETE_RELATIONSHIPS_QUERY = """
+UNWIND $relationships AS relationship
+MATCH (:Node {collection: $collection, name: relationship.from})-[r:CONNECTED {name: relationship.name}]->(:Node {collection: $collection, name: relationship.to})
+DELETE r
+RETURN count(*) as written
+"""
+
+UPSERT_RELATIONSHIPS_QUERY = """
+UNWIND $relationships AS relationship
+MATCH (from:Node {collection: $collection, name: relationship.from})
+MATCH (to:Node {collection: $collection, name: relationship.to})
+MERGE (from)-[r:CONNECTED {name: relationship.name}]->(to)
+SET r.context = relationship.context, r.imageSources = relationship.imageSources
+RETURN count(r) as written
+"""
+
+DELETE_NODES_QUERY = """
+UNWIND $nodes AS name
+MATCH (n:Node {collection: $collection, name: name})
+DETACH DELETE n
+RETURN name
+"""
+
+
+def get_diff_batches(diff, collection, chunk_size):
+    # Merged nodes exist before edges are moved onto them, and the replaced
+    # nodes go last, once none of the edges kept still point at them
+    for batch in chunk_list(diff["upserted_nodes"], chunk_size):
+        yield UPSERT_NODES_QUERY, {"nodes": batch, "collection": collection}
+    for batch in chunk_list(diff["deleted_relationships"], chunk_size):
+        yield DELETE_RELATIONSHIPS_QUERY, {
+            "relationships": batch,
+            "collection": collection,
+        }
+    for batch in chunk_list(diff["upserted_relationships"], chunk_size):
+        yield UPSERT_RELATIONSHIPS_QUERY, {
+            "relationships": batch,
+            "collection": collection,
+        }
+    for batch in chunk_list(diff["deleted_nodes"], chunk_size):
+        yield DELETE_NODES_QUERY, {"nodes": batch, "collection": collection}
+
+
+async def _apply_diff_async(tx, batches):
+    for query, params in batches:
+        await (await tx.run(query, **params)).consume()
+
+
+@timed("neo4j.apply_diff")
+async def apply_graph_diff_async(
+    diff, collection=DEFAULT_COLLECTION, chunk_size=DEFAULT_WRITE_CHUNK_SIZE
+):
+    # One write transaction, so readers see the graph before or after the
+    # diff and never anything in between
+    batches = list(get_diff_batches(diff, collection, chunk_size))
+    if not batches:
+        return
+    async with get_async_driver().session() as session:
+        await session.execute_write(_apply_diff_async, batches)
+    count_round_trips("apply_diff", len(batches))
+
+    log_diff_counts(diff)
+    notify_graph_change(get_diff_change(diff, collection))
+
+
+@timed("neo4j.delete_all")
+def delete_all_from_neo4j(collection=None):
+    # Every collection unless one is given
     logger.info("Deleting all nodes and relationships from Neo4j.")
-    with neo4j_driver.session() as session:
-        query = """
-        MATCH (n)
-        DETACH DELETE n
-        """
-        session.run(query)
-
-
-def process_edit_graph(editedNodes, deletedEdges, addedEdges):
-
-    # Loop over deleted edges
-    for edge in deletedEdges:
-        fromNode = edge["from"]
-        toNode = edge["to"]
-        label = edge["label"]
-        query = """
-        MATCH (from:Node {name: $fromNode})-[r:CONNECTED {name: $label}]->(to:Node {name: $toNode})
-        DELETE r
-        """
-        with neo4j_driver.session() as session:
-            session.run(query, fromNode=fromNode, toNode=toNode, label=label)
-
-    # Loop over added edges
-    for edge in addedEdges:
-        fromNode = edge["from"]
-        toNode = edge["to"]
-        label = edge["label"]
-        query = """
-        MATCH (from:Node {name: $fromNode})
-        MATCH (to:Node {name: $toNode})
-        MERGE (from)-[r:CONNECTED {name: $label}]->(to)
-        ON CREATE SET r.context = [], r.imageSources = ["User Edited"]
-        """
-        with neo4j_driver.session() as session:
-            session.run(query, fromNode=fromNode, toNode=toNode, label=label)
-
-    # Loop over edited nodes
-    for node in editedNodes:
-        oldName = node["oldName"]
-        newName = node["newName"]
-        # If old name is empty, then create a new node
-        # if new name is empty, then delete the node
-        # Otherwise, update the node
-        if oldName == "":
-            # Create a new node
-            query = """
-            MERGE (n:Node {name: $newName})
-            ON CREATE SET n.context = [], n.imageSources = ["User Edited"]
-            """
-            with neo4j_driver.session() as session:
-                session.run(query, newName=newName)
-        elif newName == "":
-            # Delete the node
-            query = """
-            MATCH (n:Node {name: $oldName})
-            DETACH DELETE n
-            """
-            with neo4j_driver.session() as session:
-                session.run(query, oldName=oldName)
+    with get_driver().session() as session:
+        if collection is None:
+            session.run(DELETE_ALL_QUERY).consume()
         else:
-            # Update the node
-            query = """
-            MATCH (n:Node {name: $oldName})
-            SET n.name = $newName
-            """
-            with neo4j_driver.session() as session:
-                session.run(query, oldName=oldName, newName=newName)
-
-    return get_fullgraph_from_neo4j()
+            session.run(DELETE_COLLECTION_QUERY, collection=collection).consume()
+    count_round_trips("delete_all")
+    notify_graph_change({"cleared": True, "collection": collection})
+
+
+@timed("neo4j.delete_all")
+async def delete_all_from_neo4j_async(collection=None):
+    logger.info("Deleting all nodes and relationships from Neo4j.")
+    async with get_async_driver().session() as session:
+        if collection is None:
+            await (await session.run(DELETE_ALL_QUERY)).consume()
+        else:
+            await (
+                await session.run(DELETE_COLLECTION_QUERY, collection=collection)
+            ).consume()
+    count_round_trips("delete_all")
+    notify_graph_change({"cleared": True, "collection": collection})
+
+
+def get_edit_graph_batches(
+    editedNodes, deletedEdges, addedEdges, collection, chunk_size
+):
+    # Same order as the editor applies them: edges first, then nodes
+    for batch in chunk_list(deletedEdges, chunk_size):
+        yield "deleted_relationships", DELETE_EDGES_QUERY, {
+            "edges": batch,
+            "collection": collection,
+        }
+    for batch in chunk_list(addedEdges, chunk_size):
+        yield "upserted_relationships", ADD_EDGES_QUERY, {
+            "edges": batch,
+            "collection": collection,
+        }
+
+    created, deleted, renamed = split_edited_nodes(editedNodes)
+    for batch in chunk_list(created, chunk_size):
+        yield "upserted_nodes", CREATE_NODES_QUERY, {
+            "names": batch,
+            "collection": collection,
+        }
+    for batch in chunk_list(deleted, chunk_size):
+        yield "deleted_nodes", DELETE_NODES_QUERY, {
+            "nodes": batch,
+            "collection": collection,
+        }
+    for batch in chunk_list(renamed, chunk_size):
+        yield "renamed_nodes", RENAME_NODES_QUERY, {
+            "renames": batch,
+            "collection": collection,
+        }
+
+
+def add_edit_records(changes, kind, records):
+    if kind == "deleted_nodes":
+        changes[kind] += [record["name"] for record in records]
+    elif kind == "renamed_nodes":
+        changes[kind] += [[record["oldName"], record["newName"]] for record in records]
+    else:
+        changes[kind] += records
+
+
+async def _edit_graph_async(tx, batches):
+    changes = get_empty_edit_changes()
+    for kind, query, params in batches:
+        result = await tx.run(query, **params)
+        add_edit_records(changes, kind, await result.data())
+    return changes
+
+
+@timed("neo4j.edit_graph")
+async def process_edit_graph_async(
+    editedNodes,
+    deletedEdges,
+    addedEdges,
+    collection=DEFAULT_COLLECTION,
+    chunk_size=DEFAULT_WRITE_CHUNK_SIZE,
+):
+    batches = list(
+        get_edit_graph_batches(
+            editedNodes, deletedEdges, addedEdges, collection, chunk_size
+        )
+    )
+    async with get_async_driver().session() as session:
+        changes = await session.execute_write(_edit_graph_async, batches)
+    count_round_trips("edit_graph", len(batches))
+    notify_graph_change(get_edit_graph_change(changes, collection))
+
+    return {"version": get_graph_cache(collection).version, "changes": changes}
+
+
+class Neo4jGraphStore(GraphStore):
+    name = "neo4j"
+
+    async def ensure_schema(self):
+        return await ensure_schema_async()
+
+    async def get_collections(self):
+        return await get_collections_from_neo4j_async()
+
+    async def get_all_nodes(self, collection=DEFAULT_COLLECTION):
+        return await get_all_nodes_from_neo4j_async(collection)
+
+    async def get_subgraph(self, nodes, collection=DEFAULT_COLLECTION):
+        return await get_subgraph_from_neo4j_async(nodes, collection)
+
+    async def get_fullgraph(self, collection=DEFAULT_COLLECTION):
+        return await get_fullgraph_from_neo4j_async(collection)
+
+    async def get_neighbourhood(self, nodes, collection=DEFAULT_COLLECTION):
+        return await get_neighbourhood_from_neo4j_async(nodes, collection)
+
+    async def get_nodes_page(self, after, limit, collection=DEFAULT_COLLECTION):
+        return await get_nodes_page_from_neo4j_async(after, limit, collection)
+
+    async def get_relationships_page(self, after, limit, collection=DEFAULT_COLLECTION):
+        return await get_relationships_page_from_neo4j_async(after, limit, collection)
+
+    async def iter_fullgraph(self, collection=DEFAULT_COLLECTION, page_size=None):
+        # Straight from the driver rather than a page at a time
+        async for record in iter_fullgraph_from_neo4j_async(collection):
+            yield record
+
+    async def save(self, graph, collection=DEFAULT_COLLECTION):
+        return await save_to_neo4j_async(graph, collection)
+
+    async def apply_diff(self, diff, collection=DEFAULT_COLLECTION):
+        return await apply_graph_diff_async(diff, collection)
+
+    async def delete_all(self, collection=None):
+        return await delete_all_from_neo4j_async(collection)
+
+    async def edit_graph(
+        self, editedNodes, deletedEdges, addedEdges, collection=DEFAULT_COLLECTION
+    ):
+        return await process_edit_graph_async(
+            editedNodes, deletedEdges, addedEdges, collection
+        )
+
+    async def close(self):
+        global async_neo4j_driver
+        if async_neo4j_driver is not None:
+            await async_neo4j_driver.close()
+            async_neo4j_driver = None
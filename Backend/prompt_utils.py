@@ -0,0 +1,155 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import Counter, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# The latest conversation messages are sent as they are, older ones are
+# summarized in fixed blocks so a block's summary never changes once written
+QUERY_HISTORY_RECENT_MESSAGES = int(os.getenv("QUERY_HISTORY_RECENT_MESSAGES", "6"))
+QUERY_HISTORY_SUMMARY_BLOCK = int(os.getenv("QUERY_HISTORY_SUMMARY_BLOCK", "10"))
+QUERY_HISTORY_SUMMARY_CACHE_SIZE = int(
+    os.getenv("QUERY_HISTORY_SUMMARY_CACHE_SIZE", "1024")
+)
+
+FLOWCHART_DATA_HEADER = "Flowchart data:"
+EMPTY_FIELD = "-"
+# Shorter contexts cost about as much as the id that would replace them
+SHARED_CONTEXT_MIN_LENGTH = 24
+
+
+def join_context(context):
+    return "; ".join(dict.fromkeys(text for text in context or [] if text))
+
+
+def serialize_graph(graph):
+    # Edge-list text for the query prompt. Image sources are listed once and
+    # referred to by id, as are contexts shared by several nodes or edges.
+    # Returns the text and the image name behind each id
+    items = graph["nodes"] + graph["relationships"]
+    image_ids = {}
+    for item in items:
+        for name in item.get("imageSources") or []:
+            image_ids.setdefault(name, f"I{len(image_ids) + 1}")
+    context_counts = Counter(
+        join_context(item.get("context")) for item in items if item.get("context")
+    )
+    context_ids = {}
+    for context, count in context_counts.items():
+        if count > 1 and len(context) >= SHARED_CONTEXT_MIN_LENGTH:
+            context_ids[context] = f"C{len(context_ids) + 1}"
+
+    def fields(item):
+        context = join_context(item.get("context"))
+        images = " ".join(image_ids[name] for name in item.get("imageSources") or [])
+        return f"{context_ids.get(context, context) or EMPTY_FIELD} | {images or EMPTY_FIELD}"
+
+    lines = ["Images:"]
+    lines += [f"{image_id} = {name}" for name, image_id in image_ids.items()]
+    if context_ids:
+        lines.append("Shared contexts:")
+        lines += [
+            f"{context_id} = {context}" for context, context_id in context_ids.items()
+        ]
+    lines.append("Nodes (name | context | images):")
+    lines += [f"{node['name']} | {fields(node)}" for node in graph["nodes"]]
+    lines.append("Edges (from -> to | name | context | images):")
+    lines += [
+        f"{edge['from']} -> {edge['to']} | {edge['name'] or EMPTY_FIELD} | {fields(edge)}"
+        for edge in graph["relationships"]
+    ]
+    return "\n".join(lines), {image_id: name for name, image_id in image_ids.items()}
+
+
+def resolve_image_sources(image_sources, image_names):
+    # GPT answers with image ids, the client needs the image names
+    return list(
+        dict.fromkeys(image_names.get(source, source) for source in image_sources)
+    )
+
+
+def split_history(conversation_history):
+    # Returns the complete blocks of older messages to summarize and the
+    # messages to send as they are
+    older = max(0, len(conversation_history) - QUERY_HISTORY_RECENT_MESSAGES)
+    split = older - older % QUERY_HISTORY_SUMMARY_BLOCK
+    blocks = [
+        conversation_history[start : start + QUERY_HISTORY_SUMMARY_BLOCK]
+        for start in range(0, split, QUERY_HISTORY_SUMMARY_BLOCK)
+    ]
+    return blocks, conversation_history[split:]
+
+
+def get_history_block_key(block):
+    return hashlib.sha256(json.dumps(block, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class SummaryCache:
+    # Summaries of conversation blocks, least recently used dropped first.
+    # Clients resend the whole history every turn, so each block is
+    # summarized once per conversation
+    def __init__(self, max_entries=QUERY_HISTORY_SUMMARY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            summary = self.entries.get(key)
+            if summary is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return summary
+
+    def set(self, key, summary):
+        with self.lock:
+            self.entries[key] = summary
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def get_query_messages(
+    query_prompt, user_input, summaries, recent_history, graph_text, stable_graph
+):
+    # Ordered so the start of the request repeats between calls and the
+    # provider's prompt cache can reuse it: the fixed instructions, the graph
+    # when it is the same for every question, the conversation (whose summary
+    # and messages only ever grow at the end), then what changes per question
+    messages = [{"role": "system", "content": query_prompt}]
+    data_message = f"{FLOWCHART_DATA_HEADER}\n{graph_text}"
+    if stable_graph:
+        messages.append({"role": "user", "content": data_message})
+    if summaries:
+        messages.append(
+            {
+                "role": "system",
+                "content": "Summary of the earlier conversation:\n"
+                + "\n".join(summaries),
+            }
+        )
+    messages += recent_history
+    if stable_graph:
+        messages.append({"role": "user", "content": user_input})
+    else:
+        messages.append(
+            {"role": "user", "content": f"{data_message}\n\nQuestion: {user_input}"}
+        )
+    return messages
@@ -0,0 +1,138 @@
+import re
+import math
+import logging
+import threading
+from collections import Counter, defaultdict
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+# Words in a node name say more about the node than words in its context
+NAME_WEIGHT = 2
+
+
+SUFFIXES = ("ing", "ed", "es", "s", "e")
+
+
+def stem(token):
+    # Crude suffix stripping so "validates", "validated" and "validate" match
+    for suffix in SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            return token[: -len(suffix)]
+    return token
+
+
+def tokenize(text):
+    # Split camelCase before lowercasing so "AuthService" matches "auth service"
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text)
+    return [stem(token) for token in TOKEN_PATTERN.findall(text.lower())]
+
+
+class NodeIndex:
+    # In-process BM25 index over node names and contexts, kept in sync with
+    # the graph store through the graph change notifications from storage_utils
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.ready = False
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.contexts = {}
+        self.lengths = {}
+        self.postings = defaultdict(dict)
+        self.total_length = 0
+
+    def _add(self, name, context):
+        terms = Counter(tokenize(name) * NAME_WEIGHT)
+        for text in context:
+            terms.update(tokenize(text))
+
+        self.contexts[name] = context
+        self.lengths[name] = sum(terms.values())
+        self.total_length += self.lengths[name]
+        for term, frequency in terms.items():
+            self.postings[term][name] = frequency
+
+    def _remove(self, name):
+        context = self.contexts.pop(name, None)
+        if context is None:
+            return None
+
+        self.total_length -= self.lengths.pop(name)
+        for term in set(tokenize(name)).union(*map(tokenize, context)):
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(name, None)
+                if not postings:
+                    del self.postings[term]
+        return context
+
+    def build(self, nodes):
+        with self.lock:
+            self._reset()
+            for node in nodes:
+                self._add(node["name"], list(node["context"] or []))
+            self.ready = True
+        logger.info(f"Built node search index with {len(self.contexts)} nodes.")
+
+    def apply_change(self, change):
+        # Until the first build there is nothing to keep up to date
+        if not self.ready:
+            return
+
+        with self.lock:
+            # Written by another worker process, built again on next use
+            if change.get("remote"):
+                self.ready = False
+                return
+            if change.get("cleared"):
+                self._reset()
+            for name in change.get("deleted_nodes", []):
+                self._remove(name)
+            for old_name, new_name in change.get("renamed_nodes", []):
+                context = self._remove(old_name)
+                if context is not None:
+                    self._add(new_name, context)
+            for node in change.get("upserted_nodes", []):
+                # Same set-merge as the ON MATCH branch of save_to_neo4j
+                context = self._remove(node["name"]) or []
+                context = list(dict.fromkeys(context + list(node["context"] or [])))
+                self._add(node["name"], context)
+
+    def search(self, query, top_k=15):
+        with self.lock:
+            if not self.contexts:
+                return []
+
+            node_count = len(self.contexts)
+            average_length = self.total_length / node_count or 1
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(
+                    1 + (node_count - len(postings) + 0.5) / (len(postings) + 0.5)
+                )
+                for name, frequency in postings.items():
+                    norm = self.k1 * (
+                        1 - self.b + self.b * self.lengths[name] / average_length
+                    )
+                    scores[name] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:top_k]
+
+    def get_nodes(self, names):
+        with self.lock:
+            return [
+                {"name": name, "context": self.contexts[name]}
+                for name in names
+                if name in self.contexts
+            ]
+
+    def names(self):
+        with self.lock:
+            return list(self.contexts)
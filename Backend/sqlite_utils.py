@@ -0,0 +1,600 @@
+import os
+import json
+import asyncio
+import logging
+import sqlite3
+import threading
+from metrics_utils import timed
+from storage_utils import (
+    GraphStore,
+    DEFAULT_COLLECTION,
+    get_graph_cache,
+    notify_graph_change,
+    set_union,
+    add_record_to_subgraph,
+    get_save_change,
+    get_diff_change,
+    get_empty_edit_changes,
+    get_edit_graph_change,
+    split_edited_nodes,
+    log_save_counts,
+    log_diff_counts,
+)
+
+logger = logging.getLogger(__name__)
+
+# ":memory:" keeps the graph in the process only, gone on restart
+SQLITE_GRAPH_PATH = os.getenv("SQLITE_GRAPH_PATH", "graph.sqlite3")
+
+# Lists are stored as JSON text. Relationships follow renames and deletes of
+# their nodes through the foreign keys, like DETACH DELETE does in Neo4j
+SCHEMA_MIGRATIONS = [
+    (
+        1,
+        "Nodes and relationships",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS nodes (
+                name TEXT PRIMARY KEY,
+                context TEXT NOT NULL,
+                image_sources TEXT NOT NULL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS relationships (
+                from_name TEXT NOT NULL REFERENCES nodes (name)
+                    ON UPDATE CASCADE ON DELETE CASCADE,
+                to_name TEXT NOT NULL REFERENCES nodes (name)
+                    ON UPDATE CASCADE ON DELETE CASCADE,
+                name TEXT NOT NULL,
+                context TEXT NOT NULL,
+                image_sources TEXT NOT NULL,
+                PRIMARY KEY (from_name, to_name, name)
+            )
+            """,
+            # The primary key covers lookups by from_name
+            "CREATE INDEX IF NOT EXISTS relationships_to_name ON relationships (to_name)",
+        ],
+    ),
+    (
+        2,
+        "Node names unique per collection",
+        [
+            # SQLite cannot change a primary key in place, so both tables are
+            # rebuilt with the collection in front of their keys. Existing
+            # nodes go into the default collection
+            """
+            CREATE TABLE nodes_v2 (
+                collection TEXT NOT NULL,
+                name TEXT NOT NULL,
+                context TEXT NOT NULL,
+                image_sources TEXT NOT NULL,
+                PRIMARY KEY (collection, name)
+            )
+            """,
+            """
+            CREATE TABLE relationships_v2 (
+                collection TEXT NOT NULL,
+                from_name TEXT NOT NULL,
+                to_name TEXT NOT NULL,
+                name TEXT NOT NULL,
+                context TEXT NOT NULL,
+                image_sources TEXT NOT NULL,
+                PRIMARY KEY (collection, from_name, to_name, name),
+                FOREIGN KEY (collection, from_name) REFERENCES nodes_v2 (collection, name)
+                    ON UPDATE CASCADE ON DELETE CASCADE,
+                FOREIGN KEY (collection, to_name) REFERENCES nodes_v2 (collection, name)
+                    ON UPDATE CASCADE ON DELETE CASCADE
+            )
+            """,
+            f"""
+            INSERT INTO nodes_v2
+            SELECT '{DEFAULT_COLLECTION}', name, context, image_sources FROM nodes
+            """,
+            f"""
+            INSERT INTO relationships_v2
+            SELECT '{DEFAULT_COLLECTION}', from_name, to_name, name, context, image_sources
+            FROM relationships
+            """,
+            # Relationships first, dropping nodes would cascade into them
+            "DROP TABLE relationships",
+            "DROP TABLE nodes",
+            # Renaming also points the foreign keys at the new name
+            "ALTER TABLE nodes_v2 RENAME TO nodes",
+            "ALTER TABLE relationships_v2 RENAME TO relationships",
+            "CREATE INDEX relationships_to_name ON relationships (collection, to_name)",
+        ],
+    ),
+]
+
+SAVE_NODE_SQL = """
+INSERT INTO nodes (collection, name, context, image_sources) VALUES (?, ?, ?, ?)
+ON CONFLICT (collection, name) DO UPDATE SET
+    context = set_union(context, excluded.context),
+    image_sources = set_union(image_sources, excluded.image_sources)
+"""
+
+# Relationships between nodes that do not exist are skipped, as the MATCH in
+# the Cypher query skips them
+NODES_EXIST_SQL = """
+WHERE EXISTS (SELECT 1 FROM nodes WHERE collection = ?1 AND name = ?2)
+    AND EXISTS (SELECT 1 FROM nodes WHERE collection = ?1 AND name = ?3)
+"""
+
+SAVE_RELATIONSHIP_SQL = f"""
+INSERT INTO relationships (collection, from_name, to_name, name, context, image_sources)
+SELECT ?1, ?2, ?3, ?4, ?5, ?6
+{NODES_EXIST_SQL}
+ON CONFLICT (collection, from_name, to_name, name) DO UPDATE SET
+    context = set_union(context, excluded.context),
+    image_sources = set_union(image_sources, excluded.image_sources)
+"""
+
+UPSERT_NODE_SQL = """
+INSERT INTO nodes (collection, name, context, image_sources) VALUES (?, ?, ?, ?)
+ON CONFLICT (collection, name) DO UPDATE SET
+    context = excluded.context, image_sources = excluded.image_sources
+"""
+
+UPSERT_RELATIONSHIP_SQL = f"""
+INSERT INTO relationships (collection, from_name, to_name, name, context, image_sources)
+SELECT ?1, ?2, ?3, ?4, ?5, ?6
+{NODES_EXIST_SQL}
+ON CONFLICT (collection, from_name, to_name, name) DO UPDATE SET
+    context = excluded.context, image_sources = excluded.image_sources
+"""
+
+# Edges drawn in the editor start without context, existing ones are kept
+ADD_EDGE_SQL = f"""
+INSERT INTO relationships (collection, from_name, to_name, name, context, image_sources)
+SELECT ?1, ?2, ?3, ?4, '[]', '["User Edited"]'
+{NODES_EXIST_SQL}
+ON CONFLICT (collection, from_name, to_name, name) DO NOTHING
+"""
+
+CREATE_NODE_SQL = """
+INSERT INTO nodes (collection, name, context, image_sources)
+VALUES (?, ?, '[]', '["User Edited"]')
+ON CONFLICT (collection, name) DO NOTHING
+"""
+
+DELETE_RELATIONSHIP_SQL = """
+DELETE FROM relationships
+WHERE collection = ? AND from_name = ? AND to_name = ? AND name = ?
+"""
+
+DELETE_NODE_SQL = "DELETE FROM nodes WHERE collection = ? AND name = ?"
+
+NODE_COLUMNS = "name, context, image_sources"
+RELATIONSHIP_COLUMNS = "from_name, to_name, name, context, image_sources"
+
+# Name lists are passed as one JSON parameter, so there is no limit on
+# their length. ?1 is the collection in all of these
+NODES_IN_SQL = "SELECT value FROM json_each(?2)"
+
+SUBGRAPH_SQL = f"""
+SELECT r.from_name, r.to_name, r.name, r.context, r.image_sources,
+    f.context, f.image_sources, t.context, t.image_sources
+FROM relationships r
+JOIN nodes f ON f.collection = r.collection AND f.name = r.from_name
+JOIN nodes t ON t.collection = r.collection AND t.name = r.to_name
+WHERE r.collection = ?1
+    AND (r.from_name IN ({NODES_IN_SQL}) OR r.to_name IN ({NODES_IN_SQL}))
+"""
+
+NEIGHBOURHOOD_NODES_SQL = f"""
+SELECT {NODE_COLUMNS} FROM nodes
+WHERE collection = ?1 AND (
+    name IN ({NODES_IN_SQL})
+    OR name IN (
+        SELECT to_name FROM relationships
+        WHERE collection = ?1 AND from_name IN ({NODES_IN_SQL})
+    )
+    OR name IN (
+        SELECT from_name FROM relationships
+        WHERE collection = ?1 AND to_name IN ({NODES_IN_SQL})
+    )
+)
+"""
+
+NEIGHBOURHOOD_RELATIONSHIPS_SQL = f"""
+SELECT {RELATIONSHIP_COLUMNS} FROM relationships
+WHERE collection = ?1
+    AND (from_name IN ({NODES_IN_SQL}) OR to_name IN ({NODES_IN_SQL}))
+"""
+
+# Both walk the primary key from the last row of the previous page
+NODES_PAGE_SQL = f"""
+SELECT {NODE_COLUMNS} FROM nodes
+WHERE collection = ?1 AND name > ?2
+ORDER BY name
+LIMIT ?3
+"""
+
+RELATIONSHIPS_PAGE_SQL = f"""
+SELECT {RELATIONSHIP_COLUMNS} FROM relationships
+WHERE collection = ?1 AND (from_name, to_name, name) > (?2, ?3, ?4)
+ORDER BY from_name, to_name, name
+LIMIT ?5
+"""
+
+
+def _set_union_json(existing, added):
+    return json.dumps(set_union(json.loads(existing), json.loads(added)))
+
+
+def node_row(collection, node):
+    return (
+        collection,
+        node["name"],
+        json.dumps(node["context"] or []),
+        json.dumps(node["imageSources"] or []),
+    )
+
+
+def relationship_row(collection, relationship):
+    return (
+        collection,
+        relationship["from"],
+        relationship["to"],
+        relationship["name"],
+        json.dumps(relationship["context"] or []),
+        json.dumps(relationship["imageSources"] or []),
+    )
+
+
+def node_from_row(row):
+    name, context, image_sources = row
+    return {
+        "name": name,
+        "context": json.loads(context),
+        "imageSources": json.loads(image_sources),
+    }
+
+
+def relationship_from_row(row):
+    from_name, to_name, name, context, image_sources = row
+    return {
+        "from": from_name,
+        "to": to_name,
+        "name": name,
+        "context": json.loads(context),
+        "imageSources": json.loads(image_sources),
+    }
+
+
+class SQLiteGraphStore(GraphStore):
+    # The graph in a SQLite file inside the backend process, for single node
+    # deployments and test runs without a Neo4j server. One connection is
+    # shared by all threads and used by one at a time, writes are one
+    # transaction each. The async methods run the queries in a worker thread
+    name = "sqlite"
+
+    def __init__(self, path=SQLITE_GRAPH_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        if path != ":memory:":
+            self.connection.execute("PRAGMA journal_mode = WAL")
+            self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.create_function(
+            "set_union", 2, _set_union_json, deterministic=True
+        )
+
+    def _read(self, query, params=()):
+        with self.lock:
+            return self.connection.execute(query, params).fetchall()
+
+    def _write(self, work):
+        # Runs work(connection) in one transaction, all of it or nothing
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(self.connection)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+            return result
+
+    @timed("sqlite.ensure_schema")
+    def ensure_schema_sync(self):
+        def migrate(connection):
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            for migration_version, description, statements in SCHEMA_MIGRATIONS:
+                if migration_version <= version:
+                    continue
+                logger.info(
+                    f"Applying schema migration {migration_version}: {description}."
+                )
+                for statement in statements:
+                    connection.execute(statement)
+                connection.execute(f"PRAGMA user_version = {migration_version}")
+                version = migration_version
+            return version
+
+        version = self._write(migrate)
+        logger.info(f"SQLite graph schema is at version {version}.")
+        return version
+
+    @timed("sqlite.collections")
+    def get_collections_sync(self):
+        return [
+            {"collection": collection, "nodes": nodes}
+            for collection, nodes in self._read(
+                "SELECT collection, count(*) FROM nodes GROUP BY collection ORDER BY collection"
+            )
+        ]
+
+    @timed("sqlite.all_nodes")
+    def get_all_nodes_sync(self, collection=DEFAULT_COLLECTION):
+        logger.info("Getting all nodes from SQLite.")
+        return [
+            {"name": name, "context": json.loads(context)}
+            for name, context in self._read(
+                "SELECT name, context FROM nodes WHERE collection = ?", (collection,)
+            )
+        ]
+
+    @timed("sqlite.subgraph")
+    def get_subgraph_sync(self, nodes, collection=DEFAULT_COLLECTION):
+        logger.info("Getting subgraph from SQLite.")
+        names = json.dumps(list(nodes))
+        subgraph = {"nodes": [], "relationships": []}
+        nodes_set = set()
+        for row in self._read(SUBGRAPH_SQL, (collection, names)):
+            record = dict(
+                zip(
+                    (
+                        "from",
+                        "to",
+                        "name",
+                        "relationship_context",
+                        "relationship_imageSources",
+                        "from_context",
+                        "from_imageSources",
+                        "to_context",
+                        "to_imageSources",
+                    ),
+                    row,
+                )
+            )
+            for key in list(record)[3:]:
+                record[key] = json.loads(record[key])
+            add_record_to_subgraph(subgraph, nodes_set, record)
+        return subgraph
+
+    @timed("sqlite.fullgraph")
+    def get_fullgraph_sync(self, collection=DEFAULT_COLLECTION):
+        logger.info("Getting full graph from SQLite.")
+        # Both reads under the lock, so they see the same version
+        with self.lock:
+            nodes = self.connection.execute(
+                f"SELECT {NODE_COLUMNS} FROM nodes WHERE collection = ?",
+                (collection,),
+            ).fetchall()
+            relationships = self.connection.execute(
+                f"SELECT {RELATIONSHIP_COLUMNS} FROM relationships WHERE collection = ?",
+                (collection,),
+            ).fetchall()
+        return {
+            "nodes": [node_from_row(row) for row in nodes],
+            "relationships": [relationship_from_row(row) for row in relationships],
+        }
+
+    @timed("sqlite.nodes_page")
+    def get_nodes_page_sync(self, after, limit, collection=DEFAULT_COLLECTION):
+        rows = self._read(NODES_PAGE_SQL, (collection, after, limit))
+        return [node_from_row(row) for row in rows]
+
+    @timed("sqlite.relationships_page")
+    def get_relationships_page_sync(self, after, limit, collection=DEFAULT_COLLECTION):
+        rows = self._read(RELATIONSHIPS_PAGE_SQL, (collection, *after, limit))
+        return [relationship_from_row(row) for row in rows]
+
+    @timed("sqlite.neighbourhood")
+    def get_neighbourhood_sync(self, nodes, collection=DEFAULT_COLLECTION):
+        logger.info("Getting neighbourhood of nodes from SQLite.")
+        names = json.dumps(list(nodes))
+        with self.lock:
+            node_rows = self.connection.execute(
+                NEIGHBOURHOOD_NODES_SQL, (collection, names)
+            ).fetchall()
+            relationship_rows = self.connection.execute(
+                NEIGHBOURHOOD_RELATIONSHIPS_SQL, (collection, names)
+            ).fetchall()
+        return {
+            "nodes": [node_from_row(row) for row in node_rows],
+            "relationships": [relationship_from_row(row) for row in relationship_rows],
+        }
+
+    @timed("sqlite.save")
+    def save_sync(self, graph, collection=DEFAULT_COLLECTION):
+        logger.info("Saving connections to SQLite.")
+
+        def save(connection):
+            # Nodes have to be written before the relationships that need them
+            return {
+                "nodes": connection.executemany(
+                    SAVE_NODE_SQL,
+                    [node_row(collection, node) for node in graph["nodes"]],
+                ).rowcount,
+                "relationships": connection.executemany(
+                    SAVE_RELATIONSHIP_SQL,
+                    [
+                        relationship_row(collection, rel)
+                        for rel in graph["relationships"]
+                    ],
+                ).rowcount,
+                "transactions": 1,
+            }
+
+        counts = self._write(save)
+        log_save_counts(counts)
+        notify_graph_change(get_save_change(graph, collection))
+        return counts
+
+    @timed("sqlite.apply_diff")
+    def apply_diff_sync(self, diff, collection=DEFAULT_COLLECTION):
+        if not any(diff.values()):
+            return
+
+        def apply(connection):
+            # Same order as the Neo4j batches: merged nodes first, replaced
+            # nodes last
+            connection.executemany(
+                UPSERT_NODE_SQL,
+                [node_row(collection, node) for node in diff["upserted_nodes"]],
+            )
+            connection.executemany(
+                DELETE_RELATIONSHIP_SQL,
+                [
+                    (collection, rel["from"], rel["to"], rel["name"])
+                    for rel in diff["deleted_relationships"]
+                ],
+            )
+            connection.executemany(
+                UPSERT_RELATIONSHIP_SQL,
+                [
+                    relationship_row(collection, rel)
+                    for rel in diff["upserted_relationships"]
+                ],
+            )
+            connection.executemany(
+                DELETE_NODE_SQL,
+                [(collection, name) for name in diff["deleted_nodes"]],
+            )
+
+        self._write(apply)
+        log_diff_counts(diff)
+        notify_graph_change(get_diff_change(diff, collection))
+
+    @timed("sqlite.delete_all")
+    def delete_all_sync(self, collection=None):
+        # Every collection unless one is given
+        logger.info("Deleting all nodes and relationships from SQLite.")
+
+        def delete_all(connection):
+            if collection is None:
+                connection.execute("DELETE FROM relationships")
+                connection.execute("DELETE FROM nodes")
+            else:
+                connection.execute(
+                    "DELETE FROM relationships WHERE collection = ?", (collection,)
+                )
+                connection.execute(
+                    "DELETE FROM nodes WHERE collection = ?", (collection,)
+                )
+
+        self._write(delete_all)
+        notify_graph_change({"cleared": True, "collection": collection})
+
+    @timed("sqlite.edit_graph")
+    def edit_graph_sync(
+        self, editedNodes, deletedEdges, addedEdges, collection=DEFAULT_COLLECTION
+    ):
+        # Same order and results as process_edit_graph_async in neo4j_utils
+        created, deleted, renamed = split_edited_nodes(editedNodes)
+
+        def edit(connection):
+            changes = get_empty_edit_changes()
+            for edge in deletedEdges:
+                cursor = connection.execute(
+                    DELETE_RELATIONSHIP_SQL,
+                    (collection, edge["from"], edge["to"], edge["label"]),
+                )
+                if cursor.rowcount:
+                    changes["deleted_relationships"].append(
+                        {"from": edge["from"], "to": edge["to"], "name": edge["label"]}
+                    )
+            for edge in addedEdges:
+                key = (collection, edge["from"], edge["to"], edge["label"])
+                connection.execute(ADD_EDGE_SQL, key)
+                row = connection.execute(
+                    f"SELECT {RELATIONSHIP_COLUMNS} FROM relationships "
+                    "WHERE collection = ? AND from_name = ? AND to_name = ? AND name = ?",
+                    key,
+                ).fetchone()
+                if row:
+                    changes["upserted_relationships"].append(relationship_from_row(row))
+            for name in created:
+                connection.execute(CREATE_NODE_SQL, (collection, name))
+                row = connection.execute(
+                    f"SELECT {NODE_COLUMNS} FROM nodes WHERE collection = ? AND name = ?",
+                    (collection, name),
+                ).fetchone()
+                changes["upserted_nodes"].append(node_from_row(row))
+            for name in deleted:
+                cursor = connection.execute(DELETE_NODE_SQL, (collection, name))
+                if cursor.rowcount:
+                    changes["deleted_nodes"].append(name)
+            for rename in renamed:
+                # A name that is already taken fails the whole edit, as the
+                # unique constraint does in Neo4j
+                cursor = connection.execute(
+                    "UPDATE nodes SET name = ? WHERE collection = ? AND name = ?",
+                    (rename["newName"], collection, rename["oldName"]),
+                )
+                if cursor.rowcount:
+                    changes["renamed_nodes"].append(
+                        [rename["oldName"], rename["newName"]]
+                    )
+            return changes
+
+        changes = self._write(edit)
+        notify_graph_change(get_edit_graph_change(changes, collection))
+        return {"version": get_graph_cache(collection).version, "changes": changes}
+
+    def close_sync(self):
+        with self.lock:
+            self.connection.close()
+
+    async def ensure_schema(self):
+        return await asyncio.to_thread(self.ensure_schema_sync)
+
+    async def get_collections(self):
+        return await asyncio.to_thread(self.get_collections_sync)
+
+    async def get_all_nodes(self, collection=DEFAULT_COLLECTION):
+        return await asyncio.to_thread(self.get_all_nodes_sync, collection)
+
+    async def get_subgraph(self, nodes, collection=DEFAULT_COLLECTION):
+        return await asyncio.to_thread(self.get_subgraph_sync, nodes, collection)
+
+    async def get_fullgraph(self, collection=DEFAULT_COLLECTION):
+        return await asyncio.to_thread(self.get_fullgraph_sync, collection)
+
+    async def get_neighbourhood(self, nodes, collection=DEFAULT_COLLECTION):
+        return await asyncio.to_thread(self.get_neighbourhood_sync, nodes, collection)
+
+    async def get_nodes_page(self, after, limit, collection=DEFAULT_COLLECTION):
+        return await asyncio.to_thread(
+            self.get_nodes_page_sync, after, limit, collection
+        )
+
+    async def get_relationships_page(self, after, limit, collection=DEFAULT_COLLECTION):
+        return await asyncio.to_thread(
+            self.get_relationships_page_sync, after, limit, collection
+        )
+
+    async def save(self, graph, collection=DEFAULT_COLLECTION):
+        return await asyncio.to_thread(self.save_sync, graph, collection)
+
+    async def apply_diff(self, diff, collection=DEFAULT_COLLECTION):
+        return await asyncio.to_thread(self.apply_diff_sync, diff, collection)
+
+    async def delete_all(self, collection=None):
+        return await asyncio.to_thread(self.delete_all_sync, collection)
+
+    async def edit_graph(
+        self, editedNodes, deletedEdges, addedEdges, collection=DEFAULT_COLLECTION
+    ):
+        return await asyncio.to_thread(
+            self.edit_graph_sync, editedNodes, deletedEdges, addedEdges, collection
+        )
+
+    async def close(self):
+        await asyncio.to_thread(self.close_sync)
@@ -0,0 +1,564 @@
+import os
+import json
+import time
+import base64
+import asyncio
+import sqlite3
+import logging
+import functools
+import threading
+from graph_utils import GraphCache
+
+logger = logging.getLogger(__name__)
+
+# Where the graph is kept: "neo4j" for a Neo4j server, "sqlite" for an
+# embedded SQLite file in the backend process
+GRAPH_STORE = os.getenv("GRAPH_STORE", "neo4j")
+
+# Tile graphs waiting for the upload's writer, GPT workers wait when it is full
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", "64"))
+# The writer saves what it has coalesced once it holds this many nodes, or
+# once its oldest graph has waited this long
+WRITE_BATCH_MAX_NODES = int(os.getenv("WRITE_BATCH_MAX_NODES", "500"))
+WRITE_BATCH_MAX_SECONDS = float(os.getenv("WRITE_BATCH_MAX_SECONDS", "2"))
+
+# Records in a page of the graph when paging through it, by default and at
+# most. Streaming the graph reads it a page at a time too
+GRAPH_PAGE_SIZE = int(os.getenv("GRAPH_PAGE_SIZE", "1000"))
+GRAPH_PAGE_MAX_SIZE = int(os.getenv("GRAPH_PAGE_MAX_SIZE", "10000"))
+
+# Every upload goes into a named collection of nodes, and reads, edits and
+# merges only see the nodes of one collection. Graphs from before collections
+# existed are in this one
+DEFAULT_COLLECTION = "default"
+
+# With several worker processes each has its own snapshots, search indexes
+# and answer caches. Writes are counted per collection in this file, so every
+# process notices the writes of the others
+GRAPH_VERSIONS_PATH = os.getenv("GRAPH_VERSIONS_PATH", "cache/graph_versions.sqlite3")
+# Row counting the writes that touch every collection at once
+ALL_COLLECTIONS = ""
+
+# Callbacks told about every write so in-process views of the graph stay current
+graph_change_listeners = []
+# Snapshot of the full graph of each collection, dropped on every write to it
+graph_caches = {}
+
+
+def get_graph_cache(collection=DEFAULT_COLLECTION):
+    cache = graph_caches.get(collection)
+    if cache is None:
+        cache = graph_caches.setdefault(collection, GraphCache())
+    return cache
+
+
+def add_graph_change_listener(listener):
+    graph_change_listeners.append(listener)
+
+
+class SharedGraphVersions:
+    # Write counters shared by the worker processes of one backend
+    def __init__(self, path=GRAPH_VERSIONS_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=30
+        )
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS graph_versions (
+                collection TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            )
+            """)
+        # Versions this process has caught up with
+        self.seen = dict(self._read())
+
+    def _read(self):
+        return self.connection.execute(
+            "SELECT collection, version FROM graph_versions"
+        ).fetchall()
+
+    def bump(self, collection):
+        # Counts a write made here. True if another process wrote to the
+        # collection since this one last looked
+        key = ALL_COLLECTIONS if collection is None else collection
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(
+                    """
+                    INSERT INTO graph_versions (collection, version) VALUES (?, 1)
+                    ON CONFLICT (collection) DO UPDATE SET version = version + 1
+                    """,
+                    (key,),
+                )
+                version = self.connection.execute(
+                    "SELECT version FROM graph_versions WHERE collection = ?", (key,)
+                ).fetchone()[0]
+            finally:
+                self.connection.execute("COMMIT")
+            missed = version != self.seen.get(key, 0) + 1
+            self.seen[key] = version
+            return missed
+
+    def poll(self):
+        # Collections other processes wrote to since the last look, None for
+        # a write to all of them
+        with self.lock:
+            changed = []
+            for key, version in self._read():
+                if self.seen.get(key) != version:
+                    self.seen[key] = version
+                    changed.append(None if key == ALL_COLLECTIONS else key)
+            return changed
+
+
+# Only set when the backend runs in several worker processes
+shared_graph_versions = None
+
+
+def share_graph_changes(path=GRAPH_VERSIONS_PATH):
+    global shared_graph_versions
+    shared_graph_versions = SharedGraphVersions(path)
+
+
+def sync_graph_changes():
+    # Drops what this process keeps of the collections other processes wrote
+    # to, called before reading the graph through the in-process caches. Only
+    # the graph store knows what a remote change changed
+    if shared_graph_versions is None:
+        return
+    for collection in shared_graph_versions.poll():
+        _notify_listeners({"collection": collection, "remote": True})
+
+
+def notify_graph_change(change):
+    _notify_listeners(change)
+    if shared_graph_versions is not None and shared_graph_versions.bump(
+        change.get("collection")
+    ):
+        _notify_listeners({"collection": change.get("collection"), "remote": True})
+
+
+def _notify_listeners(change):
+    # A change without a collection, like deleting everything, touches them all
+    if change.get("collection") is None:
+        for cache in list(graph_caches.values()):
+            cache.invalidate()
+    else:
+        get_graph_cache(change["collection"]).invalidate()
+    for listener in graph_change_listeners:
+        try:
+            listener(change)
+        except Exception as e:
+            logger.error(f"Graph change listener failed: {e}")
+
+
+def chunk_list(items, chunk_size):
+    for i in range(0, len(items), chunk_size):
+        yield items[i : i + chunk_size]
+
+
+def set_union(existing, added):
+    # Order kept, duplicates dropped, like apoc.coll.toSet(existing + added)
+    return list(dict.fromkeys(list(existing or []) + list(added or [])))
+
+
+def add_record_to_subgraph(subgraph, nodes_set, record):
+    relationship = {
+        "name": record["name"],
+        "from": record["from"],
+        "to": record["to"],
+        "context": record["relationship_context"],
+        "imageSources": record["relationship_imageSources"],
+    }
+    subgraph["relationships"].append(relationship)
+
+    from_node = {
+        "name": record["from"],
+        "context": record["from_context"],
+        "imageSources": record["from_imageSources"],
+    }
+    if from_node["name"] not in nodes_set:
+        subgraph["nodes"].append(from_node)
+        nodes_set.add(from_node["name"])
+
+    to_node = {
+        "name": record["to"],
+        "context": record["to_context"],
+        "imageSources": record["to_imageSources"],
+    }
+    if to_node["name"] not in nodes_set:
+        subgraph["nodes"].append(to_node)
+        nodes_set.add(to_node["name"])
+
+
+def encode_page_cursor(kind, key):
+    # Where the next page starts: after this node name, or after this
+    # (from, to, name) of a relationship
+    text = json.dumps([kind, key], separators=(",", ":"))
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+
+def decode_page_cursor(cursor):
+    # Node names are never empty, so "" comes before all of them
+    if not cursor:
+        return "nodes", ""
+    try:
+        kind, key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid page cursor.")
+    if kind == "nodes" and isinstance(key, str):
+        return kind, key
+    if kind == "relationships" and isinstance(key, list) and len(key) == 3:
+        return kind, tuple(key)
+    raise ValueError("Invalid page cursor.")
+
+
+def get_relationship_key(relationship):
+    # Relationships without a name sort as "", as the page queries order them
+    return (relationship["from"], relationship["to"], relationship["name"] or "")
+
+
+def get_save_change(graph, collection):
+    return {
+        "collection": collection,
+        "upserted_nodes": graph["nodes"],
+        "relationships_changed": True,
+    }
+
+
+def get_diff_change(diff, collection):
+    return {
+        "collection": collection,
+        "upserted_nodes": diff["upserted_nodes"],
+        "deleted_nodes": diff["deleted_nodes"],
+        "relationships_changed": bool(
+            diff["deleted_relationships"] or diff["upserted_relationships"]
+        ),
+    }
+
+
+def get_empty_edit_changes():
+    return {
+        "upserted_nodes": [],
+        "deleted_nodes": [],
+        "renamed_nodes": [],
+        "upserted_relationships": [],
+        "deleted_relationships": [],
+    }
+
+
+def get_edit_graph_change(changes, collection):
+    return {
+        "collection": collection,
+        "upserted_nodes": changes["upserted_nodes"],
+        "deleted_nodes": changes["deleted_nodes"],
+        "renamed_nodes": [tuple(rename) for rename in changes["renamed_nodes"]],
+        "relationships_changed": bool(
+            changes["upserted_relationships"] or changes["deleted_relationships"]
+        ),
+    }
+
+
+def split_edited_nodes(editedNodes):
+    # If old name is empty, then create a new node
+    # if new name is empty, then delete the node
+    # Otherwise, rename the node
+    created = [node["newName"] for node in editedNodes if node["oldName"] == ""]
+    deleted = [
+        node["oldName"]
+        for node in editedNodes
+        if node["oldName"] != "" and node["newName"] == ""
+    ]
+    renamed = [
+        {"oldName": node["oldName"], "newName": node["newName"]}
+        for node in editedNodes
+        if node["oldName"] != "" and node["newName"] != ""
+    ]
+    return created, deleted, renamed
+
+
+def log_save_counts(counts):
+    logger.info(
+        f"Saved {counts['nodes']} nodes and {counts['relationships']} relationships in {counts['transactions']} transactions."
+    )
+
+
+def log_diff_counts(diff):
+    logger.info(
+        f"Applied graph diff: {len(diff['upserted_nodes'])} nodes upserted, {len(diff['deleted_nodes'])} deleted, "
+        f"{len(diff['upserted_relationships'])} relationships upserted, {len(diff['deleted_relationships'])} deleted."
+    )
+
+
+class GraphStore:
+    # What the backend needs from the graph database. Nodes are unique by
+    # collection and name, relationships join nodes of one collection and are
+    # unique by (from, to, name). Every method works on one collection. Saving
+    # merges context and image sources into what is stored as sets, a diff or
+    # an edit replaces them. Every write is one transaction and ends with
+    # notify_graph_change
+    name = None
+
+    async def ensure_schema(self):
+        raise NotImplementedError
+
+    async def get_collections(self):
+        # Every collection with the number of nodes in it
+        raise NotImplementedError
+
+    async def get_all_nodes(self, collection=DEFAULT_COLLECTION):
+        # Names and contexts of all nodes
+        raise NotImplementedError
+
+    async def get_subgraph(self, nodes, collection=DEFAULT_COLLECTION):
+        # Every relationship touching the given nodes, with both its ends
+        raise NotImplementedError
+
+    async def get_fullgraph(self, collection=DEFAULT_COLLECTION):
+        raise NotImplementedError
+
+    async def get_neighbourhood(self, nodes, collection=DEFAULT_COLLECTION):
+        # The given nodes, their direct neighbours and every edge of the
+        # given nodes
+        raise NotImplementedError
+
+    async def get_nodes_page(self, after, limit, collection=DEFAULT_COLLECTION):
+        # Up to limit nodes with names after the given one, ordered by name
+        raise NotImplementedError
+
+    async def get_relationships_page(self, after, limit, collection=DEFAULT_COLLECTION):
+        # Up to limit relationships after the given (from, to, name), ordered
+        # by those
+        raise NotImplementedError
+
+    async def save(self, graph, collection=DEFAULT_COLLECTION):
+        # Returns the nodes, relationships and transactions written
+        raise NotImplementedError
+
+    async def apply_diff(self, diff, collection=DEFAULT_COLLECTION):
+        raise NotImplementedError
+
+    async def delete_all(self, collection=None):
+        # Only the given collection, or everything without one
+        raise NotImplementedError
+
+    async def edit_graph(
+        self, editedNodes, deletedEdges, addedEdges, collection=DEFAULT_COLLECTION
+    ):
+        # Returns the graph version after the edit and what it changed
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    async def get_snapshot(self, collection=DEFAULT_COLLECTION):
+        return await get_graph_cache(collection).get_async(
+            functools.partial(self.get_fullgraph, collection)
+        )
+
+    async def get_graph_page(self, cursor, limit, collection=DEFAULT_COLLECTION):
+        # The nodes by name and then the relationships by (from, to, name),
+        # limit records a page, and the cursor of the next page or None after
+        # the last. Pages are read as they are asked for, so a write between
+        # two of them shows in the later one
+        kind, after = decode_page_cursor(cursor)
+        page = {"nodes": [], "relationships": [], "next_cursor": None}
+        if kind == "nodes":
+            page["nodes"] = await self.get_nodes_page(after, limit, collection)
+            if len(page["nodes"]) == limit:
+                page["next_cursor"] = encode_page_cursor(
+                    "nodes", page["nodes"][-1]["name"]
+                )
+                return page
+            limit -= len(page["nodes"])
+            after = ("", "", "")
+        page["relationships"] = await self.get_relationships_page(
+            after, limit, collection
+        )
+        if len(page["relationships"]) == limit:
+            page["next_cursor"] = encode_page_cursor(
+                "relationships", get_relationship_key(page["relationships"][-1])
+            )
+        return page
+
+    async def iter_fullgraph(self, collection=DEFAULT_COLLECTION, page_size=None):
+        # ("node", node) and then ("relationship", relationship) pairs, read a
+        # page at a time so memory use does not grow with the graph
+        page_size = page_size or GRAPH_PAGE_SIZE
+        after = ""
+        while True:
+            nodes = await self.get_nodes_page(after, page_size, collection)
+            for node in nodes:
+                yield "node", node
+            if len(nodes) < page_size:
+                break
+            after = nodes[-1]["name"]
+        after = ("", "", "")
+        while True:
+            relationships = await self.get_relationships_page(
+                after, page_size, collection
+            )
+            for relationship in relationships:
+                yield "relationship", relationship
+            if len(relationships) < page_size:
+                break
+            after = get_relationship_key(relationships[-1])
+
+
+class GraphBatch:
+    # Graphs coalesced into one, nodes unique by name and relationships by
+    # (from, to, name) with context and image sources unioned as a save would
+    def __init__(self):
+        self.nodes = {}
+        self.relationships = {}
+        self.keys = []
+        self.started_at = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, graph):
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+        self.keys.append(key)
+        for node in graph["nodes"]:
+            self._union(self.nodes, node["name"], node)
+        for relationship in graph["relationships"]:
+            relationship_key = (
+                relationship["from"],
+                relationship["to"],
+                relationship["name"],
+            )
+            self._union(self.relationships, relationship_key, relationship)
+
+    def _union(self, items, key, item):
+        existing = items.get(key)
+        if existing is None:
+            items[key] = {
+                **item,
+                "context": set_union([], item["context"]),
+                "imageSources": set_union([], item["imageSources"]),
+            }
+            return
+        existing["context"] = set_union(existing["context"], item["context"])
+        existing["imageSources"] = set_union(
+            existing["imageSources"], item["imageSources"]
+        )
+
+    def to_graph(self):
+        return {
+            "nodes": list(self.nodes.values()),
+            "relationships": list(self.relationships.values()),
+        }
+
+
+class GraphWriter:
+    # Single consumer of the tile graphs of an upload. Tiles put their graph
+    # on a bounded queue, the writer coalesces them into a GraphBatch and
+    # saves it in one go, so overlapping tiles do not race each other's
+    # MERGEs on the same names. on_flush(keys, error) is awaited after every
+    # save, with the exception if it failed
+    def __init__(
+        self,
+        store,
+        on_flush,
+        collection=DEFAULT_COLLECTION,
+        max_nodes=WRITE_BATCH_MAX_NODES,
+        max_seconds=WRITE_BATCH_MAX_SECONDS,
+        queue_size=WRITE_QUEUE_SIZE,
+    ):
+        self.store = store
+        self.on_flush = on_flush
+        self.collection = collection
+        self.max_nodes = max_nodes
+        self.max_seconds = max_seconds
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.task = None
+        self.errors = []
+        self.stats = {"graphs": 0, "flushes": 0, "transactions": 0, "failed": 0}
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def put(self, key, graph):
+        await self._put((key, graph))
+
+    async def close(self):
+        # Flushes what is left and returns the stats once everything is saved
+        await self._put(None)
+        await self.task
+        return self.stats
+
+    async def _put(self, item):
+        # Waits for room on the queue unless the writer stops first, as
+        # nothing would ever take the item off a full queue then
+        if not self.task.done():
+            put = asyncio.ensure_future(self.queue.put(item))
+            try:
+                done, _ = await asyncio.wait(
+                    {put, self.task}, return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                put.cancel()
+            if put in done:
+                return put.result()
+        if not self.task.cancelled() and self.task.exception():
+            raise self.task.exception()
+        raise RuntimeError("The graph writer has stopped.")
+
+    def cancel(self):
+        if self.task:
+            self.task.cancel()
+
+    async def _run(self):
+        batch = GraphBatch()
+        while True:
+            timeout = None
+            if batch.started_at is not None:
+                timeout = max(0, batch.started_at + self.max_seconds - time.monotonic())
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                item = False
+
+            if item:
+                batch.add(*item)
+                self.stats["graphs"] += 1
+                if len(batch.nodes) < self.max_nodes:
+                    continue
+            if len(batch):
+                await self._flush(batch)
+                batch = GraphBatch()
+            if item is None:
+                return
+
+    async def _flush(self, batch):
+        error = None
+        try:
+            counts = await self.store.save(batch.to_graph(), self.collection)
+            self.stats["transactions"] += (counts or {}).get("transactions", 0)
+        except Exception as e:
+            logger.error(f"Saving {len(batch)} coalesced graphs failed: {e}")
+            self.stats["failed"] += len(batch)
+            self.errors.append(e)
+            error = e
+        self.stats["flushes"] += 1
+        await self.on_flush(batch.keys, error)
+
+
+def get_graph_store(kind=GRAPH_STORE):
+    # Imported here so that only the chosen store's driver is loaded
+    if kind == "neo4j":
+        from neo4j_utils import Neo4jGraphStore
+
+        return Neo4jGraphStore()
+    if kind == "sqlite":
+        from sqlite_utils import SQLiteGraphStore
+
+        return SQLiteGraphStore()
+    raise ValueError(f"Unknown GRAPH_STORE {kind!r}, use neo4j or sqlite.")
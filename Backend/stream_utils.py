@@ -0,0 +1,214 @@
+import json
+
+CODE_FENCE = "```json"
+WHITESPACE = " \t\r\n"
+
+
+def parse_answer(response):
+    # The query prompt asks for {"text": ..., "imageSources": [...]}, anything
+    # else is shown to the user as it is
+    response = response.strip()
+    if response.startswith(CODE_FENCE):
+        response = response[len(CODE_FENCE) :]
+    if response.endswith("```"):
+        response = response[:-3]
+    try:
+        answer = json.loads(response)
+    except json.JSONDecodeError:
+        answer = None
+    if not isinstance(answer, dict) or not isinstance(answer.get("text"), str):
+        return response, []
+    image_sources = answer.get("imageSources")
+    if not isinstance(image_sources, list):
+        image_sources = []
+    return answer["text"], [name for name in image_sources if isinstance(name, str)]
+
+
+def format_sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def format_ndjson_record(kind, record):
+    # One line of an NDJSON stream, with the kind of record in "type"
+    return json.dumps({"type": kind, **record}) + "\n"
+
+
+class AnswerStreamParser:
+    # Reads the query answer while GPT is still writing it. feed() returns the
+    # part of "text" that can be shown so far and every imageSources entry
+    # that has been closed since the last call, without waiting for the JSON
+    # to be complete. Answers that are not a JSON object pass through as text
+    def __init__(self):
+        self.chunks = []
+        self.mode = "start"
+        self.pending = ""
+        self.state = "key"
+        self.key = None
+        # The string being read, what it is for and an unfinished escape
+        self.string = []
+        self.string_target = None
+        self.escape = None
+        self.high_surrogate = ""
+        # Values of other keys are skipped, nested or not
+        self.skip_depth = 0
+        self.skip_in_string = False
+        self.skip_escape = False
+        self.skip_return = None
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+        if self.mode == "start":
+            self.pending += chunk
+            chunk = self._detect_mode()
+            if chunk is None:
+                return "", []
+        if self.mode == "raw":
+            return chunk, []
+        if self.mode == "done":
+            return "", []
+
+        text, image_sources = [], []
+        i = 0
+        while i < len(chunk) and self.mode == "object":
+            if self._step(chunk[i], text, image_sources):
+                i += 1
+        return "".join(text), image_sources
+
+    def result(self):
+        # The complete answer, parsed the same way as a non-streamed one
+        return parse_answer("".join(self.chunks))
+
+    def _detect_mode(self):
+        rest = self.pending.lstrip()
+        # Could still turn into a code fence or the opening brace
+        if CODE_FENCE.startswith(rest):
+            return None
+        if rest.startswith(CODE_FENCE):
+            rest = rest[len(CODE_FENCE) :].lstrip()
+            if not rest:
+                return None
+        if rest.startswith("{"):
+            self.mode = "object"
+            return rest[1:]
+        self.mode = "raw"
+        return self.pending
+
+    def _start_string(self, target):
+        self.string = []
+        self.string_target = target
+        self.state = "string"
+
+    def _start_skip(self, char, return_state):
+        self.skip_return = return_state
+        self.state = "skip"
+        if char in "[{":
+            self.skip_depth = 1
+        elif char == '"':
+            self.skip_depth = 0
+            self.skip_in_string = True
+        else:
+            # A number, true, false or null, which ends at the next delimiter
+            self.skip_depth = 0
+
+    def _read_escape(self, char):
+        # Returns the decoded character(s), or None while incomplete
+        self.escape += char
+        if self.escape[1] == "u" and len(self.escape) < 6:
+            return None
+        self.escape, escape = None, self.escape
+        try:
+            decoded = json.loads(f'"{escape}"')
+        except json.JSONDecodeError:
+            return escape
+        # A character outside the BMP arrives as two \u escapes
+        if "\ud800" <= decoded <= "\udbff":
+            self.high_surrogate = decoded
+            return ""
+        if self.high_surrogate:
+            decoded = (
+                (self.high_surrogate + decoded)
+                .encode("utf-16", "surrogatepass")
+                .decode("utf-16")
+            )
+            self.high_surrogate = ""
+        return decoded
+
+    def _end_string(self, text, image_sources):
+        value = "".join(self.string)
+        if self.string_target == "key":
+            self.key = value
+            self.state = "colon"
+        elif self.string_target == "text":
+            self.state = "key"
+        elif self.string_target == "image":
+            image_sources.append(value)
+            self.state = "array"
+
+    def _step(self, char, text, image_sources):
+        # Consumes one character of the object, returns False when the same
+        # character has to be read again in the new state
+        state = self.state
+        if state == "string":
+            if self.escape is not None:
+                decoded = self._read_escape(char)
+                if decoded is not None:
+                    self.string.append(decoded)
+                    if self.string_target == "text":
+                        text.append(decoded)
+            elif char == "\\":
+                self.escape = char
+            elif char == '"':
+                self._end_string(text, image_sources)
+            else:
+                self.string.append(char)
+                if self.string_target == "text":
+                    text.append(char)
+        elif state == "skip":
+            if self.skip_in_string:
+                if self.skip_escape:
+                    self.skip_escape = False
+                elif char == "\\":
+                    self.skip_escape = True
+                elif char == '"':
+                    self.skip_in_string = False
+                    if self.skip_depth == 0:
+                        self.state = self.skip_return
+            elif char == '"':
+                self.skip_in_string = True
+            elif char in "[{":
+                self.skip_depth += 1
+            elif char in "]}":
+                if self.skip_depth == 0:
+                    self.state = self.skip_return
+                    return False
+                self.skip_depth -= 1
+                if self.skip_depth == 0:
+                    self.state = self.skip_return
+            elif char == "," and self.skip_depth == 0:
+                self.state = self.skip_return
+                return False
+        elif char in WHITESPACE:
+            pass
+        elif state == "key":
+            if char == '"':
+                self._start_string("key")
+            elif char == "}":
+                self.mode = "done"
+        elif state == "colon":
+            if char == ":":
+                self.state = "value"
+        elif state == "value":
+            if char == '"' and self.key == "text":
+                self._start_string("text")
+            elif char == "[" and self.key == "imageSources":
+                self.state = "array"
+            else:
+                self._start_skip(char, "key")
+        elif state == "array":
+            if char == '"':
+                self._start_string("image")
+            elif char == "]":
+                self.state = "key"
+            elif char != ",":
+                self._start_skip(char, "array")
+        return True
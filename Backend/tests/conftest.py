@@ -0,0 +1,99 @@
+import asyncio
+import os
+import socket
+import sys
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, "benchmarks"))
+
+import pytest
+
+# Read when gpt_utils is imported, the endpoint is set once the stub is up
+os.environ.update(
+    {
+        "AZURE_OPENAI_API_KEY": "stub",
+        "AZURE_OPENAI_DEPLOYMENT_NAME": "stub",
+        "AZURE_OPENAI_API_VERSION": "2024-08-01-preview",
+    }
+)
+
+import gpt_utils
+import stub_llm_server
+from fakes import patch_graph_store
+
+GRAPH = {
+    "nodes": [
+        {"name": name, "context": [f"{name} context"], "imageSources": ["a.png"]}
+        for name in ("Frontend", "Backend", "Database")
+    ],
+    "relationships": [
+        {
+            "from": source,
+            "to": target,
+            "name": "calls",
+            "context": [],
+            "imageSources": ["a.png"],
+        }
+        for source, target in (("Frontend", "Backend"), ("Backend", "Database"))
+    ],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="session")
+def stub_server():
+    port = free_port()
+    server, app = stub_llm_server.start_in_thread(port, latency=0.0)
+    os.environ["AZURE_OPENAI_ENDPOINT_URL"] = f"http://127.0.0.1:{port}"
+    yield app
+    server.should_exit = True
+
+
+@pytest.fixture
+def stub(stub_server):
+    # The stub with its behaviour and counters reset for every test
+    state = stub_server.state
+    state.latency = 0.0
+    state.token_latency = 0.0
+    state.rate_limit_ratio = 0.0
+    state.rate_limit_next = 0
+    state.retry_after = 0.1
+    state.calls = 0
+    state.rate_limited = 0
+    state.in_flight = 0
+    state.max_in_flight = 0
+    return stub_server
+
+
+@pytest.fixture(scope="session")
+def backend(stub_server, tmp_path_factory):
+    # main with GRAPH in an in-memory graph store and its files in a scratch
+    # directory
+    scratch_dir = tmp_path_factory.mktemp("backend")
+    os.environ.setdefault("NEO4J_URI", "bolt://localhost:7687")
+    os.environ.setdefault("NEO4J_USER", "neo4j")
+    os.environ.setdefault("NEO4J_PASSWORD", "")
+    os.environ["JOBS_DIR"] = str(scratch_dir / "jobs")
+    os.environ["TILE_CACHE_PATH"] = str(scratch_dir / "tile_cache.sqlite3")
+    # main.py loads its prompt files relative to the working directory
+    os.chdir(BACKEND_DIR)
+
+    import main
+
+    graph = patch_graph_store(main)
+    asyncio.run(graph.save(GRAPH))
+    return main
+
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    # Fresh metrics and slots for every test, and no waiting on retries
+    dispatcher = gpt_utils.LLMDispatcher(max_concurrency=1, max_retries=0)
+    monkeypatch.setattr(gpt_utils, "llm_dispatcher", dispatcher)
+    return dispatcher
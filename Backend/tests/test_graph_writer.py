@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from fakes import InMemoryGraph
+from storage_utils import GraphWriter
+
+
+def tile_graph(i):
+    return {
+        "nodes": [{"name": f"Node {i}", "context": [], "imageSources": []}],
+        "relationships": [],
+    }
+
+
+def test_graphs_are_saved_in_batches():
+    flushed = []
+
+    async def on_flush(keys, error):
+        flushed.append((keys, error))
+
+    async def write():
+        store = InMemoryGraph()
+        writer = GraphWriter(store, on_flush, max_nodes=2, queue_size=1)
+        writer.start()
+        for i in range(4):
+            await writer.put(f"0:{i}", tile_graph(i))
+        stats = await writer.close()
+        return stats, await store.get_fullgraph()
+
+    stats, graph = asyncio.run(write())
+
+    assert stats["graphs"] == 4
+    assert stats["flushes"] == 2
+    assert len(graph["nodes"]) == 4
+    assert [keys for keys, _ in flushed] == [["0:0", "0:1"], ["0:2", "0:3"]]
+
+
+def test_failing_on_flush_releases_blocked_puts():
+    # The writer dies while tiles wait for room on the full queue, they get
+    # its error instead of waiting forever
+    async def write():
+        release = asyncio.Event()
+
+        async def on_flush(keys, error):
+            await release.wait()
+            raise ValueError("Tile status could not be saved.")
+
+        writer = GraphWriter(InMemoryGraph(), on_flush, max_nodes=1, queue_size=1)
+        writer.start()
+        await writer.put("0:0", tile_graph(0))
+        # Taken by the writer, which is now stuck in on_flush
+        await asyncio.sleep(0.01)
+        await writer.put("0:1", tile_graph(1))
+        blocked = [
+            asyncio.create_task(writer.put(f"0:{i}", tile_graph(i)))
+            for i in range(2, 5)
+        ]
+        await asyncio.sleep(0.01)
+        assert not any(task.done() for task in blocked)
+
+        release.set()
+        results = await asyncio.wait_for(
+            asyncio.gather(*blocked, return_exceptions=True), 1
+        )
+        with pytest.raises(ValueError):
+            await asyncio.wait_for(writer.close(), 1)
+        with pytest.raises(ValueError):
+            await writer.put("0:5", tile_graph(5))
+        return results
+
+    results = asyncio.run(write())
+
+    assert all(isinstance(result, ValueError) for result in results)
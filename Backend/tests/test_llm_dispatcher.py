@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+import pytest
+from openai import RateLimitError
+
+import gpt_utils
+from gpt_utils import LLMDispatcher, TokenBucket
+
+
+def get_params(i=0):
+    return gpt_utils.get_completion_params(
+        [{"role": "user", "content": f"Question {i}"}]
+    )
+
+
+def run_calls(dispatcher, calls, caller="query"):
+    # Sends the calls at once and returns how long they took. A fresh client
+    # per run, its connection pool belongs to this event loop
+    async def burst():
+        client = gpt_utils.get_async_openai_client()
+        try:
+            await asyncio.gather(
+                *[
+                    dispatcher.create_async(client, get_params(i), caller)
+                    for i in range(calls)
+                ]
+            )
+        finally:
+            await client.close()
+
+    start = time.perf_counter()
+    asyncio.run(burst())
+    return time.perf_counter() - start
+
+
+def test_rate_limited_call_is_retried_after_retry_after(stub):
+    stub.state.rate_limit_next = 2
+    stub.state.retry_after = 0.2
+    dispatcher = LLMDispatcher(max_retries=3)
+
+    seconds = run_calls(dispatcher, 1)
+
+    assert stub.state.calls == 3
+    assert seconds >= 0.4
+    stats = dispatcher.stats()["callers"]["query"]
+    assert stats["succeeded"] == 1
+    assert stats["rate_limited"] == 2
+    assert stats["retries"] == 2
+
+
+def test_rate_limited_call_fails_after_max_retries(stub):
+    stub.state.rate_limit_ratio = 1.0
+    stub.state.retry_after = 0.05
+    dispatcher = LLMDispatcher(max_retries=1)
+
+    with pytest.raises(RateLimitError):
+        run_calls(dispatcher, 1)
+
+    assert stub.state.calls == 2
+    stats = dispatcher.stats()["callers"]["query"]
+    assert stats["failed"] == 1
+    assert stats["succeeded"] == 0
+
+
+def test_rate_limit_holds_back_every_caller(stub):
+    # A 429 on one call blocks the deployment for the others too
+    stub.state.rate_limit_next = 1
+    stub.state.retry_after = 0.3
+    stub.state.latency = 0.05
+    dispatcher = LLMDispatcher(max_concurrency=1)
+
+    seconds = run_calls(dispatcher, 2)
+
+    assert stub.state.calls == 3
+    assert seconds >= 0.3
+
+
+def test_token_bucket_goes_into_debt():
+    bucket = TokenBucket(60)
+    now = bucket.updated
+
+    assert bucket.reserve(60, now) == 0.0
+    # One unit a second, the next caller waits for what it takes
+    assert bucket.reserve(2, now) == pytest.approx(2.0)
+    assert bucket.reserve(1, now + 1) == pytest.approx(2.0)
+    # Never refills beyond a minute's worth
+    assert bucket.reserve(60, now + 1000) == 0.0
+
+
+def test_requests_are_throttled_to_the_quota(stub):
+    dispatcher = LLMDispatcher(requests_per_minute=600)
+    # Spend the burst, from here on ten requests a second
+    dispatcher.limiter.requests.available = 0
+
+    seconds = run_calls(dispatcher, 5)
+
+    assert stub.state.calls == 5
+    assert seconds >= 0.45
+    assert dispatcher.stats()["callers"]["query"]["wait_seconds"] >= 1.0
+
+
+def test_tokens_are_throttled_to_the_quota(stub):
+    tokens = gpt_utils.estimate_tokens(get_params()["messages"])
+    # Ten calls' worth of tokens a second
+    dispatcher = LLMDispatcher(tokens_per_minute=tokens * 600)
+    dispatcher.limiter.tokens.available = 0
+
+    seconds = run_calls(dispatcher, 3)
+
+    assert stub.state.calls == 3
+    assert seconds >= 0.27
+
+
+def test_concurrency_is_capped(stub):
+    stub.state.latency = 0.1
+    dispatcher = LLMDispatcher(max_concurrency=3)
+
+    seconds = run_calls(dispatcher, 9)
+
+    assert stub.state.calls == 9
+    assert stub.state.max_in_flight == 3
+    assert seconds >= 0.3
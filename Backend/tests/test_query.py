@@ -0,0 +1,41 @@
+from fastapi.testclient import TestClient
+
+QUERY = {
+    "user_input": "How does the Frontend reach the Database?",
+    "conversation_history": [],
+    "use_relevant_context": True,
+}
+
+
+def post_query(backend, query):
+    with TestClient(backend.app) as client:
+        return client.post("/query", json=query)
+
+
+def test_query_is_answered(backend, stub, dispatcher):
+    response = post_query(backend, QUERY)
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["response"] == "Stub answer."
+    assert body["image_names"] == ["a.png"]
+    assert {node["name"] for node in body["relevant_subgraph"]["nodes"]} >= {
+        "Frontend",
+        "Database",
+    }
+
+
+def test_query_without_an_answer_is_a_bad_gateway(
+    backend, stub, dispatcher, monkeypatch
+):
+    async def no_answer(messages, caller="default"):
+        return None
+
+    monkeypatch.setattr(backend, "get_gpt_response_async", no_answer)
+
+    response = post_query(
+        backend, {**QUERY, "user_input": "What does the Backend call?"}
+    )
+
+    assert response.status_code == 502
+    assert response.json()["detail"] == "No valid response from GPT."
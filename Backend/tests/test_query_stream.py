@@ -0,0 +1,219 @@
+import asyncio
+import json
+import re
+
+import pytest
+from fastapi.testclient import TestClient
+
+import gpt_utils
+
+EVENT_PATTERN = re.compile(r"event: (\w+)\ndata: (.*)")
+
+
+def parse_events(body):
+    # Every event is an event line and a data line, ended by a blank line
+    assert body.endswith("\n\n")
+    events = []
+    for block in body[:-2].split("\n\n"):
+        match = EVENT_PATTERN.fullmatch(block)
+        assert match, block
+        events.append((match.group(1), json.loads(match.group(2))))
+    return events
+
+
+def post_query(backend, user_input, use_relevant_context=False):
+    with TestClient(backend.app) as client:
+        response = client.post(
+            "/query/stream",
+            json={
+                "user_input": user_input,
+                "conversation_history": [],
+                "use_relevant_context": use_relevant_context,
+            },
+        )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.headers["cache-control"] == "no-cache"
+    return parse_events(response.text)
+
+
+def test_events_are_framed(backend, stub, dispatcher):
+    stub.state.token_latency = 0.001
+
+    events = post_query(backend, "How does the Frontend reach the Database?")
+
+    kinds = [kind for kind, _ in events]
+    assert kinds[0] == "subgraph"
+    assert kinds[-1] == "done"
+    assert set(kinds[1:-1]) <= {"token", "image"}
+    # The answer arrives in several tokens that add up to the final text
+    tokens = [data["text"] for kind, data in events if kind == "token"]
+    assert len(tokens) > 1
+    done = events[-1][1]
+    assert "".join(tokens) == done["response"] == "Stub answer."
+    images = [data["image_name"] for kind, data in events if kind == "image"]
+    assert images == done["image_names"] == ["a.png"]
+    subgraph = events[0][1]["relevant_subgraph"]
+    assert len(subgraph["nodes"]) == 3
+    assert dispatcher.stats()["callers"]["query"]["succeeded"] == 1
+
+
+def test_llm_error_becomes_an_error_event(backend, stub, dispatcher):
+    stub.state.rate_limit_ratio = 1.0
+
+    events = post_query(backend, "Which calls reach the Database?")
+
+    assert [kind for kind, _ in events] == ["subgraph", "error"]
+    assert "rate limit" in events[-1][1]["detail"]
+    assert dispatcher.stats()["callers"]["query"]["failed"] == 1
+
+
+def test_error_after_tokens_ends_the_stream(backend, stub, monkeypatch):
+    async def broken_stream(messages, caller="default"):
+        yield '{"text": "Half'
+        raise RuntimeError("Upstream closed the connection.")
+
+    monkeypatch.setattr(backend, "stream_gpt_response_async", broken_stream)
+
+    events = post_query(backend, "What does the Backend call?")
+
+    assert events[1:] == [
+        ("token", {"text": "Half"}),
+        ("error", {"detail": "Upstream closed the connection."}),
+    ]
+
+
+def test_client_disconnect_stops_the_upstream_stream(backend, stub, dispatcher):
+    # As Starlette does when the client goes away, the task reading the
+    # events is cancelled after the first token
+    stub.state.token_latency = 0.05
+
+    async def read_until_cancelled():
+        events = backend.stream_query(
+            "Where does the Frontend send requests?", [], False, "default"
+        )
+        first_token = asyncio.Event()
+
+        async def read():
+            async for event in events:
+                if event.startswith("event: token"):
+                    first_token.set()
+
+        task = asyncio.create_task(read())
+        await first_token.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await events.aclose()
+        # The stub sees the connection close when it sends the next token
+        for _ in range(50):
+            if stub.state.in_flight == 0:
+                break
+            await asyncio.sleep(0.02)
+        return dispatcher._get_async_semaphore().locked()
+
+    assert asyncio.run(read_until_cancelled()) is False
+    assert stub.state.in_flight == 0
+
+
+def test_slot_is_freed_before_the_client_reads_the_answer(stub, dispatcher):
+    stub.state.token_latency = 0.01
+    messages = [{"role": "user", "content": "Question"}]
+
+    async def read_slowly():
+        client = gpt_utils.get_async_openai_client()
+        texts = dispatcher.stream_async(
+            client, gpt_utils.get_completion_params(messages), "query"
+        )
+        try:
+            chunks = [await anext(texts)]
+            semaphore = dispatcher._get_async_semaphore()
+            # Upstream is drained while the first token is still being read
+            for _ in range(100):
+                if not semaphore.locked():
+                    break
+                await asyncio.sleep(0.02)
+            freed = not semaphore.locked()
+            chunks += [text async for text in texts]
+        finally:
+            await texts.aclose()
+            await client.close()
+        return freed, "".join(chunks)
+
+    freed, answer = asyncio.run(read_slowly())
+
+    assert freed
+    assert json.loads(answer)["text"] == "Stub answer."
+    assert dispatcher.stats()["callers"]["query"]["succeeded"] == 1
+
+
+class FakeStream:
+    def __init__(self):
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeClient:
+    # Just enough of AsyncAzureOpenAI for stream_async to open a stream
+    def __init__(self, stream):
+        self.chat = self.completions = self
+        self.stream = stream
+
+    async def create(self, **params):
+        return self.stream
+
+
+def test_slot_is_freed_when_the_reader_never_starts(dispatcher, monkeypatch):
+    # The reader is cancelled right after the stream is created, before it
+    # runs at all, as happens when the event loop shuts down
+    create_task = asyncio.create_task
+
+    def cancel_reader(coro, **kwargs):
+        task = create_task(coro, **kwargs)
+        if coro.__name__ == "_read_stream":
+            task.cancel()
+        return task
+
+    monkeypatch.setattr(asyncio, "create_task", cancel_reader)
+    stream = FakeStream()
+    messages = [{"role": "user", "content": "Question"}]
+
+    async def read():
+        texts = dispatcher.stream_async(
+            FakeClient(stream), gpt_utils.get_completion_params(messages), "query"
+        )
+        with pytest.raises(RuntimeError, match="cancelled"):
+            await asyncio.wait_for(anext(texts), 1)
+        await asyncio.sleep(0)
+        return dispatcher._get_async_semaphore()
+
+    semaphore = asyncio.run(read())
+
+    assert semaphore._value == dispatcher.max_concurrency
+    assert stream.closed
+
+
+def test_question_without_matching_nodes_gets_the_hubs(
+    backend, stub, dispatcher, monkeypatch
+):
+    monkeypatch.setattr(backend, "SUBGRAPH_MAX_NODES", 2)
+
+    subgraph = asyncio.run(
+        backend.get_relevant_subgraph_from_neo4j(
+            "What does this flowchart do?", "default"
+        )
+    )
+
+    # The best connected nodes and only the edges between them
+    assert [node["name"] for node in subgraph["nodes"]] == ["Backend", "Frontend"]
+    assert [(rel["from"], rel["to"]) for rel in subgraph["relationships"]] == [
+        ("Frontend", "Backend")
+    ]
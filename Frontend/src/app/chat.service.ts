@@ -22,6 +22,7 @@ export class ChatService {
         user_input: message,
         conversation_history: conversationContext,
         use_relevant_context: useRelevantContext,
+        collection_id: environment.collectionId,
       })
       .pipe(
         tap((response: any) => {
@@ -1,13 +1,40 @@
 import { HttpClient } from '@angular/common/http';
 import { Injectable } from '@angular/core';
-import { BehaviorSubject, Observable, tap } from 'rxjs';
+import {
+  BehaviorSubject,
+  filter,
+  map,
+  Observable,
+  switchMap,
+  take,
+  tap,
+  timer,
+} from 'rxjs';
 import { environment } from '../environments/environment';
-import { Graph } from './model';
+import { Graph, GraphChanges } from './model';
 
 interface FullGraphResponse {
   full_graph: Graph;
 }
 
+interface GraphEditResponse {
+  version: number;
+  changes: GraphChanges;
+}
+
+interface UploadJobResponse {
+  job_id: string;
+  status: string;
+}
+
+interface UploadJob {
+  job_id: string;
+  status: string;
+  error: string | null;
+}
+
+const JOB_POLL_INTERVAL_MS = 2000;
+
 @Injectable({
   providedIn: 'root',
 })
@@ -26,18 +53,74 @@ export class ImageUploadService {
       rows: environment.imageSegmentation.rows,
       cols: environment.imageSegmentation.cols,
       overlap: environment.imageSegmentation.overlap,
+      tiling_mode: environment.imageSegmentation.tilingMode,
+      collection_id: environment.collectionId,
     };
 
-    return this.http.post(this.apiBaseUrl + '/upload', payload).pipe(
+    return this.finishUpload(
+      this.http.post(this.apiBaseUrl + '/upload', payload)
+    );
+  }
+
+  // Sends the files as they are instead of as base64 text, so the backend
+  // can stream them to disk rather than hold the whole upload in memory
+  uploadImageFiles(files: File[], imageNames: string[]): Observable<any> {
+    const segmentation = environment.imageSegmentation;
+    const formData = new FormData();
+    files.forEach((file, i) => {
+      formData.append('images', file);
+      formData.append('image_names', imageNames[i]);
+    });
+    formData.append('rows', String(segmentation.rows));
+    formData.append('cols', String(segmentation.cols));
+    formData.append('overlap', String(segmentation.overlap));
+    formData.append('tiling_mode', segmentation.tilingMode);
+    formData.append('collection_id', environment.collectionId);
+
+    return this.finishUpload(
+      this.http.post(this.apiBaseUrl + '/upload/files', formData)
+    );
+  }
+
+  private finishUpload(upload: Observable<any>): Observable<any> {
+    return upload.pipe(
+      switchMap((response: UploadJobResponse) =>
+        this.waitForJob(response.job_id)
+      ),
+      // The job status leaves the graph out, it is fetched once at the end
+      switchMap((job: UploadJob) =>
+        this.http.get<FullGraphResponse>(
+          `${this.apiBaseUrl}/jobs/${job.job_id}/graph`
+        )
+      ),
       tap((response: FullGraphResponse) => {
         this.fullGraphSubject.next(response.full_graph);
       })
     );
   }
 
+  // The backend processes uploads in the background, poll until the job is done
+  waitForJob(jobId: string): Observable<UploadJob> {
+    return timer(0, JOB_POLL_INTERVAL_MS).pipe(
+      switchMap(() =>
+        this.http.get<UploadJob>(`${this.apiBaseUrl}/jobs/${jobId}`)
+      ),
+      filter((job) => job.status === 'completed' || job.status === 'failed'),
+      take(1),
+      map((job) => {
+        if (job.status === 'failed') {
+          throw new Error(job.error);
+        }
+        return job;
+      })
+    );
+  }
+
   queryFullGraph() {
     this.http
-      .get(this.apiBaseUrl + '/fullgraph')
+      .get(this.apiBaseUrl + '/fullgraph', {
+        params: { collection_id: environment.collectionId },
+      })
       .pipe(
         tap((response: FullGraphResponse) => {
           this.fullGraphSubject.next(response.full_graph);
@@ -51,10 +134,62 @@ export class ImageUploadService {
   }
 
   editGraph(payload: any) {
-    return this.http.post(this.apiBaseUrl + '/editgraph', payload).pipe(
-      tap((response: FullGraphResponse) => {
-        this.fullGraphSubject.next(response.full_graph);
+    return this.http
+      .post(this.apiBaseUrl + '/editgraph', {
+        ...payload,
+        collection_id: environment.collectionId,
       })
-    );
+      .pipe(
+        tap((response: GraphEditResponse) => {
+          const graph = this.fullGraphSubject.value;
+          if (graph) {
+            this.fullGraphSubject.next(
+              applyGraphChanges(graph, response.changes)
+            );
+          } else {
+            this.queryFullGraph();
+          }
+        })
+      );
   }
 }
+
+// The backend only returns what an edit changed, patch the local graph in
+// the same order it applied them: edges first, then nodes
+function applyGraphChanges(graph: Graph, changes: GraphChanges): Graph {
+  const edgeKey = (edge: { from: string; to: string; name: string }) =>
+    JSON.stringify([edge.from, edge.to, edge.name]);
+
+  const deletedEdges = new Set(changes.deleted_relationships.map(edgeKey));
+  const relationships = new Map(
+    graph.relationships
+      .filter((edge) => !deletedEdges.has(edgeKey(edge)))
+      .map((edge) => [edgeKey(edge), edge])
+  );
+  for (const edge of changes.upserted_relationships) {
+    relationships.set(edgeKey(edge), edge);
+  }
+
+  const nodes = new Map(graph.nodes.map((node) => [node.name, node]));
+  for (const node of changes.upserted_nodes) {
+    nodes.set(node.name, node);
+  }
+  const deletedNodes = new Set(changes.deleted_nodes);
+  const renamedNodes = new Map(changes.renamed_nodes);
+  const rename = (name: string) => renamedNodes.get(name) ?? name;
+
+  return {
+    nodes: [...nodes.values()]
+      .filter((node) => !deletedNodes.has(node.name))
+      .map((node) => ({ ...node, name: rename(node.name) })),
+    relationships: [...relationships.values()]
+      .filter(
+        (edge) => !deletedNodes.has(edge.from) && !deletedNodes.has(edge.to)
+      )
+      .map((edge) => ({
+        ...edge,
+        from: rename(edge.from),
+        to: rename(edge.to),
+      })),
+  };
+}
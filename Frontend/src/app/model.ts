@@ -10,13 +10,13 @@ export interface VisGraph {
   edges: VisEdge[];
 }
 
-interface Node {
+export interface Node {
   context: string[];
   imageSources: string[];
   name: string;
 }
 
-interface Relationship {
+export interface Relationship {
   from: string;
   to: string;
   imageSources: string[];
@@ -24,6 +24,14 @@ interface Relationship {
   context: string[];
 }
 
+export interface GraphChanges {
+  upserted_nodes: Node[];
+  deleted_nodes: string[];
+  renamed_nodes: [string, string][];
+  upserted_relationships: Relationship[];
+  deleted_relationships: { from: string; to: string; name: string }[];
+}
+
 export interface ChatResponse {
   response: string;
   image_names: string[];
@@ -71,24 +71,24 @@ export class UploadComponent {
   }
 
   onTemplatedUpload(event: any) {
-    const files = event.files;
-    const base64Images: string[] = [];
-    const imageNames: string[] = [];
+    const files: File[] = event.files;
+    const imageNames: string[] = new Array(files.length);
+    let namedImages = 0;
 
-    files.forEach((file: File) => {
+    // The files are uploaded as they are, they are only read here to name them
+    files.forEach((file: File, i: number) => {
       const reader = new FileReader();
       reader.onload = () => {
         const base64String = (reader.result as string).split(',')[1];
-        base64Images.push(base64String);
 
         // File name = File name + crc32hash(base64String)
         const hash = crc32(base64String).toString(16);
         const newFileName = `${file.name}-${hash}`;
 
-        imageNames.push(newFileName);
+        imageNames[i] = newFileName;
         console.log('File name: ', newFileName);
 
-        if (base64Images.length === files.length) {
+        if (++namedImages === files.length) {
           const interval = setInterval(() => {
             if (this.progress < 97) {
               this.progress += 1;
@@ -96,7 +96,7 @@ export class UploadComponent {
           }, 1000);
 
           this.imageUploadService
-            .uploadImage(base64Images, imageNames)
+            .uploadImageFiles(files, imageNames)
             .subscribe(
               (response) => {
                 this.messageService.add({
@@ -4,10 +4,16 @@ export const environment = {
   //   Backend API base URL
   apiBaseUrl: 'http://localhost:8000',
 
+  //   Collection the uploads go into and queries, the graph and edits are about
+  collectionId: 'default',
+
   //   Image segmentation configuration
   imageSegmentation: {
     rows: 2,
     cols: 2,
     overlap: 50,
+    // 'grid' always sends rows x cols segments, 'adaptive' (opt-in) follows the diagram
+    // content and can send fewer or more segments
+    tilingMode: 'grid',
   },
 };